@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+热键动作队列：去抖、合并和临时切换的串行化。
+
+- 去抖：按住热键时系统按键盘重复频率不断发送 WM_HOTKEY（注册时已带 MOD_NOREPEAT，
+  这里再兜底）。同一热键 repeat_delay 秒内的再次触发视为自动重复，丢弃。
+- 合并：同一轮事件循环中到达的切换 / 英文 / 第二语言动作合并为一次净状态变化，
+  对前台窗口最多发出一次 PostMessage；连按偶数次切换不发出任何消息。
+- 临时切换（temp / instant）同一时间只有一个：
+  - 等待切回期间再按临时切换：延长等待，从现在起重新计时，取两者中较长的间隔
+  - 等待期间按切换 / 英文 / 第二语言：取消临时切换，不再切回（以用户明确的选择为准）
+  - 临时切换尚未切出（等待热键松开）时再按：视为同一次
+"""
+
+import asyncio
+import logging
+import time
+
+from ime_switcher.switcher import ENGLISH_KEYBOARD_ID
+
+logger = logging.getLogger('ime_switcher')
+
+TOGGLE = 'toggle'
+ENGLISH = 'english'
+SECONDARY = 'secondary'
+TEMP_TOGGLE = 'temp_toggle'
+INSTANT_TOGGLE = 'instant_toggle'
+# 配置中 hotkeys 可以绑定的目标
+HOTKEY_TARGETS = (TOGGLE, TEMP_TOGGLE, INSTANT_TOGGLE, ENGLISH, SECONDARY)
+
+_switch_actions = (TOGGLE, ENGLISH, SECONDARY)
+_temp_actions = (TEMP_TOGGLE, INSTANT_TOGGLE)
+
+
+class HotkeyActions:
+    """
+    Args:
+        loop: 事件循环
+        switcher: Switcher，配置重新加载后可直接替换该属性
+        activity_scheduler: 临时切换等待期间采样按键的 ActivityScheduler，同样可替换
+        repeat_delay: 自动重复的判定间隔（秒）
+    """
+
+    def __init__(self, loop, switcher, activity_scheduler=None, repeat_delay=0.05):
+        self.loop = loop
+        self.switcher = switcher
+        self.activity_scheduler = activity_scheduler
+        self.repeat_delay = repeat_delay
+        self.press_count = 0
+        self.debounced = 0
+        self.coalesced = 0
+        self.extended = 0
+        self.cancelled = 0
+        # 动作 -> 上次触发时间
+        self._last_press = {}
+        self._pending = []
+        self._temp_task = None
+        self._temp_timer = None
+
+    def press(self, action, timestamp=None, interval=None):
+        """
+        处理一次热键。interval 为临时切换的不活动间隔（秒）。
+        返回 False 表示作为自动重复被丢弃。
+        """
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        self.press_count += 1
+        last = self._last_press.get(action)
+        self._last_press[action] = timestamp
+        if last is not None and timestamp - last < self.repeat_delay:
+            self.debounced += 1
+            return False
+
+        if action in _temp_actions:
+            self._press_temp(interval)
+            return True
+        if action not in _switch_actions:
+            raise ValueError(f'Unknown action: {action}')
+        self.cancel_temp()
+        if not self._pending:
+            self.loop.call_soon(self._flush)
+        self._pending.append(action)
+        return True
+
+    @property
+    def is_temp_toggling(self):
+        return self._temp_task is not None and not self._temp_task.done()
+
+    def cancel_temp(self):
+        """取消进行中的临时切换，不切回"""
+        if self.is_temp_toggling:
+            self._temp_task.cancel()
+            self.cancelled += 1
+            logger.info('Temp toggle cancelled')
+
+    def stats(self):
+        return {
+            'presses': self.press_count,
+            'debounced': self.debounced,
+            'coalesced': self.coalesced,
+            'temp_extended': self.extended,
+            'temp_cancelled': self.cancelled,
+        }
+
+    def _flush(self):
+        pending, self._pending = self._pending, []
+        switcher = self.switcher
+        hwnd = switcher.get_front_window()
+        start = langid = switcher.get_window_langid(hwnd)
+        target = None
+        for action in pending:
+            if action == TOGGLE:
+                target = switcher.toggle_target(hwnd, langid)
+            elif action == ENGLISH:
+                target = ENGLISH_KEYBOARD_ID
+            else:
+                target = switcher.get_secondary_keyboard_id(hwnd)
+            langid = target[4:8]
+
+        if langid == start:
+            self.coalesced += len(pending)
+            if len(pending) > 1:
+                logger.debug(f'{len(pending)} hotkey presses cancelled out')
+            return
+        self.coalesced += len(pending) - 1
+        switcher.set_input_language_for_window(hwnd, target)
+        name = 'ENGLISH' if target == ENGLISH_KEYBOARD_ID else 'secondary keyboard'
+        logger.info(f'{switcher.get_window_title(hwnd) or "[Unknown]"}: switched to {name}'
+                    + (f' ({len(pending)} presses)' if len(pending) > 1 else ''))
+
+    def _press_temp(self, interval):
+        if self.is_temp_toggling:
+            if self._temp_timer is not None:
+                # 已切出，正在等待切回：从现在起重新计时
+                self._temp_timer.interval = max(self._temp_timer.interval, interval)
+                self._temp_timer.touch()
+                self.extended += 1
+                logger.info(f'Temp toggle extended, switching back after {self._temp_timer.interval}s of inactivity')
+            return
+        self._temp_task = self.loop.create_task(self._temp_toggle(interval))
+
+    async def _temp_toggle(self, interval):
+        def on_timer(timer):
+            self._temp_timer = timer
+
+        try:
+            await self.switcher.temp_toggle(self.activity_scheduler, interval, on_timer)
+        finally:
+            self._temp_timer = None
+
+
+def _world(layout_delay, windows):
+    from ime_switcher.backend import SimulatedBackend
+    from ime_switcher.layouts import KeyboardLayoutRegistry, PlatformLayoutBackend
+    from ime_switcher.switcher import Switcher
+
+    # 避开中文的 2s 最短切回时间
+    secondary = '00000411'
+    backend = SimulatedBackend(layouts=(ENGLISH_KEYBOARD_ID, secondary), layout_delay=layout_delay)
+    hwnds = [backend.add_window(f'window {i}') for i in range(windows)]
+    registry = KeyboardLayoutRegistry(PlatformLayoutBackend(backend), (ENGLISH_KEYBOARD_ID, secondary))
+    registry.preload()
+    switcher = Switcher(secondary, registry, backend=backend, temp_toggle_delay=0.01)
+    return backend, hwnds, switcher
+
+
+async def _stress(rate=5000, seconds=2.0, windows=5, layout_delay=0.02):
+    """
+    以每秒 rate 次的速度向模拟后端发送热键（连按、按住），布局变化延迟 layout_delay 秒才生效。
+    对比逐个处理和经过动作队列处理的后端调用数，以及每个窗口的最终布局是否与（被接受的）按键一致。
+    """
+    import random
+
+    from ime_switcher.message_pump import SimulatedHotkeySource
+
+    rng = random.Random(7)
+    count = int(rate * seconds)
+    actions = [rng.choice((TOGGLE,) * 8 + (ENGLISH, SECONDARY)) for _ in range(count)]
+    ids = {TOGGLE: 1, ENGLISH: 4, SECONDARY: 5}
+    names = {v: k for k, v in ids.items()}
+    loop = asyncio.get_running_loop()
+
+    # direct: 每个热键直接切换；no settle: 不考虑布局生效的延迟（旧行为）；
+    # no debounce: 只合并不去抖，相当于连按而不是按住
+    for mode, settle, repeat_delay in (('direct, no settle', False, None), ('direct', True, None),
+                                       ('queued, no debounce', True, 0.0), ('queued', True, 0.05)):
+        backend, hwnds, switcher = _world(layout_delay, windows)
+        if not settle:
+            switcher.settle_time = 0
+        queue = HotkeyActions(loop, switcher, repeat_delay=repeat_delay or 0.0)
+        source = SimulatedHotkeySource()
+        handled = [0]
+        # hwnd -> 是否应为第二语言
+        expected = {}
+
+        def on_hotkey(hotkey_id, timestamp):
+            handled[0] += 1
+            action = names[hotkey_id]
+            if repeat_delay is None:
+                {TOGGLE: switcher.toggle, ENGLISH: switcher.switch_english, SECONDARY: switcher.switch_secondary}[action]()
+            elif not queue.press(action, timestamp):
+                return
+            hwnd = backend.foreground
+            expected[hwnd] = not expected.get(hwnd, False) if action == TOGGLE else action == SECONDARY
+
+        source.start(loop, on_hotkey)
+        for hotkey_id in ids.values():
+            await source.register_hotkey(hotkey_id, 0, hotkey_id)
+        backend.calls.clear()
+        start = time.perf_counter()
+        for i, action in enumerate(actions):
+            if i % 500 == 0:
+                # 切换窗口前等已发出的热键处理完
+                while handled[0] < i:
+                    await asyncio.sleep(0.001)
+                backend.focus(rng.choice(hwnds))
+            source.post_hotkey(ids[action])
+            if i % 50 == 49:
+                await asyncio.sleep(50 / rate)
+        while handled[0] < count:
+            await asyncio.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        source.stop()
+        calls = dict(backend.calls)
+        await asyncio.sleep(layout_delay * 2)
+        wrong = sum(1 for hwnd in hwnds
+                    if (switcher.get_window_langid(hwnd) == '0411') != expected.get(hwnd, False))
+        print(f'{mode:19}: {count / elapsed:6.0f} hotkeys/s, {calls.get("post_message", 0):5} PostMessage, '
+              f'{calls.get("get_keyboard_layout", 0):5} GetKeyboardLayout, '
+              f'{wrong}/{len(hwnds)} windows in an unexpected state'
+              + (f', {queue.stats()}' if repeat_delay is not None else ''))
+
+
+async def _temp_semantics():
+    """临时切换的延长和取消"""
+    from ime_switcher.activity import ActivityScheduler, FakeActivitySource
+
+    loop = asyncio.get_running_loop()
+    backend, hwnds, switcher = _world(0.0, 1)
+    scheduler = ActivityScheduler(loop, FakeActivitySource.name)
+    queue = HotkeyActions(loop, switcher, scheduler)
+
+    def langid():
+        return switcher.get_window_langid(hwnds[0])
+
+    queue.press(TEMP_TOGGLE, interval=0.1)
+    await asyncio.sleep(0.05)
+    switched = langid()
+    queue.press(INSTANT_TOGGLE, interval=0.2)
+    await asyncio.sleep(0.15)
+    extended = langid()
+    await asyncio.sleep(0.2)
+    print(f'temp toggle: switched to {switched}, still {extended} after extension, back to {langid()}')
+
+    queue.press(TEMP_TOGGLE, interval=0.1)
+    await asyncio.sleep(0.05)
+    queue.press(TOGGLE)
+    await asyncio.sleep(0.3)
+    print(f'temp toggle then toggle: {langid()} (cancelled, not switched back), {queue.stats()}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_stress())
+    asyncio.run(_temp_semantics())
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+键盘活动来源：为临时切换提供"最近一次按键时间"。
+
+- HookActivitySource: 低级键盘钩子 (WH_KEYBOARD_LL)，按键时推送，空闲时零开销
+- PollingActivitySource: 原来的 GetAsyncKeyState 全键扫描，作为后备
+- FakeActivitySource: 进程内模拟按键，用于在 Linux 上测试和基准测试
+
+ActivityScheduler 只在临时切换等待切回期间启动采样，其余时间完全停止；
+会话暂停（锁屏等）期间轮询来源也不扫描。
+"""
+
+import asyncio
+import contextlib
+import ctypes
+import logging
+import time
+
+from ime_switcher import win32
+from ime_switcher.backend import get_backend
+from ime_switcher.logs import RateLimit
+from ime_switcher.message_pump import MessageThread
+from ime_switcher.metrics import histogram
+from ime_switcher.timer import DeadlineTimer
+from ime_switcher.win32 import KBDLLHOOKSTRUCT
+
+logger = logging.getLogger('ime_switcher')
+# 每次按键都会经过这里，调试日志限速
+_key_log = RateLimit(logger, logging.DEBUG, 1.0)
+
+WH_KEYBOARD_LL = 13
+HC_ACTION = 0
+WM_KEYDOWN = 0x0100
+WM_SYSKEYDOWN = 0x0104
+
+
+class ActivitySource:
+    """键盘活动来源的基类，所有实现都通过 on_key_press 更新 last_key_press_time"""
+    name = 'base'
+
+    def __init__(self):
+        self.last_key_press_time = None
+        self.key_press_count = 0
+        # SessionState（可选），由 ActivityScheduler 设置
+        self.session = None
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """注册按键回调 callback(vk, timestamp)，在事件循环线程上调用"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def reset(self):
+        """清除最近一次按键时间，开始新一轮等待"""
+        self.last_key_press_time = None
+
+    def on_key_press(self, vk, timestamp=None):
+        self.last_key_press_time = time.monotonic() if timestamp is None else timestamp
+        self.key_press_count += 1
+        suppressed = _key_log.allow()
+        if suppressed is not None:
+            logger.debug(f'key pressed: {vk}{RateLimit.suffix(suppressed)}')
+        for callback in self._listeners:
+            callback(vk, self.last_key_press_time)
+
+    def start(self, loop):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class PollingActivitySource(ActivitySource):
+    """每隔 interval 秒扫描全部 256 个虚拟键 (GetAsyncKeyState)"""
+    name = 'polling'
+
+    def __init__(self, interval=0.05, get_async_key_state=None):
+        super().__init__()
+        self.interval = interval
+        self.call_count = 0
+        self._get_async_key_state = get_async_key_state
+        self._task = None
+
+    def start(self, loop):
+        if self._get_async_key_state is None:
+            self._get_async_key_state = get_backend().get_async_key_state
+        self._task = loop.create_task(self._poll())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _poll(self):
+        while True:
+            if self.session is not None and await self.session.wait_active():
+                # 暂停期间的按键状态没有意义，清掉“上次调用以来按下过”的标志
+                for vk in range(256):
+                    self._get_async_key_state(vk)
+            for vk in range(256):
+                self.call_count += 1
+                if self._get_async_key_state(vk) & 0x0001:  # Key was pressed since last call
+                    self.on_key_press(vk)
+                    break
+            await asyncio.sleep(self.interval)
+
+
+class HookActivitySource(ActivitySource):
+    """
+    低级键盘钩子。钩子安装在独立的消息线程上，该线程阻塞在 GetMessageW 中，
+    按键时通过 call_soon_threadsafe 把事件交给事件循环。
+    """
+    name = 'hook'
+
+    def __init__(self):
+        super().__init__()
+        self._loop = None
+        self._thread = None
+        self._hook = None
+        self._hook_proc = None
+
+    def start(self, loop, timeout=1.0):
+        self._loop = loop
+        self._thread = MessageThread('KeyboardHook')
+        self._thread.start(timeout)
+        try:
+            self._thread.call(self._install).result(timeout)
+        except Exception as e:
+            self._thread.stop()
+            raise e if isinstance(e, OSError) else OSError(str(e))
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.call(self._uninstall)
+            self._thread.stop()
+            self._thread = None
+
+    def _install(self):
+        api = win32.api()
+        self._hook_proc = api.HOOKPROC(self._on_hook)
+        self._hook = api.SetWindowsHookExW(WH_KEYBOARD_LL, self._hook_proc, api.GetModuleHandleW(None), 0)
+        if not self._hook:
+            raise api.error()
+
+    def _uninstall(self):
+        if self._hook:
+            win32.api().UnhookWindowsHookEx(self._hook)
+            self._hook = None
+            logger.info('Keyboard hook removed')
+
+    def _on_hook(self, n_code, w_param, l_param):
+        if n_code == HC_ACTION and w_param in (WM_KEYDOWN, WM_SYSKEYDOWN):
+            info = ctypes.cast(l_param, ctypes.POINTER(KBDLLHOOKSTRUCT)).contents
+            # 钩子回调必须尽快返回，实际处理交给事件循环线程
+            self._loop.call_soon_threadsafe(self.on_key_press, info.vkCode, time.monotonic())
+        return win32.api().CallNextHookEx(None, n_code, w_param, l_param)
+
+
+class FakeActivitySource(ActivitySource):
+    """进程内模拟的按键来源，start/stop 不做任何事"""
+    name = 'fake'
+
+    def start(self, loop):
+        pass
+
+    def stop(self):
+        pass
+
+    def press(self, vk=0x41, timestamp=None):
+        self.on_key_press(vk, timestamp)
+
+    async def type_burst(self, count, gap):
+        """以 gap 秒的间隔连续按键 count 次"""
+        for _ in range(count):
+            self.press()
+            await asyncio.sleep(gap)
+
+
+_activity_sources = {
+    HookActivitySource.name: HookActivitySource,
+    PollingActivitySource.name: PollingActivitySource,
+    FakeActivitySource.name: FakeActivitySource,
+}
+
+
+def create_activity_source(kind='hook'):
+    if kind not in _activity_sources:
+        raise ValueError(f'Unknown activity source: {kind}')
+    return _activity_sources[kind]()
+
+
+class ActivityScheduler:
+    """
+    按需启动键盘活动采样：arm() 时启动活动来源，最后一次 disarm() 时停止，
+    并统计采样处于活动状态的总时长
+    """
+
+    def __init__(self, loop, kind='hook', session=None):
+        self.loop = loop
+        self.session = session
+        self.source = create_activity_source(kind)
+        self.arm_count = 0
+        self._armed = 0
+        self._armed_since = None
+        self._active_seconds = 0.0
+
+    @property
+    def is_armed(self):
+        return self._armed > 0
+
+    @property
+    def active_seconds(self):
+        """采样处于活动状态的累计时长（秒）"""
+        if self._armed_since is None:
+            return self._active_seconds
+        return self._active_seconds + time.monotonic() - self._armed_since
+
+    def arm(self):
+        if self._armed == 0:
+            self._start_source()
+            self.arm_count += 1
+            self._armed_since = time.monotonic()
+            logger.debug(f'Activity sampling armed ({self.source.name})')
+        self._armed += 1
+
+    def disarm(self):
+        if self._armed == 0:
+            return
+        self._armed -= 1
+        if self._armed > 0:
+            return
+        self.source.stop()
+        self._active_seconds += time.monotonic() - self._armed_since
+        self._armed_since = None
+        logger.debug(f'Activity sampling parked, total active {self._active_seconds:.2f}s')
+
+    @contextlib.contextmanager
+    def armed(self):
+        self.arm()
+        try:
+            yield self.source
+        finally:
+            self.disarm()
+
+    def stats(self):
+        return {
+            'source': self.source.name,
+            'armed': self.is_armed,
+            'arm_count': self.arm_count,
+            'active_seconds': round(self.active_seconds, 3),
+            'key_press_count': self.source.key_press_count,
+        }
+
+    def _start_source(self):
+        self.source.session = self.session
+        try:
+            self.source.start(self.loop)
+        except OSError as e:
+            # 钩子安装失败时永久回退到轮询
+            if self.source.name != HookActivitySource.name:
+                raise
+            logger.warning(f'Keyboard hook unavailable ({e}), falling back to polling')
+            self.source = PollingActivitySource()
+            self.source.session = self.session
+            self.source.start(self.loop)
+
+
+async def wait_for_key_inactivity(source, interval, on_timer=None):
+    """
+    等待用户停止输入：至少有一次按键，且之后 interval 秒内没有新的按键。
+    每次按键重置截止时间，到期立即返回，不再按固定间隔轮询。
+
+    on_timer: 可选，on_timer(timer) 收到内部的 DeadlineTimer，调用方可以 touch() 延长等待
+    """
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def on_deadline():
+        if not done.done():
+            done.set_result(None)
+
+    timer = DeadlineTimer(loop, interval, on_deadline, histogram('switch_back_error_ms'))
+    if on_timer is not None:
+        on_timer(timer)
+
+    def on_key_press(vk, timestamp):
+        timer.touch(timestamp)
+
+    source.reset()
+    source.add_listener(on_key_press)
+    try:
+        await done
+    finally:
+        timer.cancel()
+        source.remove_listener(on_key_press)
+
+
+async def _benchmark():
+    # 1. 空闲开销：轮询扫描每秒的 GetAsyncKeyState 调用次数
+    loop = asyncio.get_running_loop()
+    polling = PollingActivitySource(get_async_key_state=lambda vk: 0)
+    polling.start(loop)
+    await asyncio.sleep(1.0)
+    polling.stop()
+    print(f'polling: {polling.call_count} GetAsyncKeyState calls per idle second')
+    print(f'hook:    0 calls per idle second (push-based)')
+
+    # 2. 切回时机：模拟一段输入后停止，测量实际切回时间与预期的误差
+    scheduler = ActivityScheduler(loop, kind=FakeActivitySource.name)
+    started = time.monotonic()
+    for interval in (0.3, 0.6, 2.0):
+        with scheduler.armed() as source:
+            waiter = asyncio.ensure_future(wait_for_key_inactivity(source, interval))
+            await source.type_burst(count=10, gap=0.05)
+            await waiter
+        error = time.monotonic() - source.last_key_press_time - interval
+        print(f'interval {interval:.1f}s: switched back {error * 1000:.1f} ms after deadline')
+        await asyncio.sleep(0.5)
+
+    # 3. 按需采样：只有等待切回期间才在采样
+    elapsed = time.monotonic() - started
+    print(f'sampling active {scheduler.active_seconds:.2f}s of {elapsed:.2f}s wall time: {scheduler.stats()}')
+    print(f'switch-back error (ms): {histogram("switch_back_error_ms").summary()}')
+
+
+if __name__ == '__main__':
+    asyncio.run(_benchmark())
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""
+平台后端：程序用到的全部窗口 / 键盘布局 / IME / 热键 / 按键状态调用。
+
+- Win32Backend: 真实的 user32 / imm32 调用（函数原型和缓冲区见 win32 模块）
+- SimulatedBackend: 确定性的内存模拟（窗口、线程、布局、IME 状态、可配置的调用延迟），
+  用于在 Linux 上做性能分析、压力测试和基准测试
+
+其余模块通过 get_backend() 获取当前后端，set_backend() 用于替换。
+"""
+
+import ctypes
+import ctypes.wintypes
+import random
+import time
+
+from ime_switcher import win32
+from ime_switcher.win32 import LASTINPUTINFO
+
+WM_INPUTLANGCHANGEREQUEST = 0x0050
+WM_IME_CONTROL = 0x0283
+IMC_GETCONVERSIONMODE = 0x0001
+IMC_SETCONVERSIONMODE = 0x0002
+IMC_GETOPENSTATUS = 0x0005
+IMC_SETOPENSTATUS = 0x0006
+GA_ROOTOWNER = 3
+SMTO_ABORTIFHUNG = 0x0002
+KLF_SUBSTITUTE_OK = 0x00000002
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+
+
+class Backend:
+    """平台后端的基类"""
+    name = 'base'
+
+    def get_foreground_window(self):
+        raise NotImplementedError
+
+    def get_root_owner(self, hwnd):
+        raise NotImplementedError
+
+    def get_window_thread_id(self, hwnd):
+        raise NotImplementedError
+
+    def get_window_title(self, hwnd):
+        raise NotImplementedError
+
+    def get_window_class(self, hwnd):
+        raise NotImplementedError
+
+    def get_process_name(self, hwnd):
+        """返回窗口所属进程的可执行文件名（小写，例如 'code.exe'），无法获取时返回空字符串"""
+        raise NotImplementedError
+
+    def get_keyboard_layout(self, thread_id):
+        """返回线程当前的 HKL"""
+        raise NotImplementedError
+
+    def load_keyboard_layout(self, layout_id):
+        """加载布局（不激活），返回 HKL"""
+        raise NotImplementedError
+
+    def get_keyboard_layout_list(self):
+        """返回系统当前已加载的 HKL 元组"""
+        raise NotImplementedError
+
+    def get_default_ime_window(self, hwnd):
+        raise NotImplementedError
+
+    def send_ime_control(self, hime, command, value=0, timeout_ms=200):
+        """发送 WM_IME_CONTROL，超时或窗口挂起时抛出 TimeoutError"""
+        raise NotImplementedError
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        raise NotImplementedError
+
+    def get_async_key_state(self, vk):
+        raise NotImplementedError
+
+    def get_idle_time(self):
+        """距离最后一次用户输入（键盘/鼠标，整个会话）的秒数"""
+        raise NotImplementedError
+
+    def register_hotkey(self, hwnd, id, modifiers, vk):
+        """必须在 hwnd 所属的线程上调用"""
+        raise NotImplementedError
+
+    def unregister_hotkey(self, hwnd, id):
+        raise NotImplementedError
+
+
+class Win32Backend(Backend):
+    """
+    真实的 Win32 调用，函数原型来自 win32 模块；api 可替换为 win32.FakeWin32Api 以在非 Windows 平台上测量本类的开销。
+    输出缓冲区是线程局部的（IME 查询在线程池中运行），不在每次调用时分配。
+    """
+    name = 'win32'
+
+    def __init__(self, api=None):
+        self._api = api or win32.api()
+        self._last_input = LASTINPUTINFO(ctypes.sizeof(LASTINPUTINFO))
+
+    def get_foreground_window(self):
+        return self._api.GetForegroundWindow() or 0
+
+    def get_root_owner(self, hwnd):
+        return self._api.GetAncestor(hwnd, GA_ROOTOWNER) or 0
+
+    def get_window_thread_id(self, hwnd):
+        return self._api.GetWindowThreadProcessId(hwnd, None)
+
+    def get_window_title(self, hwnd):
+        buf = win32.text_buffer()
+        length = self._api.GetWindowTextW(hwnd, buf, len(buf))
+        if length >= len(buf) - 1:
+            # 可能被截断：按实际长度放大后重取（很少见）
+            buf = win32.text_buffer(self._api.GetWindowTextLengthW(hwnd) + 1)
+            length = self._api.GetWindowTextW(hwnd, buf, len(buf))
+        return buf.value if length > 0 else ""
+
+    def get_window_class(self, hwnd):
+        # 类名最长 256 个字符
+        buf = win32.text_buffer(257)
+        self._api.GetClassNameW(hwnd, buf, len(buf))
+        return buf.value
+
+    def get_process_name(self, hwnd):
+        dword = win32.out_dword()
+        self._api.GetWindowThreadProcessId(hwnd, ctypes.byref(dword))
+        process = self._api.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, dword.value)
+        if not process:
+            return ''
+        try:
+            buf = win32.text_buffer(1024)
+            dword.value = len(buf)
+            if not self._api.QueryFullProcessImageNameW(process, 0, buf, ctypes.byref(dword)):
+                return ''
+            return buf.value.rsplit('\\', 1)[-1].lower()
+        finally:
+            self._api.CloseHandle(process)
+
+    def get_keyboard_layout(self, thread_id):
+        return self._api.GetKeyboardLayout(thread_id) or 0
+
+    def load_keyboard_layout(self, layout_id):
+        # 不带 KLF_ACTIVATE：只加载，不改变本线程的输入语言
+        hkl = self._api.LoadKeyboardLayoutW(layout_id, KLF_SUBSTITUTE_OK)
+        if not hkl:
+            raise self._api.error()
+        return hkl
+
+    def get_keyboard_layout_list(self):
+        count = self._api.GetKeyboardLayoutList(0, None)
+        buffer = (ctypes.wintypes.HKL * count)()
+        count = self._api.GetKeyboardLayoutList(count, buffer)
+        return tuple(hkl or 0 for hkl in buffer[:count])
+
+    def get_default_ime_window(self, hwnd):
+        return self._api.ImmGetDefaultIMEWnd(hwnd) or 0
+
+    def send_ime_control(self, hime, command, value=0, timeout_ms=200):
+        result = win32.out_size_t()
+        if not self._api.SendMessageTimeoutW(hime, WM_IME_CONTROL, command, value,
+                                             SMTO_ABORTIFHUNG, timeout_ms, ctypes.byref(result)):
+            raise TimeoutError(f"IME window 0x{hime or 0:x} did not respond (error {self._api.last_error()})")
+        return result.value
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        if not self._api.PostMessageW(hwnd, message, wparam, lparam):
+            raise self._api.error()
+
+    def get_async_key_state(self, vk):
+        return self._api.GetAsyncKeyState(vk)
+
+    def get_idle_time(self):
+        if not self._api.GetLastInputInfo(ctypes.byref(self._last_input)):
+            return 0.0
+        # 两者都是 32 位毫秒计数，约 49.7 天回绕一次
+        return ((self._api.GetTickCount() - self._last_input.dwTime) & 0xFFFFFFFF) / 1000
+
+    def register_hotkey(self, hwnd, id, modifiers, vk):
+        return bool(self._api.RegisterHotKey(hwnd, id, modifiers, vk))
+
+    def unregister_hotkey(self, hwnd, id):
+        return bool(self._api.UnregisterHotKey(hwnd, id))
+
+
+class SimulatedWindow:
+    def __init__(self, hwnd, thread_id, title='', hime=0, root_owner=None, class_name='', process_name=''):
+        self.hwnd = hwnd
+        self.thread_id = thread_id
+        self.title = title
+        self.hime = hime
+        self.root_owner = hwnd if root_owner is None else root_owner
+        self.class_name = class_name
+        self.process_name = process_name
+
+
+class SimulatedBackend(Backend):
+    """
+    确定性的内存模拟。
+
+    - add_window() 创建窗口，同一线程的窗口共享键盘布局和 IME 状态
+    - latencies: {方法名: 秒}，调用时 sleep 相应时间，模拟 Win32 调用开销
+    - hang(hwnd) 使窗口的 IME 查询超时
+    - calls: 每个方法的调用次数
+    - layout_delay: WM_INPUTLANGCHANGEREQUEST 经过多少秒才生效（目标线程处理消息的延迟）
+    - press() / touch_input() 更新最后一次输入的时间（get_idle_time）
+    - drop_rate: 布局切换请求和 IMC_SET* 被目标程序静默丢弃的比例（繁忙、UIPI 拦截等），dropped 为丢弃次数
+    """
+    name = 'simulated'
+
+    def __init__(self, layouts=('00000409', '00000804'), latencies=None, sleep=time.sleep, layout_delay=0.0,
+                 clock=time.monotonic, drop_rate=0.0, seed=0):
+        self.latencies = dict(latencies or {})
+        self.layout_delay = layout_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = {}
+        self.windows = {}
+        self.foreground = 0
+        self.layout_ids = list(layouts)
+        # thread_id -> HKL
+        self.thread_layouts = {}
+        # hime -> [open, conversion_mode]
+        self.ime_states = {}
+        self.hung = set()
+        self.hotkeys = {}
+        self.pressed = set()
+        self.posted = []
+        # [(生效时间, thread_id, HKL)]
+        self._pending_layouts = []
+        self._next_handle = 0x10000
+        self.last_input = clock()
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self._rng = random.Random(seed)
+
+    # --- 模拟世界的操作 ---
+
+    def add_window(self, title='', thread_id=None, layout_id='00000409', ime=True, class_name='', process_name=''):
+        hwnd = self._new_handle()
+        if thread_id is None:
+            thread_id = hwnd
+        hime = 0
+        if ime:
+            hime = next((w.hime for w in self.windows.values() if w.thread_id == thread_id and w.hime), 0)
+            if not hime:
+                hime = self._new_handle()
+                self.ime_states[hime] = [0, 0]
+        self.windows[hwnd] = SimulatedWindow(hwnd, thread_id, title, hime,
+                                             class_name=class_name, process_name=process_name.lower())
+        self.thread_layouts.setdefault(thread_id, self.hkl(layout_id))
+        if not self.foreground:
+            self.foreground = hwnd
+        return hwnd
+
+    def focus(self, hwnd):
+        self.foreground = hwnd
+
+    def hang(self, hwnd, hung=True):
+        (self.hung.add if hung else self.hung.discard)(self.windows[hwnd].hime)
+
+    def press(self, vk):
+        self.pressed.add(vk)
+        self.touch_input()
+
+    def touch_input(self):
+        self.last_input = self.clock()
+
+    def set_ime_state(self, hwnd, open_status, conversion_mode):
+        self.ime_states[self.windows[hwnd].hime] = [open_status, conversion_mode]
+
+    @staticmethod
+    def hkl(layout_id):
+        """HKL 由布局 ID 推导：'00000804' -> 0x08040804"""
+        lang_id = int(layout_id, 16) & 0xFFFF
+        return (lang_id << 16) | lang_id
+
+    # --- Backend 接口 ---
+
+    def get_foreground_window(self):
+        self._call('get_foreground_window')
+        return self.foreground
+
+    def get_root_owner(self, hwnd):
+        self._call('get_root_owner')
+        window = self.windows.get(hwnd)
+        return window.root_owner if window else 0
+
+    def get_window_thread_id(self, hwnd):
+        self._call('get_window_thread_id')
+        window = self.windows.get(hwnd)
+        return window.thread_id if window else 0
+
+    def get_window_title(self, hwnd):
+        self._call('get_window_title')
+        window = self.windows.get(hwnd)
+        return window.title if window else ""
+
+    def get_window_class(self, hwnd):
+        self._call('get_window_class')
+        window = self.windows.get(hwnd)
+        return window.class_name if window else ""
+
+    def get_process_name(self, hwnd):
+        self._call('get_process_name')
+        window = self.windows.get(hwnd)
+        return window.process_name if window else ""
+
+    def get_keyboard_layout(self, thread_id):
+        self._call('get_keyboard_layout')
+        if self._pending_layouts:
+            now = self.clock()
+            while self._pending_layouts and self._pending_layouts[0][0] <= now:
+                _, pending_thread, hkl = self._pending_layouts.pop(0)
+                self.thread_layouts[pending_thread] = hkl
+        return self.thread_layouts.get(thread_id, 0)
+
+    def load_keyboard_layout(self, layout_id):
+        self._call('load_keyboard_layout')
+        if layout_id not in self.layout_ids:
+            self.layout_ids.append(layout_id)
+        return self.hkl(layout_id)
+
+    def get_keyboard_layout_list(self):
+        self._call('get_keyboard_layout_list')
+        return tuple(self.hkl(layout_id) for layout_id in self.layout_ids)
+
+    def get_default_ime_window(self, hwnd):
+        self._call('get_default_ime_window')
+        window = self.windows.get(hwnd)
+        return window.hime if window else 0
+
+    def send_ime_control(self, hime, command, value=0, timeout_ms=200):
+        self._call('send_ime_control')
+        if hime in self.hung:
+            self.sleep(timeout_ms / 1000)
+            raise TimeoutError(f"IME window 0x{hime:x} did not respond")
+        state = self.ime_states.get(hime)
+        if state is None:
+            return 0
+        if command == IMC_GETOPENSTATUS:
+            return state[0]
+        if command == IMC_GETCONVERSIONMODE:
+            return state[1]
+        if command in (IMC_SETOPENSTATUS, IMC_SETCONVERSIONMODE) and self._drop():
+            return 0
+        if command == IMC_SETOPENSTATUS:
+            state[0] = value
+        elif command == IMC_SETCONVERSIONMODE:
+            state[1] = value
+        return 0
+
+    def post_message(self, hwnd, message, wparam, lparam):
+        self._call('post_message')
+        self.posted.append((hwnd, message, wparam, lparam))
+        window = self.windows.get(hwnd)
+        if window is not None and message == WM_INPUTLANGCHANGEREQUEST and not self._drop():
+            if self.layout_delay:
+                self._pending_layouts.append((self.clock() + self.layout_delay, window.thread_id, lparam))
+            else:
+                self.thread_layouts[window.thread_id] = lparam
+
+    def get_async_key_state(self, vk):
+        self._call('get_async_key_state')
+        if vk in self.pressed:
+            self.pressed.discard(vk)
+            return 0x0001
+        return 0
+
+    def get_idle_time(self):
+        self._call('get_idle_time')
+        return max(0.0, self.clock() - self.last_input)
+
+    def register_hotkey(self, hwnd, id, modifiers, vk):
+        self._call('register_hotkey')
+        if (modifiers, vk) in self.hotkeys.values():
+            return False
+        self.hotkeys[id] = (modifiers, vk)
+        return True
+
+    def unregister_hotkey(self, hwnd, id):
+        self._call('unregister_hotkey')
+        return self.hotkeys.pop(id, None) is not None
+
+    def _drop(self):
+        if self.drop_rate and self._rng.random() < self.drop_rate:
+            self.dropped += 1
+            return True
+        return False
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        latency = self.latencies.get(name)
+        if latency:
+            self.sleep(latency)
+
+    def _new_handle(self):
+        self._next_handle += 0x10
+        return self._next_handle
+
+
+_backends = {
+    Win32Backend.name: Win32Backend,
+    SimulatedBackend.name: SimulatedBackend,
+}
+
+_current = None
+
+
+def create_backend(kind='win32', **kwargs):
+    if kind not in _backends:
+        raise ValueError(f'Unknown backend: {kind}')
+    return _backends[kind](**kwargs)
+
+
+def get_backend():
+    """返回当前后端，首次调用时创建 Win32Backend"""
+    global _current
+    if _current is None:
+        _current = Win32Backend()
+    return _current
+
+
+def set_backend(backend):
+    global _current
+    _current = backend
+    return backend
+
+
+def _benchmark(rounds=2000):
+    """在模拟后端上测量各热路径的耗时和每次操作的后端调用次数"""
+    from ime_switcher import ime_status_detector as detector
+    from ime_switcher.layouts import KeyboardLayoutRegistry, PlatformLayoutBackend
+    from ime_switcher.metrics import Histogram
+
+    # 每个 Win32 调用模拟 20us 开销
+    latency = 20e-6
+    backend = set_backend(SimulatedBackend(latencies={name: latency for name in (
+        'get_foreground_window', 'get_root_owner', 'get_window_thread_id', 'get_keyboard_layout',
+        'get_default_ime_window', 'send_ime_control', 'post_message', 'load_keyboard_layout',
+    )}))
+    windows = [backend.add_window(f'window {i}', layout_id='00000804') for i in range(8)]
+    registry = KeyboardLayoutRegistry(PlatformLayoutBackend(backend), ('00000409', '00000804'))
+    registry.preload()
+
+    def toggle():
+        hwnd = backend.get_root_owner(backend.get_foreground_window())
+        lang_id = backend.get_keyboard_layout(backend.get_window_thread_id(hwnd)) & 0xFFFF
+        layout_id = '00000409' if lang_id == 0x0804 else '00000804'
+        backend.post_message(hwnd, WM_INPUTLANGCHANGEREQUEST, 0, registry.get(layout_id))
+
+    def force_cn():
+        backend.set_ime_state(backend.foreground, 1, 0)
+        status = detector.get_ime_status(fields=detector.ALL | detector.PINYIN_ONLY)
+        if status.is_pinyin and not status.is_chinese:
+            detector.switch_to_chinese_mode(status.hwnd)
+
+    for name, operation in (('get_ime_status', detector.get_ime_status), ('toggle', toggle), ('force_cn', force_cn)):
+        backend.calls.clear()
+        histogram = Histogram(name)
+        for i in range(rounds):
+            backend.focus(windows[i % len(windows)])
+            start = time.perf_counter()
+            operation()
+            histogram.add((time.perf_counter() - start) * 1000)
+        calls = {api: round(count / rounds, 2) for api, count in sorted(backend.calls.items())}
+        print(f'{name:15} (ms): {histogram.summary()}')
+        print(f'{"":15} calls/op: {calls}')
+    print(f'window info cache: {detector.window_info_cache.stats()}')
+
+
+if __name__ == '__main__':
+    # 以包内模块运行，使 set_backend() 对其他模块生效
+    from ime_switcher.backend import _benchmark
+    _benchmark()
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+切换引擎基准测试：在模拟后端上回放按键 / 焦点 / 热键轨迹。
+
+场景：
+- toggle_storm: 连续数千次切换，吞吐量和每次切换的后端调用数
+- bursty_typing: 临时切换 + 突发输入，切回误差百分位（hook 与 polling 两种活动来源）
+- window_switching: 快速切换窗口时的强制中文反应延迟（event 与 polling 两种触发方式）
+- idle: 空闲时的 CPU 时间，换算为每空闲小时的 CPU 秒数
+
+轨迹为 [[t, kind, arg], ...]，t 为距开始的秒数，kind 为 key / focus / hotkey。
+可用 --trace 传入录制的轨迹文件，否则使用固定种子生成的合成轨迹。
+
+    python -m ime_switcher.bench --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+
+from ime_switcher import force_cn, ime_status_detector
+from ime_switcher.actions import HotkeyActions
+from ime_switcher.activity import ActivityScheduler, FakeActivitySource, PollingActivitySource
+from ime_switcher.backend import SimulatedBackend, set_backend
+from ime_switcher.focus_events import FOREGROUND, TraceEventSource
+from ime_switcher.ime_query import ImeQueryExecutor
+from ime_switcher.layouts import KeyboardLayoutRegistry, PlatformLayoutBackend
+from ime_switcher.metrics import Histogram, histogram
+from ime_switcher.switcher import ENGLISH_KEYBOARD_ID, Switcher
+
+KEY = 'key'
+FOCUS = 'focus'
+HOTKEY = 'hotkey'
+
+# 避开中文的 2s 最短切回时间，让基准测试的时长可控
+SECONDARY_KEYBOARD_ID = '00000411'
+PINYIN_KEYBOARD_ID = '00000804'
+VK_A = 0x41
+
+
+# --- 轨迹 ---
+
+def load_trace(path):
+    with open(path, encoding='utf-8') as f:
+        return [tuple(event) for event in json.load(f)]
+
+
+def save_trace(trace, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([list(event) for event in trace], f)
+
+
+def bursty_typing_trace(sessions=8, seed=1):
+    """每轮：热键临时切换，随后一段突发输入，再停顿"""
+    rng = random.Random(seed)
+    trace, t = [], 0.0
+    for _ in range(sessions):
+        trace.append((t, HOTKEY, 'temp_toggle'))
+        t += 0.3
+        for _ in range(rng.randint(3, 15)):
+            trace.append((t, KEY, VK_A))
+            t += rng.uniform(0.02, 0.15)
+        t += 0.6
+    return trace
+
+
+def window_switching_trace(switches=40, windows=10, seed=2):
+    rng = random.Random(seed)
+    trace, t = [], 0.0
+    for _ in range(switches):
+        t += rng.uniform(0.02, 0.3)
+        trace.append((t, FOCUS, rng.randrange(windows)))
+    return trace
+
+
+async def replay(trace, handler):
+    """按轨迹时间依次调用 handler(kind, arg)"""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for t, kind, arg in trace:
+        delay = start + t - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        handler(kind, arg)
+
+
+# --- 模拟环境 ---
+
+class World:
+    """模拟后端 + 切换引擎，窗口 0..n-1 使用微软拼音"""
+
+    def __init__(self, windows=10, secondary_keyboard_id=SECONDARY_KEYBOARD_ID, latency=0.0):
+        self.backend = set_backend(SimulatedBackend(
+            layouts=(ENGLISH_KEYBOARD_ID, secondary_keyboard_id, PINYIN_KEYBOARD_ID),
+            latencies={name: latency for name in (
+                'get_foreground_window', 'get_root_owner', 'get_window_thread_id', 'get_keyboard_layout',
+                'get_default_ime_window', 'send_ime_control', 'post_message', 'get_async_key_state',
+            )},
+        ))
+        self.windows = [self.backend.add_window(f'window {i}', layout_id=PINYIN_KEYBOARD_ID) for i in range(windows)]
+        ime_status_detector.window_info_cache.invalidate()
+        self.layout_registry = KeyboardLayoutRegistry(
+            PlatformLayoutBackend(self.backend), (ENGLISH_KEYBOARD_ID, secondary_keyboard_id))
+        self.layout_registry.preload()
+        self.switcher = Switcher(secondary_keyboard_id, self.layout_registry,
+                                 ime_status_detector.window_info_cache, self.backend)
+
+    def focus(self, index):
+        """切到窗口并把它的拼音置为英文模式，等待强制中文"""
+        hwnd = self.windows[index % len(self.windows)]
+        self.backend.focus(hwnd)
+        self.backend.set_ime_state(hwnd, 1, 0)
+        ime_status_detector.window_info_cache.invalidate(hwnd)
+        return hwnd
+
+    def backend_calls(self):
+        return sum(self.backend.calls.values())
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 3) if seconds else None
+
+
+# --- 场景 ---
+
+def toggle_storm(toggles=5000, windows=10):
+    world = World(windows)
+    world.backend.calls.clear()
+    latency = Histogram('toggle_ms')
+    start = time.perf_counter()
+    for i in range(toggles):
+        world.backend.focus(world.windows[i % windows])
+        t = time.perf_counter()
+        world.switcher.toggle()
+        latency.add((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        'toggles': toggles,
+        'toggles_per_second': _rate(toggles, elapsed),
+        'latency_ms': latency.summary(),
+        'backend_calls_per_toggle': _rate(world.backend_calls(), toggles),
+    }
+
+
+async def bursty_typing(trace, activity_source):
+    world = World()
+    loop = asyncio.get_running_loop()
+    scheduler = ActivityScheduler(loop, activity_source)
+    actions = HotkeyActions(loop, world.switcher, scheduler)
+    switch_back_error = histogram('switch_back_error_ms')
+    switch_back_error.reset()
+    world.backend.calls.clear()
+
+    def on_event(kind, arg):
+        if kind == HOTKEY:
+            actions.press(arg, interval=0.3)
+        elif kind == KEY:
+            # 钩子推送按键；轮询来源从模拟后端的 GetAsyncKeyState 读取
+            if isinstance(scheduler.source, FakeActivitySource) and scheduler.is_armed:
+                scheduler.source.press(arg)
+            world.backend.press(arg)
+        elif kind == FOCUS:
+            world.focus(arg)
+
+    start = time.perf_counter()
+    cpu = time.process_time()
+    await replay(trace, on_event)
+    while actions.is_temp_toggling:
+        await asyncio.sleep(0.05)
+    events = len(trace)
+    return {
+        'activity_source': activity_source,
+        'events': events,
+        'switches': world.switcher.switch_count,
+        'switch_back_error_ms': switch_back_error.summary(),
+        'backend_calls_per_event': _rate(world.backend_calls(), events),
+        'cpu_seconds': round(time.process_time() - cpu, 4),
+        'wall_seconds': round(time.perf_counter() - start, 3),
+        'sampling': scheduler.stats(),
+    }
+
+
+async def window_switching(trace, mode):
+    world = World()
+    source = TraceEventSource()
+    source.start(asyncio.get_running_loop())
+    executor = ImeQueryExecutor(world.backend.get_foreground_window, ime_status_detector.get_ime_status,
+                                ime_status_detector.switch_to_chinese_mode)
+    fields = ime_status_detector.ALL | ime_status_detector.PINYIN_ONLY
+    monitor = force_cn.ForceCnMonitor(lambda: executor.get_status(None, fields), executor.switch, lambda hwnd: '',
+                                      mode=mode, event_source=source)
+    reaction = Histogram('reaction_ms')
+    pending = {}
+
+    def on_event(kind, arg):
+        if kind == FOCUS:
+            pending[world.focus(arg)] = time.monotonic()
+            source.notify(FOREGROUND, world.backend.foreground)
+
+    def on_switched(hwnd, ok):
+        started = pending.pop(hwnd, None)
+        if ok and started is not None:
+            reaction.add((time.monotonic() - started) * 1000)
+
+    switch = executor.switch
+
+    async def timed_switch(hwnd):
+        ok = await switch(hwnd)
+        on_switched(hwnd, ok)
+        return ok
+
+    monitor.switch = timed_switch
+    world.backend.calls.clear()
+    task = asyncio.create_task(monitor.run())
+    await replay(trace, on_event)
+    await asyncio.sleep(0.5)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    executor.shutdown()
+    events = len(trace)
+    return {
+        'mode': mode,
+        'events': events,
+        'reaction_ms': reaction.summary(),
+        'missed': len(pending),
+        'status_checks': monitor.check_count,
+        'backend_calls_per_event': _rate(world.backend_calls(), events),
+    }
+
+
+async def idle(seconds, mode, activity_source):
+    """没有任何输入时运行 seconds 秒，换算为每空闲小时的 CPU 秒数"""
+    world = World()
+    loop = asyncio.get_running_loop()
+    source = TraceEventSource()
+    source.start(loop)
+    executor = ImeQueryExecutor(world.backend.get_foreground_window, ime_status_detector.get_ime_status,
+                                ime_status_detector.switch_to_chinese_mode)
+    fields = ime_status_detector.ALL | ime_status_detector.PINYIN_ONLY
+    monitor = force_cn.ForceCnMonitor(lambda: executor.get_status(None, fields), executor.switch, lambda hwnd: '',
+                                      mode=mode, event_source=source)
+    scheduler = ActivityScheduler(loop, activity_source)
+    # 旧版本一直在轮询按键；按需采样时空闲期间不启动
+    if activity_source == PollingActivitySource.name:
+        scheduler.arm()
+    world.backend.calls.clear()
+    task = asyncio.create_task(monitor.run())
+    cpu = time.process_time()
+    await asyncio.sleep(seconds)
+    cpu = time.process_time() - cpu
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    scheduler.disarm()
+    executor.shutdown()
+    return {
+        'force_cn_trigger': mode,
+        'activity_source': activity_source,
+        'cpu_seconds_per_idle_hour': round(cpu * 3600 / seconds, 3),
+        'backend_calls_per_idle_second': _rate(world.backend_calls(), seconds),
+    }
+
+
+async def run(quick=False, trace=None):
+    typing_trace = trace or bursty_typing_trace(sessions=4 if quick else 8)
+    switching_trace = trace or window_switching_trace(switches=20 if quick else 40)
+    idle_seconds = 1.0 if quick else 3.0
+    return {
+        'environment': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'quick': quick,
+        },
+        'toggle_storm': toggle_storm(1000 if quick else 5000),
+        'bursty_typing': [await bursty_typing(typing_trace, kind) for kind in
+                          (FakeActivitySource.name, PollingActivitySource.name)],
+        'window_switching': [await window_switching(switching_trace, mode) for mode in
+                             (force_cn.EVENT, force_cn.POLLING)],
+        'idle': [
+            await idle(idle_seconds, force_cn.EVENT, FakeActivitySource.name),
+            await idle(idle_seconds, force_cn.POLLING, PollingActivitySource.name),
+        ],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IME Switcher benchmark suite (simulated backend)')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--trace', help='replay a recorded [[t, kind, arg], ...] trace instead of synthetic ones')
+    parser.add_argument('--quick', action='store_true', help='shorter runs')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.ERROR)
+    trace = load_trace(args.trace) if args.trace else None
+    results = asyncio.run(run(args.quick, trace))
+    text = json.dumps(results, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+命令总线：把其他线程（托盘菜单）发起的操作交给事件循环执行。
+
+托盘回调运行在 infi.systray 的线程上，直接修改 config、创建任务或查询 IME 会与
+事件循环上的监视器竞争，查询挂起的窗口还会卡住托盘。通过 CommandBus 提交后，
+命令在事件循环上按提交顺序逐个执行，协程命令有超时，调用方可以不等待（菜单）
+或带超时等待结果。
+"""
+
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger('ime_switcher')
+
+
+class CommandBus:
+    """
+    Args:
+        loop: 执行命令的事件循环
+        timeout: 协程命令的最长执行时间（秒），也是 call() 的默认等待时间
+    """
+
+    def __init__(self, loop, timeout=2.0):
+        self.loop = loop
+        self.timeout = timeout
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self._handlers = {}
+        self._lock = None
+
+    def register(self, name, handler):
+        """handler(*args) 为普通函数或协程函数，在事件循环线程上调用"""
+        self._handlers[name] = handler
+
+    def submit(self, name, *args):
+        """可从任意线程调用，返回 concurrent.futures.Future"""
+        if name not in self._handlers:
+            raise KeyError(f'Unknown command: {name}')
+        return asyncio.run_coroutine_threadsafe(self._run(name, args), self.loop)
+
+    def call(self, name, *args, timeout=None):
+        """提交并等待结果，超时抛出 TimeoutError；不能在事件循环线程上调用"""
+        if self._on_loop_thread():
+            raise RuntimeError('CommandBus.call() would block the event loop')
+        return self.submit(name, *args).result(self.timeout if timeout is None else timeout)
+
+    def menu_action(self, name):
+        """infi.systray 的菜单回调：只提交，不等待，错误已在事件循环上记录"""
+        def action(_):
+            try:
+                self.submit(name)
+            except RuntimeError:
+                # 事件循环已关闭（正在退出）
+                pass
+        return action
+
+    def stats(self):
+        return {'completed': self.completed, 'failed': self.failed, 'timeouts': self.timeouts}
+
+    async def _run(self, name, args):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            try:
+                result = self._handlers[name](*args)
+                if asyncio.iscoroutine(result):
+                    result = await asyncio.wait_for(result, self.timeout)
+            except (asyncio.TimeoutError, TimeoutError):
+                self.timeouts += 1
+                logger.warning(f'Command {name} timed out after {self.timeout}s')
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f'Command {name} failed: {e}')
+                raise
+            self.completed += 1
+            return result
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+
+def _stress(threads=32, per_thread=500):
+    """
+    多个线程同时提交“读-让出-写”的计数命令：直接在各线程中修改共享状态会丢失更新，
+    经过命令总线则不会；同时验证挂起的命令超时后事件循环和总线仍然可用。
+    """
+    import time
+
+    from ime_switcher.metrics import Histogram
+
+    state = {'direct': 0, 'bus': 0}
+
+    def direct():
+        for _ in range(per_thread):
+            value = state['direct']
+            time.sleep(0)
+            state['direct'] = value + 1
+
+    workers = [threading.Thread(target=direct) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    bus = CommandBus(loop, timeout=0.2)
+
+    async def increment():
+        value = state['bus']
+        await asyncio.sleep(0)
+        state['bus'] = value + 1
+        return value
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    bus.register('increment', increment)
+    bus.register('hang', hang)
+    latency = Histogram('command_ms')
+    errors = []
+
+    def submit():
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            try:
+                bus.call('increment')
+            except Exception as e:
+                errors.append(e)
+            latency.add((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=submit) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    counted = state['bus']
+
+    try:
+        bus.call('hang', timeout=1.0)
+        hang_result = 'returned'
+    except TimeoutError:
+        hang_result = 'timed out'
+    after_hang = bus.call('increment')
+
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()
+    total = threads * per_thread
+    print(f'direct from {threads} threads: {total - state["direct"]} of {total} updates lost')
+    print(f'command bus:  {total - counted} of {total} updates lost, {len(errors)} errors, '
+          f'{total / elapsed:,.0f} commands/s')
+    print(f'command round trip (ms): {latency.summary()}')
+    print(f'hung command {hang_result}, bus still serving (counter {after_hang}), {bus.stats()}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    _stress()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+切换确认：发出切换后确认目标布局 / 中英文模式确实生效，未生效时有限次重试。
+
+WM_INPUTLANGCHANGEREQUEST 只是 PostMessage，IMC_SETCONVERSIONMODE 的 SendMessage 也不报告
+输入法是否接受，目标程序繁忙或被 UIPI 拦截时切换会静默丢失。SwitchVerifier 在发出后按
+probe_delays 的时间表重新探测（收到 IME 变化事件时提前探测），仍未生效则重新发出，
+最多 attempts 次；连续失败的窗口由熔断器暂时跳过，不再反复发出。
+按应用统计成功率，确认延迟记入 switch_confirm_ms 直方图。
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+
+from ime_switcher.focus_events import IME_CHANGE
+from ime_switcher.ime_query import CircuitBreaker
+from ime_switcher.metrics import histogram
+
+logger = logging.getLogger('ime_switcher')
+
+
+async def _call(func):
+    result = func()
+    if asyncio.iscoroutine(result):
+        result = await result
+    return result
+
+
+class AppSwitchStats:
+    __slots__ = ('switches', 'confirmed', 'attempts')
+
+    def __init__(self):
+        self.switches = 0
+        self.confirmed = 0
+        self.attempts = 0
+
+    def summary(self):
+        return {
+            'switches': self.switches,
+            'success_rate': round(self.confirmed / self.switches, 3),
+            'attempts_per_switch': round(self.attempts / self.switches, 2),
+        }
+
+
+class SwitchVerifier:
+    """
+    Args:
+        attempts: 每次切换最多发出几次（含第一次）
+        probe_delays: 每次发出后重新探测的时间点（秒，相对发出时间），最后一个之后仍未生效则重试
+        backoff: 每次重试时 probe_delays 放大的倍数
+        get_app: get_app(hwnd) 返回应用名（进程名），用于按应用统计
+        breaker: 连续确认失败的窗口暂时跳过，默认连续 2 次后退避 5 秒起
+        max_apps: 按应用统计的最大条目数
+    """
+
+    def __init__(self, attempts=3, probe_delays=(0.02, 0.06, 0.15), backoff=2.0, get_app=None, breaker=None,
+                 max_apps=64):
+        self.attempts = attempts
+        self.probe_delays = tuple(probe_delays)
+        self.backoff = backoff
+        self.get_app = get_app
+        self.breaker = breaker or CircuitBreaker(base_backoff=5.0, max_backoff=120.0, reason='ignored the switch')
+        self.max_apps = max_apps
+        self.confirm_latency = histogram('switch_confirm_ms')
+        self.confirmed = 0
+        self.failed = 0
+        self.retries = 0
+        self.probes = 0
+        self.superseded = 0
+        self.skipped = 0
+        self._apps = OrderedDict()
+        # 等待下次探测的事件，IME 变化时全部唤醒
+        self._waiters = set()
+        # hwnd -> 后台确认任务
+        self._pending = {}
+
+    def allow(self, hwnd):
+        """窗口最近多次拒绝切换时返回 False，调用方应暂时不再切换"""
+        if self.breaker.allow(hwnd):
+            return True
+        self.skipped += 1
+        return False
+
+    async def run(self, hwnd, apply, confirm, label='switch', applied=False, probe_delays=None):
+        """
+        发出切换并确认，返回是否生效。
+
+        apply(): 发出切换，普通函数或协程函数，返回 False 表示发出失败（同样会重试）
+        confirm(): 重新探测，返回目标状态是否已生效；抛出 TimeoutError 视为未生效
+        applied: 第一次已由调用方同步发出（热键路径），只需确认
+        probe_delays: 覆盖默认的探测时间表，例如同步生效的 IMC_SETCONVERSIONMODE 不需要等
+        """
+        start = time.monotonic()
+        attempt = 0
+        scale = 1.0
+        try:
+            while attempt < self.attempts:
+                attempt += 1
+                if attempt > 1:
+                    self.retries += 1
+                    logger.info(f'{label} on window 0x{hwnd or 0:x} not confirmed, retry {attempt - 1}')
+                if (attempt == 1 and applied) or await _call(apply) is not False:
+                    if await self._probe(confirm, probe_delays or self.probe_delays, scale):
+                        self._record(hwnd, True, attempt)
+                        self.confirm_latency.add((time.monotonic() - start) * 1000)
+                        return True
+                scale *= self.backoff
+        except asyncio.CancelledError:
+            # 同一窗口有了新的切换，本次结果已无意义
+            self.superseded += 1
+            raise
+        self._record(hwnd, False, attempt)
+        logger.warning(f'{label} on window 0x{hwnd or 0:x} not confirmed after {attempt} attempts')
+        return False
+
+    def submit(self, hwnd, coro):
+        """
+        在后台运行确认协程，同一窗口的上一个确认任务被取消（已被新的切换取代）。
+        没有运行中的事件循环时（同步调用）不确认。
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            coro.close()
+            return None
+        previous = self._pending.get(hwnd)
+        if previous is not None and not previous.done():
+            previous.cancel()
+        task = loop.create_task(coro)
+        self._pending[hwnd] = task
+        task.add_done_callback(functools.partial(self._forget, hwnd))
+        return task
+
+    def on_event(self, event, hwnd, timestamp):
+        """FocusEventSource 的监听器：IME 变化事件的 hwnd 是 IME 窗口，无法对应，唤醒全部等待"""
+        if event != IME_CHANGE:
+            return
+        for waiter in self._waiters:
+            waiter.set()
+
+    def stats(self):
+        return {
+            'confirmed': self.confirmed,
+            'failed': self.failed,
+            'retries': self.retries,
+            'probes': self.probes,
+            'superseded': self.superseded,
+            'skipped': self.skipped,
+        }
+
+    def app_stats(self, limit=10):
+        """切换次数最多的 limit 个应用"""
+        apps = sorted(self._apps.items(), key=lambda item: item[1].switches, reverse=True)[:limit]
+        return {app: stats.summary() for app, stats in apps}
+
+    async def _probe(self, confirm, probe_delays, scale):
+        applied_at = time.monotonic()
+        for delay in probe_delays:
+            remaining = applied_at + delay * scale - time.monotonic()
+            if remaining > 0:
+                waiter = asyncio.Event()
+                self._waiters.add(waiter)
+                try:
+                    await asyncio.wait_for(waiter.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self._waiters.discard(waiter)
+            self.probes += 1
+            try:
+                if await _call(confirm):
+                    return True
+            except TimeoutError:
+                pass
+        return False
+
+    def _forget(self, hwnd, task):
+        if self._pending.get(hwnd) is task:
+            del self._pending[hwnd]
+
+    def _record(self, hwnd, confirmed, attempts):
+        if confirmed:
+            self.confirmed += 1
+            self.breaker.record_success(hwnd)
+        else:
+            self.failed += 1
+            self.breaker.record_failure(hwnd)
+        app = self.get_app(hwnd) if self.get_app is not None and hwnd else ''
+        stats = self._apps.get(app)
+        if stats is None:
+            stats = self._apps[app] = AppSwitchStats()
+            while len(self._apps) > self.max_apps:
+                self._apps.popitem(last=False)
+        self._apps.move_to_end(app)
+        stats.switches += 1
+        stats.confirmed += confirmed
+        stats.attempts += attempts
+
+
+async def _benchmark(switches=300, windows=10, drop_rate=0.2, layout_delay=0.01):
+    """
+    模拟后端以 drop_rate 的比例丢弃布局切换请求和 IMC_SET*（繁忙的程序、UIPI）。
+    1. 热键切换布局：比较不确认和确认时，最后仍停在错误布局上的窗口数和每次切换发出的消息数
+    2. 强制中文：用户在前台窗口按 Shift 切到英文，比较离开窗口时仍是英文的次数和纠正延迟
+    """
+    import random
+
+    from ime_switcher import ime_status_detector as detector
+    from ime_switcher.backend import SimulatedBackend, set_backend
+    from ime_switcher.force_cn import POLLING, ForceCnMonitor
+    from ime_switcher.layouts import KeyboardLayoutRegistry, PlatformLayoutBackend
+    from ime_switcher.metrics import Histogram
+    from ime_switcher.switcher import ENGLISH_KEYBOARD_ID, Switcher
+
+    for verified in (False, True):
+        rng = random.Random(5)
+        backend = SimulatedBackend(layout_delay=layout_delay, drop_rate=drop_rate, seed=3)
+        hwnds = [backend.add_window(f'window {i}', process_name=f'app{i % 3}.exe') for i in range(windows)]
+        registry = KeyboardLayoutRegistry(PlatformLayoutBackend(backend), (ENGLISH_KEYBOARD_ID, '00000804'))
+        registry.preload()
+        verifier = SwitchVerifier(get_app=backend.get_process_name) if verified else None
+        switcher = Switcher('00000804', registry, backend=backend, verifier=verifier)
+        # hwnd -> 最后一次切换的目标 HKL
+        targets = {}
+        for _ in range(switches):
+            hwnd = rng.choice(hwnds)
+            backend.focus(hwnd)
+            switcher.toggle()
+            targets[hwnd] = backend.posted[-1][3]
+            await asyncio.sleep(rng.uniform(0.005, 0.03))
+        await asyncio.sleep(1.0)
+        stuck = sum(1 for hwnd, hkl in targets.items() if switcher.read_window_hkl(hwnd) != hkl)
+        print(f'layout   {"verified" if verified else "posted":8}: {stuck}/{len(targets)} windows in the wrong layout, '
+              f'{backend.calls["post_message"] / switches:.2f} posts/switch, {backend.dropped} dropped'
+              + (f', {verifier.stats()}, confirm (ms): {verifier.confirm_latency.summary()}' if verified else ''))
+
+    for verified in (False, True):
+        rng = random.Random(6)
+        backend = set_backend(SimulatedBackend(drop_rate=drop_rate, seed=4))
+        hwnds = [backend.add_window(f'window {i}', layout_id='00000804', process_name=f'app{i % 3}.exe')
+                 for i in range(windows)]
+        for hwnd in hwnds:
+            backend.set_ime_state(hwnd, 1, detector.IME_CMODE_NATIVE)
+        verifier = SwitchVerifier(get_app=backend.get_process_name) if verified else None
+
+        async def get_status(hwnd=None):
+            return detector.get_ime_status(hwnd, detector.ALL | detector.PINYIN_ONLY)
+
+        async def switch(hwnd):
+            return detector.switch_to_chinese_mode(hwnd)
+
+        monitor = ForceCnMonitor(get_status, switch, backend.get_window_title, interval=0.02, mode=POLLING,
+                                 verifier=verifier)
+        task = asyncio.create_task(monitor.run())
+        reaction = Histogram('reaction_ms')
+        left_in_english = 0
+        for _ in range(switches // 3):
+            hwnd = rng.choice(hwnds)
+            backend.focus(hwnd)
+            # 用户按 Shift 切到英文，停留 0.3~0.6 秒后离开
+            backend.set_ime_state(hwnd, 1, 0)
+            start = time.monotonic()
+            deadline = start + rng.uniform(0.3, 0.6)
+            state = backend.ime_states[backend.windows[hwnd].hime]
+            while not state[1] & detector.IME_CMODE_NATIVE and time.monotonic() < deadline:
+                await asyncio.sleep(0.002)
+            if state[1] & detector.IME_CMODE_NATIVE:
+                reaction.add((time.monotonic() - start) * 1000)
+            else:
+                left_in_english += 1
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        print(f'force cn {"verified" if verified else "one-shot":8}: {left_in_english}/{switches // 3} windows left '
+              f'in English, {backend.dropped} dropped, fixed after (ms): {reaction.summary()}'
+              + (f', {verifier.stats()}' if verified else ''))
+        if verified:
+            print(f'success by app: {verifier.app_stats()}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_benchmark())
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+本地控制接口：脚本和编辑器插件通过命名管道（Windows）或 Unix 套接字（模拟器）
+查询和切换输入模式，不必自己重新实现 get_ime_status。协议和客户端见 control_client。
+
+连接在事件循环上处理，处理函数直接在事件循环上调用（与托盘不同，不需要经过命令总线）。
+status 读取强制中文监视器维护的状态快照，不查询窗口，请求耗时为微秒级；
+协程处理函数有超时，挂起的查询不会让连接一直等待。
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import time
+
+from ime_switcher.control_client import default_address, encode
+from ime_switcher.metrics import histogram
+
+logger = logging.getLogger('ime_switcher')
+
+# 单个请求行的最大字节数
+MAX_REQUEST = 64 * 1024
+
+
+class ControlServer:
+    """
+    控制接口服务端的基类。
+
+    Args:
+        address: 监听地址，默认 default_address(name)
+        timeout: 协程处理函数的最长执行时间（秒）
+    """
+    name = 'base'
+
+    def __init__(self, address=None, timeout=2.0):
+        self.address = address or default_address(self.name)
+        self.timeout = timeout
+        self.requests = 0
+        self.errors = 0
+        self.connections = 0
+        self.request_latency = histogram('control_request_ms')
+        self._handlers = {}
+        self._server = None
+
+    def register(self, command, handler):
+        """handler(*args) 为普通函数或协程函数，返回值需可序列化为 JSON"""
+        self._handlers[command] = handler
+
+    async def start(self, loop):
+        raise NotImplementedError
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def stats(self):
+        return {
+            'address': self.address,
+            'connections': self.connections,
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_ms': self.request_latency.summary(),
+        }
+
+    async def handle(self, line):
+        """处理一行请求，返回响应行（bytes）"""
+        start = time.perf_counter()
+        self.requests += 1
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            command = request['command']
+            handler = self._handlers.get(command)
+            if handler is None:
+                raise ValueError(f'unknown command {command!r}, expected one of {sorted(self._handlers)}')
+            result = handler(*request.get('args', ()))
+            if asyncio.iscoroutine(result):
+                result = await asyncio.wait_for(result, self.timeout)
+            response = {'id': request_id, 'ok': True, 'result': result}
+        except Exception as e:
+            self.errors += 1
+            if isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+                e = f'timed out after {self.timeout}s'
+            elif isinstance(e, (KeyError, AttributeError)):
+                e = 'malformed request'
+            logger.debug(f'Control request failed: {e}')
+            response = {'id': request_id, 'ok': False, 'error': str(e)}
+        self.request_latency.add((time.perf_counter() - start) * 1000)
+        return encode(response)
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # 超过 MAX_REQUEST 的请求行
+                    writer.write(encode({'id': None, 'ok': False, 'error': 'request too long'}))
+                    break
+                if not line:
+                    break
+                writer.write(await self.handle(line))
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+
+class PipeControlServer(ControlServer):
+    """命名管道，需要 ProactorEventLoop（Windows 上的默认事件循环）；默认安全描述符只允许本用户和管理员写入"""
+    name = 'pipe'
+
+    async def start(self, loop):
+        if not hasattr(loop, 'start_serving_pipe'):
+            raise OSError('Named pipes need the proactor event loop')
+
+        def protocol_factory():
+            reader = asyncio.StreamReader(limit=MAX_REQUEST, loop=loop)
+            return asyncio.StreamReaderProtocol(reader, self._serve, loop=loop)
+
+        [self._server] = await loop.start_serving_pipe(protocol_factory, self.address)
+
+
+class UnixControlServer(ControlServer):
+    """Unix 套接字，文件权限只允许本用户访问"""
+    name = 'unix'
+
+    async def start(self, loop):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Unix sockets are not available on this platform')
+        if os.path.exists(self.address):
+            # 残留的套接字文件可以删除；仍有程序在监听时不能抢占
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.address)
+            except OSError:
+                os.unlink(self.address)
+            else:
+                raise OSError(f'Another instance is listening on {self.address}')
+            finally:
+                probe.close()
+        old_umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._serve, self.address, limit=MAX_REQUEST)
+        finally:
+            os.umask(old_umask)
+
+    def stop(self):
+        if self._server is not None:
+            super().stop()
+            with contextlib.suppress(OSError):
+                os.unlink(self.address)
+
+
+_control_servers = {
+    PipeControlServer.name: PipeControlServer,
+    UnixControlServer.name: UnixControlServer,
+}
+
+
+def create_control_server(kind='pipe', **kwargs):
+    if kind not in _control_servers:
+        raise ValueError(f'Unknown control server: {kind}')
+    return _control_servers[kind](**kwargs)
+
+
+def _stress(threads=8, per_thread=2000, ime_latency=0.0005):
+    """
+    模拟后端上的负载测试：多个客户端线程在各自的连接上连续发送请求。
+    status 读取快照，对比每次请求都查询 IME（相当于客户端自己调用 get_ime_status，
+    SimulatedBackend 的每次 Win32 调用耗时 ime_latency 秒）；最后测量命令行客户端的启动时间。
+    """
+    import concurrent.futures
+    import statistics
+    import subprocess
+    import sys
+    import tempfile
+    import threading
+
+    from ime_switcher import ime_status_detector as detector
+    from ime_switcher.backend import SimulatedBackend, set_backend
+    from ime_switcher.control_client import ControlClient
+    from ime_switcher.force_cn import WindowStatus
+    from ime_switcher.metrics import Histogram
+
+    backend = set_backend(SimulatedBackend(latencies={'send_ime_control': ime_latency}))
+    hwnd = backend.add_window('README.md - Visual Studio Code', layout_id='00000804')
+    backend.focus(hwnd)
+    backend.set_ime_state(hwnd, 1, detector.IME_CMODE_NATIVE)
+    status = WindowStatus()
+    status.update(detector.get_ime_status())
+    executor = concurrent.futures.ThreadPoolExecutor(4)
+
+    def describe(snapshot):
+        return {'hwnd': snapshot.hwnd, 'title': snapshot.title, 'lang_id': snapshot.lang_id,
+                'chinese': snapshot.is_chinese}
+
+    async def live_status():
+        loop = asyncio.get_running_loop()
+        return describe(await loop.run_in_executor(executor, detector.get_ime_status))
+
+    kind = 'pipe' if os.name == 'nt' else 'unix'
+    address = default_address(kind) + '-stress' if kind == 'pipe' else os.path.join(tempfile.mkdtemp(), 'control.sock')
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    server = create_control_server(kind, address=address)
+    server.register('status', lambda: describe(status.snapshot))
+    server.register('live_status', live_status)
+    asyncio.run_coroutine_threadsafe(server.start(loop), loop).result()
+
+    def load(command, count):
+        latency = Histogram(f'{command}_ms')
+
+        def client():
+            with ControlClient(address) as c:
+                for _ in range(count):
+                    start = time.perf_counter()
+                    c.call(command)
+                    latency.add((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=client) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        print(f'{command:11}: {threads * count / elapsed:8,.0f} requests/s from {threads} clients, '
+              f'round trip (ms): {latency.summary()}, server (ms): {server.request_latency.summary()}')
+        server.request_latency.reset()
+
+    load('status', per_thread)
+    load('live_status', per_thread // 10)
+
+    async def handle(line, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            await server.handle(line)
+        return (time.perf_counter() - start) / count * 1e6
+
+    line = encode({'id': 1, 'command': 'status', 'args': []})
+    handled = asyncio.run_coroutine_threadsafe(handle(line, 20000), loop).result()
+    env = dict(os.environ, IME_SWITCHER_CONTROL=address)
+
+    def run(args):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], env=env, check=True, stdout=subprocess.DEVNULL)
+        return (time.perf_counter() - start) * 1000
+
+    bare = statistics.median(run(['-c', 'pass']) for _ in range(5))
+    cli = statistics.median(run(['-m', 'ime_switcher.control_client', 'status']) for _ in range(5))
+    print(f'status handled in {handled:.1f} us without client load, {server.errors} errors')
+    print(f'CLI status: {cli:.0f} ms wall time (bare interpreter {bare:.0f} ms)')
+
+    loop.call_soon_threadsafe(server.stop)
+    loop.call_soon_threadsafe(loop.stop)
+    loop_thread.join()
+    loop.close()
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    _stress()
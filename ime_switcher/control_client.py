@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+本地控制接口的客户端和命令行工具。
+
+    python -m ime_switcher.control_client status
+    python -m ime_switcher.control_client switch english
+    python -m ime_switcher.control_client toggle | temp_toggle | metrics
+
+协议：每行一个 JSON 请求 {"id": 1, "command": "status", "args": []}，
+服务端按顺序每行返回一个响应 {"id": 1, "ok": true, "result": ...} 或 {"id": 1, "ok": false, "error": "..."}。
+地址：Windows 上为命名管道，其他平台为 Unix 套接字；环境变量 IME_SWITCHER_CONTROL 可覆盖。
+
+只依赖标准库中启动很快的模块，不导入 asyncio 和程序的其他部分，供脚本和编辑器插件频繁调用。
+"""
+
+import json
+import os
+import socket
+import sys
+import time
+
+PIPE_PREFIX = '\\\\.\\pipe\\'
+ERROR_PIPE_BUSY = 231
+
+# 退出码
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_NOT_RUNNING = 3
+
+
+class ControlError(Exception):
+    """服务端返回的错误"""
+
+
+def default_address(kind=None):
+    """kind 为 pipe / unix，None 表示当前平台的默认方式"""
+    address = os.environ.get('IME_SWITCHER_CONTROL')
+    if address:
+        return address
+    if kind is None:
+        kind = 'pipe' if os.name == 'nt' else 'unix'
+    if kind == 'pipe':
+        return f'{PIPE_PREFIX}ime-switcher-{os.environ.get("USERNAME", "default")}'
+    directory = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+    return os.path.join(directory, f'ime-switcher-{os.getuid()}.sock')
+
+
+def encode(message):
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ControlClient:
+    """
+    同步客户端，一个连接上可以连续发送多个请求。连接失败时抛出 OSError（程序未运行）。
+
+    Args:
+        address: 命名管道或 Unix 套接字路径，默认 default_address()
+        timeout: 连接和等待响应的超时（秒）；命名管道只用于连接，读取时不超时
+    """
+
+    def __init__(self, address=None, timeout=2.0):
+        self.address = address or default_address()
+        self.timeout = timeout
+        self._next_id = 1
+        self._sock = None
+        self._pipe = None
+        self._reader = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        if self.address.startswith(PIPE_PREFIX):
+            self._pipe = self._open_pipe()
+            self._reader = open(self._pipe.fileno(), 'rb', closefd=False)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            try:
+                self._sock.connect(self.address)
+            except OSError:
+                self.close()
+                raise
+            self._reader = self._sock.makefile('rb')
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self._pipe is not None:
+            self._pipe.close()
+            self._pipe = None
+
+    def call(self, command, *args):
+        """发送请求并返回结果，服务端报告错误时抛出 ControlError"""
+        if self._reader is None:
+            self.connect()
+        request_id = self._next_id
+        self._next_id += 1
+        data = encode({'id': request_id, 'command': command, 'args': list(args)})
+        if self._sock is not None:
+            self._sock.sendall(data)
+        else:
+            self._pipe.write(data)
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError('Control API closed the connection')
+        response = json.loads(line)
+        if response.get('id') != request_id:
+            raise ControlError(f'Unexpected response id {response.get("id")}, expected {request_id}')
+        if not response.get('ok'):
+            raise ControlError(response.get('error', 'unknown error'))
+        return response.get('result')
+
+    def _open_pipe(self):
+        # 服务端在每次连接后才创建下一个管道实例，短暂的 ERROR_PIPE_BUSY 重试即可
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return open(self.address, 'r+b', buffering=0)
+            except OSError as e:
+                if getattr(e, 'winerror', None) != ERROR_PIPE_BUSY or time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.01)
+
+
+USAGE = """usage: python -m ime_switcher.control_client [--address ADDRESS] COMMAND [ARGS...]
+
+commands:
+  status                  current window, layout and Chinese/English mode
+  toggle                  toggle between English and the secondary keyboard
+  switch english|secondary
+  temp_toggle             switch temporarily, switches back after typing stops
+  metrics                 latency histograms and Win32 call counts"""
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    address = None
+    if argv[:1] == ['--address'] and len(argv) >= 2:
+        address, argv = argv[1], argv[2:]
+    if not argv or argv[0] in ('-h', '--help'):
+        print(USAGE, file=sys.stderr)
+        return EXIT_USAGE
+    client = ControlClient(address)
+    try:
+        client.connect()
+    except OSError as e:
+        print(f'IME Switcher is not running at {client.address} ({e})', file=sys.stderr)
+        return EXIT_NOT_RUNNING
+    try:
+        result = client.call(argv[0], *argv[1:])
+    except (ControlError, OSError) as e:
+        print(f'{argv[0]} failed: {e}', file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        client.close()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+前台窗口 / 焦点 / IME 变化 / 窗口销毁事件来源。
+
+- WinEventSource: SetWinEventHook (WINEVENT_OUTOFCONTEXT)，运行在独立消息线程上
+- TraceEventSource: 回放事件轨迹，用于在 Linux 上测试和基准测试
+"""
+
+import asyncio
+import logging
+import time
+
+from ime_switcher import win32
+from ime_switcher.message_pump import MessageThread
+
+logger = logging.getLogger('ime_switcher')
+
+EVENT_SYSTEM_FOREGROUND = 0x0003
+EVENT_OBJECT_DESTROY = 0x8001
+EVENT_OBJECT_FOCUS = 0x8005
+EVENT_OBJECT_IME_SHOW = 0x8027
+EVENT_OBJECT_IME_HIDE = 0x8028
+EVENT_OBJECT_IME_CHANGE = 0x8029
+WINEVENT_OUTOFCONTEXT = 0x0000
+WINEVENT_SKIPOWNPROCESS = 0x0002
+OBJID_WINDOW = 0
+CHILDID_SELF = 0
+
+# 事件名称
+FOREGROUND = 'foreground'
+FOCUS = 'focus'
+IME_CHANGE = 'ime_change'
+DESTROY = 'destroy'
+
+_event_names = {
+    EVENT_SYSTEM_FOREGROUND: FOREGROUND,
+    EVENT_OBJECT_DESTROY: DESTROY,
+    EVENT_OBJECT_FOCUS: FOCUS,
+    EVENT_OBJECT_IME_SHOW: IME_CHANGE,
+    EVENT_OBJECT_IME_HIDE: IME_CHANGE,
+    EVENT_OBJECT_IME_CHANGE: IME_CHANGE,
+}
+
+
+class FocusEventSource:
+    """
+    焦点事件来源的基类。
+
+    start(loop) 之后，每个事件都会在事件循环线程上调用所有监听器
+    callback(event, hwnd, timestamp)，timestamp 为单调时钟时间。
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.loop = None
+        self.event_count = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def start(self, loop):
+        self.loop = loop
+
+    def stop(self):
+        pass
+
+    def notify(self, event, hwnd, timestamp=None):
+        """在事件循环线程上分发一个事件"""
+        self.event_count += 1
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        for callback in list(self._listeners):
+            callback(event, hwnd, timestamp)
+
+
+class WinEventSource(FocusEventSource):
+    """通过 SetWinEventHook 订阅前台、焦点和 IME 窗口变化"""
+    name = 'winevent'
+
+    _hooked_ranges = (
+        (EVENT_SYSTEM_FOREGROUND, EVENT_SYSTEM_FOREGROUND),
+        (EVENT_OBJECT_DESTROY, EVENT_OBJECT_DESTROY),
+        (EVENT_OBJECT_FOCUS, EVENT_OBJECT_FOCUS),
+        (EVENT_OBJECT_IME_SHOW, EVENT_OBJECT_IME_CHANGE),
+    )
+
+    def __init__(self):
+        super().__init__()
+        self._thread = None
+        self._hooks = []
+        self._proc = None
+
+    def start(self, loop, timeout=1.0):
+        super().start(loop)
+        self._thread = MessageThread('WinEventHook')
+        self._thread.start(timeout)
+        try:
+            self._thread.call(self._install).result(timeout)
+        except Exception as e:
+            self._thread.stop()
+            raise e if isinstance(e, OSError) else OSError(str(e))
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.call(self._uninstall)
+            self._thread.stop()
+            self._thread = None
+
+    def _install(self):
+        api = win32.api()
+        self._proc = api.WINEVENTPROC(self._on_win_event)
+        flags = WINEVENT_OUTOFCONTEXT | WINEVENT_SKIPOWNPROCESS
+        for event_min, event_max in self._hooked_ranges:
+            hook = api.SetWinEventHook(event_min, event_max, None, self._proc, 0, 0, flags)
+            if not hook:
+                # 先取错误码，UnhookWinEvent 会覆盖它
+                error = api.error()
+                self._uninstall()
+                raise error
+            self._hooks.append(hook)
+
+    def _uninstall(self):
+        api = win32.api()
+        for hook in self._hooks:
+            api.UnhookWinEvent(hook)
+        self._hooks = []
+
+    def _on_win_event(self, hook, event, hwnd, id_object, id_child, thread_id, event_time):
+        name = _event_names.get(event)
+        if name == DESTROY and (id_object != OBJID_WINDOW or id_child != CHILDID_SELF):
+            # 只关心窗口本身的销毁，忽略窗口内的控件/光标等对象
+            return
+        if name is not None:
+            self.loop.call_soon_threadsafe(self.notify, name, hwnd or 0, time.monotonic())
+
+
+class TraceEventSource(FocusEventSource):
+    """
+    回放事件轨迹 [(delay, event, hwnd), ...]，delay 为距上一个事件的秒数。
+    start() 之后调用 replay() 按原始时间间隔依次分发。
+    """
+    name = 'trace'
+
+    def __init__(self, trace=()):
+        super().__init__()
+        self.trace = list(trace)
+
+    async def replay(self, on_step=None):
+        for delay, event, hwnd in self.trace:
+            if delay:
+                await asyncio.sleep(delay)
+            if on_step is not None:
+                on_step(event, hwnd)
+            self.notify(event, hwnd)
+
+
+_focus_event_sources = {
+    WinEventSource.name: WinEventSource,
+    TraceEventSource.name: TraceEventSource,
+}
+
+
+def create_focus_event_source(kind='winevent'):
+    if kind not in _focus_event_sources:
+        raise ValueError(f'Unknown focus event source: {kind}')
+    return _focus_event_sources[kind]()
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+强制中文模式：当检测到Microsoft Pinyin输入法且为英文模式时，自动切换到中文模式。
+
+两种触发方式：
+- polling: 定期检查（原有方式）
+- event: 只在前台/焦点/IME 变化事件后检查。输入法内部的中英切换（例如按 Shift）
+  不一定产生事件，因此仍以较长的 fallback_interval 做兜底检查
+
+两种方式的定期检查间隔都是自适应的（AdaptiveCadence）：检查到变化或期间有用户输入时
+回到 interval（event 模式为 fallback_interval），空闲时按指数逐渐放长到 max_interval。
+锁屏、断开连接等会话暂停期间（session.SessionState）不检查，恢复后立即重新检查。
+
+有 confirm.SwitchVerifier 时，切换后重新查询该窗口确认中/英文模式已生效，未生效时有限次重试；
+仍未生效的窗口在之后的检查中继续尝试（由确认器的熔断器限制频率），不会因为状态没有变化而被跳过。
+
+配置了按应用规则（policy.PolicyEngine）时，规则的 conversion 覆盖默认行为：
+chinese 强制中文，english 强制英文，off 不处理。不强制时，如果有 LanguageMemory，
+切回窗口时恢复该窗口上次的中/英文模式。
+"""
+
+import asyncio
+import logging
+import time
+
+from ime_switcher import metrics
+from ime_switcher.focus_events import DESTROY
+from ime_switcher.logs import RateLimit
+from ime_switcher.metrics import histogram
+from ime_switcher.policy import CHINESE, ENGLISH
+
+logger = logging.getLogger('ime_switcher')
+_skip_log = RateLimit(logger, logging.DEBUG, 5.0)
+
+POLLING = 'polling'
+EVENT = 'event'
+# IMC_SETCONVERSIONMODE 是同步的 SendMessage，输入法接受后立即可查，确认不需要等布局切换那么久
+CONFIRM_DELAYS = (0.01, 0.04)
+# 最后一次输入后至少这么多秒内仍按活动处理
+INPUT_HOLD = 1.0
+
+
+class WindowStatus:
+    """
+    最近一次检查到的前台窗口输入法状态（ImeSnapshot），由监视器每次检查时替换，
+    托盘的“状态”直接读取，不再查询窗口。
+    """
+    __slots__ = ('snapshot', 'updated_at')
+
+    def __init__(self):
+        self.snapshot = None
+        self.updated_at = None
+
+    def update(self, snapshot):
+        self.snapshot = snapshot
+        self.updated_at = time.monotonic()
+
+    def age(self):
+        return None if self.updated_at is None else time.monotonic() - self.updated_at
+
+
+class AdaptiveCadence:
+    """
+    自适应检查间隔：有活动（检查到变化，或上次检查以来有用户输入）时回到 min_interval，
+    否则每次乘以 decay，最长 max_interval。
+    """
+
+    def __init__(self, min_interval, max_interval, decay=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.decay = decay
+        self.interval = min_interval
+        self.ticks = 0
+        self.active_ticks = 0
+
+    def next(self, active):
+        """返回下次检查前等待的秒数"""
+        self.ticks += 1
+        if active:
+            self.active_ticks += 1
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.decay)
+        return self.interval
+
+    def reset(self):
+        self.interval = self.min_interval
+
+    def stats(self):
+        return {'interval': round(self.interval, 3), 'ticks': self.ticks, 'active_ticks': self.active_ticks}
+
+
+class ForceCnMonitor:
+    """
+    Args:
+        get_status: 协程函数 get_status(hwnd=None)，返回 ime_status_detector.ImeSnapshot（默认前台窗口），
+            窗口无响应时抛出 TimeoutError，即 ImeQueryExecutor.get_status；只需要拼音窗口的中/英文模式
+            （fields 可带 PINYIN_ONLY）
+        switch: 切换到中文模式的协程函数 switch(hwnd) -> bool
+        get_title: 获取窗口标题的函数
+        interval: 轮询间隔（秒），有活动时的检查间隔
+        mode: POLLING 或 EVENT
+        event_source: EVENT 模式下使用的 FocusEventSource（需已启动）
+        fallback_interval: EVENT 模式下的兜底检查间隔（秒）
+        policy: PolicyEngine（可选），按窗口决定强制中文/英文/不处理
+        switch_english: 切换到英文模式的协程函数 switch_english(hwnd) -> bool，有 english 规则时需要
+        default_conversion: 没有规则匹配时的行为，CHINESE 或 OFF（force_cn_mode 关闭、只按规则处理）
+        on_window_change: 前台窗口变化时调用 on_window_change(hwnd)，用于应用规则的布局
+        memory: LanguageMemory（可选），记住并恢复每个窗口的中/英文模式
+        status: 每次检查后更新的 WindowStatus，监视器重启时可沿用同一个
+        max_interval: 空闲时检查间隔的上限（秒），None 表示不放长
+        get_idle_time: 返回距离最后一次用户输入的秒数（Backend.get_idle_time），用于判断检查之间是否有输入
+        session: SessionState（可选），会话暂停期间不检查
+        verifier: SwitchVerifier（可选），确认切换已生效并有限次重试
+    """
+
+    def __init__(self, get_status, switch, get_title, interval=0.2, mode=POLLING,
+                 event_source=None, fallback_interval=1.0, policy=None, switch_english=None,
+                 default_conversion=CHINESE, on_window_change=None, memory=None, status=None,
+                 max_interval=None, get_idle_time=None, session=None, verifier=None):
+        if mode == EVENT and event_source is None:
+            raise ValueError('Event mode requires an event source')
+        self.get_status = get_status
+        self.switch = switch
+        self.get_title = get_title
+        self.interval = interval
+        self.mode = mode
+        self.event_source = event_source
+        self.fallback_interval = fallback_interval
+        self.policy = policy
+        self.switch_english = switch_english
+        self.default_conversion = default_conversion
+        self.on_window_change = on_window_change
+        self.memory = memory
+        self.status = status if status is not None else WindowStatus()
+        base = interval if mode == POLLING else fallback_interval
+        self.cadence = AdaptiveCadence(base, max_interval or base)
+        self.get_idle_time = get_idle_time
+        self.session = session
+        self.verifier = verifier
+        # 切换未被确认的窗口，下次检查时即使状态没变也再试
+        self._unconfirmed = None
+        self.resync_count = 0
+        self.cadence_histogram = histogram('force_cn_interval_ms')
+        self._cycle_start = time.monotonic()
+        # 上一次处理中/英文模式记忆的窗口（布局刚被恢复时，窗口要到下次检查才是拼音）
+        self._memory_hwnd = None
+        self.check_count = 0
+        self.switch_count = 0
+        self.reaction_latency = histogram('force_cn_reaction_ms')
+        self._last_status = None
+        self._changed = None
+        self._changed_at = None
+
+    async def check(self):
+        """检查一次当前窗口，必要时切换到中文（或按规则切换到英文）模式；返回窗口或输入法状态是否有变化"""
+        self.check_count += 1
+        snapshot = await self.get_status()
+        self.status.update(snapshot)
+        hwnd, is_pinyin, is_chinese = snapshot.hwnd, snapshot.is_pinyin, snapshot.is_chinese
+        current_status = (is_pinyin, is_chinese, hwnd)
+        new_window = self._last_status is None or hwnd != self._last_status[2]
+        if new_window:
+            self._memory_hwnd = None
+            if self.on_window_change is not None and hwnd:
+                self.on_window_change(hwnd)
+
+        conversion = self.default_conversion
+        if self.policy is not None:
+            conversion = self.policy.decide(hwnd).conversion or conversion
+
+        # 避免频繁切换，只在状态变化时执行
+        if is_pinyin and (current_status != self._last_status or hwnd == self._unconfirmed):
+            if conversion == CHINESE and not is_chinese:
+                await self._switch(hwnd, self.switch, 'Chinese')
+            elif conversion == ENGLISH and is_chinese and self.switch_english is not None:
+                await self._switch(hwnd, self.switch_english, 'English')
+            elif conversion not in (CHINESE, ENGLISH) and self.memory is not None:
+                await self._restore(hwnd, is_chinese)
+
+        changed = current_status != self._last_status
+        self._last_status = current_status
+        return changed
+
+    async def _restore(self, hwnd, is_chinese):
+        """切回窗口时恢复记住的模式，否则记下当前模式"""
+        new_window, self._memory_hwnd = hwnd != self._memory_hwnd, hwnd
+        remembered = self.memory.recall_conversion(hwnd) if new_window else None
+        if remembered is None or remembered == is_chinese or self.switch_english is None:
+            self.memory.remember_conversion(hwnd, is_chinese)
+        elif remembered:
+            await self._switch(hwnd, self.switch, 'Chinese')
+        else:
+            await self._switch(hwnd, self.switch_english, 'English')
+
+    async def _switch(self, hwnd, switch, mode_name):
+        if self.verifier is not None and not self.verifier.allow(hwnd):
+            return
+        window_title = self.get_title(hwnd)
+        logger.info(f"Force {mode_name} triggered: Microsoft Pinyin detected in the other mode")
+        logger.info(f"Window: {window_title}")
+
+        # 从检测到需要切换到切换成功（有确认器时到确认生效）
+        with metrics.span('force_cn_switch_ms'):
+            if self.verifier is None:
+                success = await switch(hwnd)
+            else:
+                chinese = mode_name == 'Chinese'
+                success = await self.verifier.run(hwnd, lambda: switch(hwnd), lambda: self._confirm(hwnd, chinese),
+                                                  f'Force {mode_name}', probe_delays=CONFIRM_DELAYS)
+                self._unconfirmed = None if success else hwnd
+            if success:
+                metrics.mark()
+        if success:
+            self.switch_count += 1
+            logger.info(f"✅ Auto switched to {mode_name} mode successfully")
+        else:
+            logger.warning(f"❌ Force {mode_name} failed")
+
+    async def _confirm(self, hwnd, chinese):
+        snapshot = await self.get_status(hwnd)
+        return snapshot.is_chinese == chinese
+
+    async def run(self):
+        logger.info(f"Force CN mode monitor started ({self.mode})")
+        if self.mode == EVENT:
+            self._changed = asyncio.Event()
+            self.event_source.add_listener(self._on_event)
+        try:
+            while True:
+                if self.session is not None and await self.session.wait_active():
+                    self._resync()
+                changed = False
+                try:
+                    with metrics.span('force_cn_check_ms'):
+                        changed = await self.check()
+                        metrics.mark()
+                    if self._changed_at is not None:
+                        self.reaction_latency.add((time.monotonic() - self._changed_at) * 1000)
+                        self._changed_at = None
+                except TimeoutError as e:
+                    # 前台窗口无响应，由熔断器退避，下次照常检查
+                    suppressed = _skip_log.allow()
+                    if suppressed is not None:
+                        logger.debug(f"Force CN check skipped: {e}{RateLimit.suffix(suppressed)}")
+                except Exception as e:
+                    logger.error(f"Error in force CN monitor: {e}")
+                    # 出错时等待更长时间，连续出错时按指数放长
+                    await asyncio.sleep(max(self.cadence.next(False), self.interval * 2))
+                    continue
+                await self._wait(changed)
+        except asyncio.CancelledError:
+            logger.info("Force CN mode monitor cancelled")
+            raise
+        finally:
+            if self.mode == EVENT:
+                self.event_source.remove_listener(self._on_event)
+
+    def stats(self):
+        return {'mode': self.mode, 'checks': self.check_count, 'switches': self.switch_count,
+                'resyncs': self.resync_count, **self.cadence.stats()}
+
+    def _resync(self):
+        """会话恢复：暂停前的窗口状态和事件都已过时，当作首次检查"""
+        self.resync_count += 1
+        self._last_status = None
+        self._memory_hwnd = None
+        self._changed_at = None
+        if self._changed is not None:
+            self._changed.clear()
+        self.cadence.reset()
+        self._cycle_start = time.monotonic()
+
+    def _user_active(self):
+        """上一轮（等待 + 检查）开始以来是否有用户输入；打字中的短暂停顿（INPUT_HOLD 秒内）也算"""
+        now = time.monotonic()
+        since, self._cycle_start = now - self._cycle_start, now
+        return self.get_idle_time is not None and self.get_idle_time() < max(since, INPUT_HOLD)
+
+    async def _wait(self, changed):
+        # 先判断输入，避免短路跳过对 _cycle_start 的更新
+        active = self._user_active() or changed
+        interval = self.cadence.next(active)
+        self.cadence_histogram.add(interval * 1000)
+        if self.mode != EVENT:
+            await asyncio.sleep(interval)
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    def _on_event(self, event, hwnd, timestamp):
+        if event == DESTROY:
+            return
+        # 多个事件合并为一次检查，延迟从第一个事件开始计算
+        if self._changed_at is None:
+            self._changed_at = timestamp
+        self._changed.set()
+
+
+async def _benchmark():
+    import random
+
+    from ime_switcher.focus_events import FOREGROUND, TraceEventSource
+    from ime_switcher.ime_status_detector import IME_CMODE_NATIVE, ImeSnapshot
+    from ime_switcher.metrics import Histogram
+
+    # 模拟窗口：奇数窗口的拼音处于英文模式，切换后变为中文
+    trace = [(random.uniform(0.05, 1.5), FOREGROUND, random.randint(1, 20)) for _ in range(40)]
+    duration = sum(delay for delay, _, _ in trace) + 0.5
+
+    for mode in (POLLING, EVENT):
+        world = {'hwnd': 0, 'chinese': set(), 'changed_at': None}
+        calls = [0]
+        latency = Histogram('reaction_ms')
+
+        async def get_status():
+            calls[0] += 1
+            hwnd = world['hwnd']
+            return ImeSnapshot.from_values(hwnd, 0x08040804, True, IME_CMODE_NATIVE if hwnd in world['chinese'] else 0,
+                                           is_pinyin=hwnd % 2 == 1)
+
+        async def switch(hwnd):
+            world['chinese'].add(hwnd)
+            latency.add((time.monotonic() - world['changed_at']) * 1000)
+            return True
+
+        def on_step(event, hwnd):
+            world['hwnd'] = hwnd
+            world['chinese'].discard(hwnd)
+            world['changed_at'] = time.monotonic()
+
+        source = TraceEventSource(trace)
+        source.start(asyncio.get_running_loop())
+        monitor = ForceCnMonitor(get_status, switch, lambda hwnd: f'window {hwnd}',
+                                 mode=mode, event_source=source)
+        task = asyncio.create_task(monitor.run())
+        await source.replay(on_step)
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        print(f'{mode:8}: {calls[0] / duration:.1f} status probes/s, reaction latency (ms): {latency.summary()}')
+
+
+def _cadence_benchmark(hours=1.0, min_interval=0.2, max_interval=3.0, seed=9):
+    """
+    用模拟时钟和活动轨迹比较固定间隔与自适应间隔：轨迹由 5 分钟打字、10 分钟空闲交替组成，
+    打字期间每 0.1~0.4 秒一次按键，不时出现需要检查才能发现的变化（按 Shift 切到英文、切换窗口）。
+    统计每个空闲小时的唤醒次数，以及打字期间发现变化的延迟。
+    """
+    import bisect
+    import random
+
+    from ime_switcher.metrics import Histogram
+
+    rng = random.Random(seed)
+    duration = hours * 3600
+    keys, changes, idle_spans = [], [], []
+    t = 0.0
+    while t < duration:
+        end = min(t + 300, duration)
+        while t < end:
+            t += rng.uniform(0.1, 0.4)
+            keys.append(t)
+            if rng.random() < 0.01:
+                changes.append(t)
+        idle_spans.append((end, min(end + 600, duration)))
+        t = end + 600
+
+    def idle(moment):
+        return any(start <= moment < end for start, end in idle_spans)
+
+    for name, cadence in (('fixed', AdaptiveCadence(min_interval, min_interval)),
+                          ('adaptive', AdaptiveCadence(min_interval, max_interval))):
+        reaction = Histogram(name)
+        wakeups = idle_wakeups = 0
+        now = cycle_start = 0.0
+        next_change = 0
+        while now < duration:
+            wakeups += 1
+            idle_wakeups += idle(now)
+            changed = False
+            while next_change < len(changes) and changes[next_change] <= now:
+                reaction.add((now - changes[next_change]) * 1000)
+                next_change += 1
+                changed = True
+            active = bisect.bisect_right(keys, now) > bisect.bisect_right(keys, min(cycle_start, now - INPUT_HOLD))
+            cycle_start = now
+            now += cadence.next(active or changed)
+        idle_hours = sum(end - start for start, end in idle_spans) / 3600
+        print(f'{name:8}: {wakeups:6} wakeups, {idle_wakeups / idle_hours:7.0f} per idle hour, '
+              f'reaction while typing (ms): {reaction.summary()}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    _cadence_benchmark()
+    asyncio.run(_benchmark())
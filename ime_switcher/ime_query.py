@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+在事件循环之外执行 IME 查询：有界线程池 + 单次调用超时 + 按窗口熔断。
+
+前台程序挂起时，对其 IME 窗口的查询可能阻塞；放到线程池里执行后，
+事件循环（热键处理）不受影响，连续失败的窗口会被暂时跳过并指数退避。
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('ime_switcher')
+
+
+class CircuitBreaker:
+    """
+    按窗口熔断：连续失败 failure_threshold 次后，在退避期内拒绝该窗口的调用。
+    退避时间从 base_backoff 开始每次翻倍，最多 max_backoff 秒；成功一次即恢复。
+    reason 用于日志，说明窗口为什么被跳过。
+    """
+
+    def __init__(self, failure_threshold=2, base_backoff=1.0, max_backoff=30.0, max_size=256, clock=time.monotonic,
+                 reason='is not responding'):
+        self.failure_threshold = failure_threshold
+        self.reason = reason
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_size = max_size
+        self.clock = clock
+        self.rejected = 0
+        # key -> [连续失败次数, 熔断截止时间]
+        self._states = OrderedDict()
+
+    def allow(self, key):
+        state = self._states.get(key)
+        if state is None or self.clock() >= state[1]:
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self, key):
+        self._states.pop(key, None)
+
+    def record_failure(self, key):
+        state = self._states.setdefault(key, [0, 0.0])
+        self._states.move_to_end(key)
+        state[0] += 1
+        if state[0] >= self.failure_threshold:
+            backoff = min(self.base_backoff * 2 ** (state[0] - self.failure_threshold), self.max_backoff)
+            state[1] = self.clock() + backoff
+            logger.warning(f'Window 0x{key or 0:x} {self.reason}, backing off for {backoff:.1f}s')
+        while len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+
+    def is_open(self, key):
+        state = self._states.get(key)
+        return state is not None and self.clock() < state[1]
+
+
+class ImeQueryExecutor:
+    """
+    Args:
+        get_foreground: 获取前台窗口句柄（不会阻塞）
+        get_status: get_ime_status(hwnd, fields)，可能阻塞
+        switch: switch_to_chinese_mode(hwnd)，可能阻塞
+        timeout: 单次调用超时（秒）
+        max_workers: 线程池大小，也是同时进行的查询上限
+    """
+
+    def __init__(self, get_foreground, get_status, switch, timeout=0.5, max_workers=2, breaker=None):
+        self.get_foreground = get_foreground
+        self._get_status = get_status
+        self._switch = switch
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.max_workers = max_workers
+        self.timeouts = 0
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ImeQuery')
+        # 仍在线程中执行的调用数（超时后线程可能仍被占用）
+        self._in_flight = 0
+
+    async def get_status(self, hwnd=None, *args):
+        """查询窗口输入法状态，args 原样传给 get_status；窗口被熔断或已无空闲线程时抛出 TimeoutError"""
+        if hwnd is None:
+            hwnd = self.get_foreground()
+        return await self._call(hwnd, self._get_status, hwnd, *args)
+
+    async def switch(self, hwnd):
+        """切换到中文模式；超时或窗口被熔断时返回 False"""
+        return await self.run(hwnd, self._switch, hwnd)
+
+    async def run(self, hwnd, func, *args):
+        """在线程池中执行 func(*args)，按 hwnd 熔断；超时或被熔断时返回 False"""
+        try:
+            return await self._call(hwnd, func, *args)
+        except TimeoutError as e:
+            logger.warning(f'Switch skipped: {e}')
+            return False
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _call(self, hwnd, func, *args):
+        if not self.breaker.allow(hwnd):
+            raise TimeoutError(f'Window 0x{hwnd or 0:x} is backed off')
+        if self._in_flight >= self.max_workers:
+            # 所有线程都卡在无响应的窗口上，不再排队
+            raise TimeoutError('All IME query workers are busy')
+        self._in_flight += 1
+        # 复制上下文，让线程中的 Win32 调用计入当前操作的指标
+        context = contextvars.copy_context()
+        future = asyncio.get_running_loop().run_in_executor(self._pool, context.run, func, *args)
+        future.add_done_callback(self._on_done)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except (asyncio.TimeoutError, TimeoutError):
+            self.timeouts += 1
+            self.breaker.record_failure(hwnd)
+            raise TimeoutError(f'IME query for window 0x{hwnd or 0:x} timed out')
+        self.breaker.record_success(hwnd)
+        return result
+
+    def _on_done(self, future):
+        self._in_flight -= 1
+
+    def stats(self):
+        return {
+            'in_flight': self._in_flight,
+            'timeouts': self.timeouts,
+            'rejected': self.breaker.rejected,
+        }
+
+
+async def _benchmark():
+    """一个窗口挂起时，测量事件循环（热键处理）的延迟"""
+    from ime_switcher.ime_status_detector import ImeSnapshot
+    from ime_switcher.metrics import Histogram
+
+    hung_hwnd = 13
+
+    def get_status(hwnd):
+        # 模拟 SendMessage 到挂起的窗口：阻塞直到系统超时
+        time.sleep(2.0 if hwnd == hung_hwnd else 0.001)
+        # 微软拼音的英文模式
+        return ImeSnapshot.from_values(hwnd, 0x08040804, opened=True, conversion=0, is_pinyin=True)
+
+    async def measure_loop_latency(duration, probe):
+        latency = Histogram('loop_latency_ms')
+        task = asyncio.create_task(probe())
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            start = time.monotonic()
+            await asyncio.sleep(0.01)
+            latency.add((time.monotonic() - start - 0.01) * 1000)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return latency
+
+    async def direct_probe():
+        while True:
+            get_status(hung_hwnd)
+            await asyncio.sleep(0.2)
+
+    executor = ImeQueryExecutor(lambda: hung_hwnd, get_status, None, timeout=0.2)
+
+    async def pooled_probe():
+        while True:
+            try:
+                await executor.get_status()
+            except TimeoutError:
+                pass
+            await asyncio.sleep(0.2)
+
+    print(f'direct on loop:  {(await measure_loop_latency(5, direct_probe)).summary()}')
+    print(f'worker pool:     {(await measure_loop_latency(5, pooled_probe)).summary()}')
+    print(f'executor stats:  {executor.stats()}')
+    executor.shutdown()
+
+    # 切换路径：set_ime_mode 把挂起窗口的 TimeoutError 传给执行器，同样触发按窗口熔断
+    from ime_switcher import ime_status_detector as detector
+    from ime_switcher.backend import SimulatedBackend, set_backend
+
+    backend = set_backend(SimulatedBackend())
+    hwnd = backend.add_window('hung - Notepad', layout_id='00000804')
+    backend.hang(hwnd)
+    executor = ImeQueryExecutor(lambda: hwnd, detector.get_ime_status, detector.switch_to_chinese_mode, timeout=0.5)
+    results = [await executor.switch(hwnd) for _ in range(3)]
+    assert results == [False] * 3 and executor.breaker.is_open(hwnd), executor.stats()
+    print(f'hung switch:     {results}, breaker open, executor stats: {executor.stats()}')
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(_benchmark())
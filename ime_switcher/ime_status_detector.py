@@ -1,30 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import ctypes
-import ctypes.wintypes
+import logging
+import threading
 import time
+from collections import OrderedDict
 
-# --- 定义 Windows API 函数原型 ---
-# 使用 ctypes.WinDLL 比 windll 更适合多线程环境
-user32 = ctypes.WinDLL('user32', use_last_error=True)
-imm32 = ctypes.WinDLL('imm32', use_last_error=True)
-kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
-
-# 定义函数参数和返回类型
-user32.GetForegroundWindow.restype = ctypes.wintypes.HWND
-user32.GetWindowThreadProcessId.restype = ctypes.wintypes.DWORD
-user32.GetKeyboardLayout.argtypes = [ctypes.wintypes.DWORD]
-user32.GetKeyboardLayout.restype = ctypes.wintypes.HKL
-imm32.ImmGetDefaultIMEWnd.argtypes = [ctypes.wintypes.HWND]
-imm32.ImmGetDefaultIMEWnd.restype = ctypes.wintypes.HWND
-user32.SendMessageW.argtypes = [ctypes.wintypes.HWND, ctypes.wintypes.UINT, ctypes.wintypes.WPARAM, ctypes.wintypes.LPARAM]
-user32.SendMessageW.restype = ctypes.wintypes.LPARAM
-
-# 添加获取窗口标题的API
-user32.GetWindowTextW.argtypes = [ctypes.wintypes.HWND, ctypes.wintypes.LPWSTR, ctypes.c_int]
-user32.GetWindowTextW.restype = ctypes.c_int
-user32.GetWindowTextLengthW.argtypes = [ctypes.wintypes.HWND]
-user32.GetWindowTextLengthW.restype = ctypes.c_int
+from ime_switcher import metrics
+from ime_switcher.backend import get_backend
+
+logger = logging.getLogger('ime_switcher')
 
 # --- 定义常量 ---
 # WM_IME_CONTROL 消息和子命令
@@ -34,6 +18,9 @@ IMC_SETOPENSTATUS = 0x0006
 IMC_GETCONVERSIONMODE = 0x0001
 IMC_SETCONVERSIONMODE = 0x0002
 
+# 单次 IME 查询的超时时间（毫秒）
+ime_query_timeout_ms = 200
+
 # Conversion Mode 的常量 (根据参考资料)
 IME_CMODE_NATIVE = 0x0001        # 中/日/韩文输入模式
 IME_CMODE_KATAKANA = 0x0002      # 日文片假名 (与 NATIVE 结合使用)
@@ -49,16 +36,93 @@ LANG_ENGLISH_US = 0x0409
 # Microsoft Pinyin 的布局ID
 PINYIN_LAYOUT_IDS = [0x08040804, 0x00000804, 0xe0010804]
 
+class WindowInfoCache:
+    """
+    按窗口句柄缓存 (thread_id, hkl, hime, is_pinyin)，有界 LRU + TTL。
+
+    用户长时间停留在同一窗口时，每次检查只需 GetForegroundWindow 和两次 SendMessageTimeoutW。
+    焦点/输入语言变化时应调用 invalidate() 使缓存失效，TTL 作为兜底。
+    查询线程池中的线程调用 get/put，事件循环线程调用 invalidate，所有操作都在锁内进行。
+    """
+
+    def __init__(self, max_size=64, ttl=1.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, hwnd):
+        with self._lock:
+            entry = self._entries.get(hwnd)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self._entries.move_to_end(hwnd)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, hwnd, info):
+        with self._lock:
+            self._entries[hwnd] = (time.monotonic(), info)
+            self._entries.move_to_end(hwnd)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, hwnd=None):
+        """使指定窗口（或全部窗口）的缓存失效"""
+        with self._lock:
+            if hwnd is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(hwnd, None)
+
+    def stats(self):
+        with self._lock:
+            size, hits, misses = len(self._entries), self.hits, self.misses
+        total = hits + misses
+        return {
+            'size': size,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 3) if total else None,
+        }
+
+
+window_info_cache = WindowInfoCache()
+
+
+def get_window_info(hwnd):
+    """
+    获取窗口的线程ID、键盘布局、默认IME窗口和是否为Microsoft Pinyin（带缓存）
+
+    Returns:
+        tuple: (thread_id, hkl, hime, is_pinyin)
+    """
+    info = window_info_cache.get(hwnd)
+    if info is None:
+        metrics.count_call('GetWindowThreadProcessId')
+        metrics.count_call('GetKeyboardLayout')
+        metrics.count_call('ImmGetDefaultIMEWnd')
+        backend = get_backend()
+        # 获取窗口线程ID
+        thread_id = backend.get_window_thread_id(hwnd)
+        # 获取键盘布局句柄
+        hkl = backend.get_keyboard_layout(thread_id)
+        # 语言ID是HKL的低16位
+        is_pinyin = is_microsoft_pinyin(hkl & 0xFFFF, hkl)
+        hime = backend.get_default_ime_window(hwnd)
+        info = (thread_id, hkl, hime, is_pinyin)
+        window_info_cache.put(hwnd, info)
+    return info
+
 def get_window_title(hwnd):
     """获取窗口标题"""
     if not hwnd:
         return ""
-    length = user32.GetWindowTextLengthW(hwnd) + 1
-    if length <= 1:
-        return ""
-    buf = ctypes.create_unicode_buffer(length)
-    user32.GetWindowTextW(hwnd, buf, length)
-    return buf.value
+    metrics.count_call('GetWindowTextW')
+    return get_backend().get_window_title(hwnd)
 
 def is_microsoft_pinyin(lang_id, hkl):
     """检查是否为Microsoft Pinyin输入法"""
@@ -69,6 +133,16 @@ def is_microsoft_pinyin(lang_id, hkl):
     # 检查完整的HKL值是否匹配Microsoft Pinyin
     return hkl in PINYIN_LAYOUT_IDS
 
+def send_ime_control(hime, command, value=0):
+    """
+    向IME窗口发送 WM_IME_CONTROL，超时或窗口挂起时抛出 TimeoutError
+
+    Returns:
+        int: 消息返回值
+    """
+    metrics.count_call('SendMessageTimeoutW')
+    return get_backend().send_ime_control(hime, command, value, ime_query_timeout_ms)
+
 def set_ime_mode(hwnd, open_status=True, conversion_mode=None):
     """
     设置IME模式
@@ -80,23 +154,27 @@ def set_ime_mode(hwnd, open_status=True, conversion_mode=None):
     
     Returns:
         bool: 是否设置成功
+
+    窗口挂起时 TimeoutError 原样抛出，由 ImeQueryExecutor 记入该窗口的熔断
     """
-    hime = imm32.ImmGetDefaultIMEWnd(hwnd)
+    hime = get_window_info(hwnd)[2]
     if not hime:
         return False
     
     try:
         # 设置IME开启状态
         if open_status is not None:
-            user32.SendMessageW(hime, WM_IME_CONTROL, IMC_SETOPENSTATUS, 1 if open_status else 0)
+            send_ime_control(hime, IMC_SETOPENSTATUS, 1 if open_status else 0)
         
         # 设置转换模式
         if conversion_mode is not None:
-            user32.SendMessageW(hime, WM_IME_CONTROL, IMC_SETCONVERSIONMODE, conversion_mode)
+            send_ime_control(hime, IMC_SETCONVERSIONMODE, conversion_mode)
         
         return True
-    except Exception as e:
-        print(f"设置IME模式失败: {e}")
+    except TimeoutError:
+        raise
+    except OSError as e:
+        logger.warning(f"设置IME模式失败: {e}")
         return False
 
 def switch_to_chinese_mode(hwnd):
@@ -105,80 +183,139 @@ def switch_to_chinese_mode(hwnd):
     conversion_mode = IME_CMODE_NATIVE
     return set_ime_mode(hwnd, open_status=True, conversion_mode=conversion_mode)
 
-def get_ime_status():
+def switch_to_english_mode(hwnd):
+    """切换到英文模式"""
+    # 保持IME开启，去掉NATIVE标志位（与在拼音中按 Shift 的效果相同）
+    conversion_mode = 0
+    return set_ime_mode(hwnd, open_status=True, conversion_mode=conversion_mode)
+
+# get_ime_status 的 fields：键盘布局（HKL）总会返回，以下为额外的 IME 查询（各一次 SendMessageTimeoutW）
+OPEN_STATUS = 0x1      # IMC_GETOPENSTATUS
+CONVERSION = 0x2       # IMC_GETCONVERSIONMODE
+PINYIN_ONLY = 0x4      # 只在布局为 Microsoft Pinyin 时查询以上两项
+ALL = OPEN_STATUS | CONVERSION
+
+# ImeSnapshot.state 的位：低 16 位为转换模式
+_OPEN = 1 << 16
+_OPEN_KNOWN = 1 << 17
+_CONVERSION_KNOWN = 1 << 18
+_PINYIN = 1 << 19
+
+
+class ImeSnapshot:
     """
-    获取当前活动窗口的输入法状态。
+    一次 IME 状态查询的结果，只保存原始值：窗口句柄、HKL，以及打包在 state 中的
+    开启状态、转换模式和是否为 Microsoft Pinyin。语言、中/英文、标点模式和窗口标题在访问时才计算。
+    未查询的项（fields 不含、或 PINYIN_ONLY 时非拼音窗口）对应的属性为 None。
+    """
+    __slots__ = ('hwnd', 'hkl', 'state', '_title')
+
+    def __init__(self, hwnd=0, hkl=0, state=0):
+        self.hwnd = hwnd
+        self.hkl = hkl
+        self.state = state
+        self._title = None
+
+    @classmethod
+    def from_values(cls, hwnd, hkl, opened=None, conversion=None, is_pinyin=None):
+        if is_pinyin is None:
+            is_pinyin = is_microsoft_pinyin(hkl & 0xFFFF, hkl)
+        state = _PINYIN if is_pinyin else 0
+        if opened is not None:
+            state |= _OPEN_KNOWN | (_OPEN if opened else 0)
+        if conversion is not None:
+            state |= _CONVERSION_KNOWN | (conversion & 0xFFFF)
+        return cls(hwnd, hkl, state)
+
+    @property
+    def lang_id(self):
+        # 语言ID是HKL的低16位
+        return self.hkl & 0xFFFF
+
+    @property
+    def is_pinyin(self):
+        return bool(self.state & _PINYIN)
+
+    @property
+    def conversion(self):
+        return self.state & 0xFFFF if self.state & _CONVERSION_KNOWN else None
+
+    @property
+    def opened(self):
+        """IME 是否打开（已按以下规则修正），未查询时为 None"""
+        if not self.state & _OPEN_KNOWN:
+            return None
+        # 规则：如果键盘布局是英文，即使输入法报告'opened'，也应视为关闭
+        # 规则：罕见情况，NOCONVERSION 标志位表示关闭
+        if not self.state & _OPEN or self.lang_id == LANG_ENGLISH_US:
+            return False
+        return not (self.state & _CONVERSION_KNOWN and self.state & IME_CMODE_NOCONVERSION)
+
+    @property
+    def is_chinese(self):
+        """中文输入模式：opened 为真且转换模式包含 NATIVE 标志位；未查询时为 None"""
+        opened, conversion = self.opened, self.conversion
+        if opened is None or conversion is None:
+            return None
+        return bool(opened and conversion & IME_CMODE_NATIVE)
+
+    @property
+    def symbol_mode(self):
+        """描述标点符号状态的字符串，只用于显示"""
+        conversion = self.conversion
+        if not self.hwnd or conversion is None:
+            return "未知"
+        if self.is_chinese and conversion & IME_CMODE_SYMBOL:
+            return "中文标点"
+        # 在中文模式下，如果不是中文标点，则根据全角/半角判断；英文模式下只判断全半角
+        return "英文全角" if conversion & IME_CMODE_FULLSHAPE else "英文半角"
+
+    @property
+    def title(self):
+        if self._title is None:
+            self._title = get_window_title(self.hwnd)
+        return self._title
+
+    def __repr__(self):
+        return (f'ImeSnapshot(hwnd=0x{self.hwnd or 0:x}, hkl=0x{self.hkl:08x}, pinyin={self.is_pinyin}, '
+                f'opened={self.opened}, conversion={self.conversion})')
+
+
+def get_ime_status(hwnd=None, fields=ALL):
+    """
+    获取当前活动窗口（或指定窗口）的输入法状态。
     严格遵循参考资料和流程图的逻辑。
+    IME窗口无响应时抛出 TimeoutError。
 
-    返回:
-        tuple: (is_chinese, symbol_mode_str, lang_id, is_pinyin, hwnd)
-        is_chinese (bool): True 表示中文输入模式, False 表示英文模式。
-        symbol_mode_str (str): 描述标点符号状态的字符串。
-        lang_id (int): 当前键盘布局的语言ID。
-        is_pinyin (bool): 是否为Microsoft Pinyin输入法。
-        hwnd (int): 窗口句柄
+    Args:
+        hwnd: 窗口句柄，None 表示前台窗口
+        fields: 需要的 IME 状态，OPEN_STATUS / CONVERSION / PINYIN_ONLY 的组合；
+            强制中文监视器只关心拼音窗口，用 ALL | PINYIN_ONLY 可省去其他窗口的两次 SendMessage
+
+    Returns:
+        ImeSnapshot
     """
     # 1. 获取活动窗口句柄
-    hwnd = user32.GetForegroundWindow()
+    if hwnd is None:
+        metrics.count_call('GetForegroundWindow')
+        hwnd = get_backend().get_foreground_window()
     if not hwnd:
-        return False, "未知", 0, False, 0
-
-    # 2. 获取键盘布局语言ID
-    # 获取窗口线程ID
-    thread_id = user32.GetWindowThreadProcessId(hwnd, None)
-    # 获取键盘布局句柄
-    hkl = user32.GetKeyboardLayout(thread_id)
-    # 语言ID是HKL的低16位
-    lang_id = hkl & 0xFFFF
-    
-    # 检查是否为Microsoft Pinyin
-    is_pinyin = is_microsoft_pinyin(lang_id, hkl)
+        return ImeSnapshot.from_values(0, 0, False, 0, False)
 
-    # 3. 获取IME窗口句柄
-    hime = imm32.ImmGetDefaultIMEWnd(hwnd)
-    if not hime:
-        # 如果没有IME窗口，通常是英文模式
-        return False, "英文半角", lang_id, is_pinyin, hwnd
-
-    # 4. 获取 opened 和 convMode 状态
-    # IMC_GETOPENSTATUS: 输入法是否打开
-    opened = user32.SendMessageW(hime, WM_IME_CONTROL, IMC_GETOPENSTATUS, 0)
-    
-    # IMC_GETCONVERSIONMODE: 获取转换模式
-    conv_mode = user32.SendMessageW(hime, WM_IME_CONTROL, IMC_GETCONVERSIONMODE, 0)
-
-    # --- 核心判断逻辑 (根据流程图) ---
-
-    # 规则：如果键盘布局是英文，即使输入法报告'opened'，也应视为关闭
-    if opened and lang_id == LANG_ENGLISH_US:
-        opened = False
-        
-    # 规则：罕见情况，NOCONVERSION 标志位表示关闭
-    if conv_mode & IME_CMODE_NOCONVERSION:
-        opened = False
-
-    # 判断是否为中文输入模式
-    # 关键条件: opened为真 且 conv_mode包含NATIVE标志位
-    is_chinese = bool(opened and (conv_mode & IME_CMODE_NATIVE))
-
-    # 判断标点符号模式
-    symbol_mode_str = "英文半角" # 默认值
-    if is_chinese:
-        if conv_mode & IME_CMODE_SYMBOL:
-            symbol_mode_str = "中文标点"
-        else:
-            # 在中文模式下，如果不是中文标点，则根据全角/半角判断
-            if conv_mode & IME_CMODE_FULLSHAPE:
-                symbol_mode_str = "英文全角"
-            else:
-                symbol_mode_str = "英文半角"
-    else: # 英文模式下只判断全半角
-        if conv_mode & IME_CMODE_FULLSHAPE:
-            symbol_mode_str = "英文全角"
-        else:
-            symbol_mode_str = "英文半角"
+    # 2. 获取键盘布局、是否为Microsoft Pinyin、IME窗口句柄（按窗口缓存）
+    thread_id, hkl, hime, is_pinyin = get_window_info(hwnd)
+    if fields & PINYIN_ONLY and not is_pinyin:
+        fields = 0
 
-    return is_chinese, symbol_mode_str, lang_id, is_pinyin, hwnd
+    # 3. 检查IME窗口句柄；如果没有IME窗口，通常是英文模式
+    opened = conv_mode = None
+    if fields & OPEN_STATUS:
+        # IMC_GETOPENSTATUS: 输入法是否打开
+        opened = send_ime_control(hime, IMC_GETOPENSTATUS) if hime else 0
+    if fields & CONVERSION:
+        # IMC_GETCONVERSIONMODE: 获取转换模式
+        conv_mode = send_ime_control(hime, IMC_GETCONVERSIONMODE) if hime else 0
+    return ImeSnapshot.from_values(hwnd, hkl, opened, conv_mode, is_pinyin)
 
 def auto_switch_to_chinese():
     """
@@ -187,16 +324,15 @@ def auto_switch_to_chinese():
     Returns:
         bool: 是否执行了切换操作
     """
-    is_chinese, symbol_mode, lang_id, is_pinyin, hwnd = get_ime_status()
+    status = get_ime_status(fields=ALL | PINYIN_ONLY)
     
     # 检查条件：是Microsoft Pinyin且当前为英文模式
-    if is_pinyin and not is_chinese:
-        window_title = get_window_title(hwnd)
+    if status.is_pinyin and not status.is_chinese:
         print("检测到Microsoft Pinyin处于英文模式，自动切换到中文模式...")
-        print(f"窗口: {window_title}")
+        print(f"窗口: {status.title}")
         
         # 执行切换
-        success = switch_to_chinese_mode(hwnd)
+        success = switch_to_chinese_mode(status.hwnd)
         if success:
             print("✅ 已切换到中文模式")
             return True
@@ -218,20 +354,19 @@ def main():
 
     try:
         while True:
-            is_chinese, symbol_mode, lang_id, is_pinyin, hwnd = get_ime_status()
+            status = get_ime_status()
             
             # 组合当前状态字符串
-            lang_str = "中文" if is_chinese else "英文"
-            pinyin_str = " (Microsoft Pinyin)" if is_pinyin else ""
-            window_title = get_window_title(hwnd)
+            lang_str = "中文" if status.is_chinese else "英文"
+            pinyin_str = " (Microsoft Pinyin)" if status.is_pinyin else ""
             
-            status_str = f"输入模式: {lang_str}{pinyin_str} | 标点状态: {symbol_mode} | 语言ID: {hex(lang_id)}"
+            status_str = f"输入模式: {lang_str}{pinyin_str} | 标点状态: {status.symbol_mode} | 语言ID: {hex(status.lang_id)}"
             
             # 仅在状态变化时打印，避免刷屏
             if status_str != last_status_str:
                 print(f"[{time.strftime('%H:%M:%S')}] {status_str}")
-                if window_title:
-                    print(f"           窗口: {window_title}")
+                if status.title:
+                    print(f"           窗口: {status.title}")
                 last_status_str = status_str
                 
                 # 执行自动切换检查
@@ -250,31 +385,61 @@ def test_single_check():
     print("执行单次IME状态检查...")
     print("-" * 40)
     
-    is_chinese, symbol_mode, lang_id, is_pinyin, hwnd = get_ime_status()
-    window_title = get_window_title(hwnd)
+    status = get_ime_status()
     
-    print(f"窗口标题: {window_title}")
-    print(f"语言ID: 0x{lang_id:04x}")
-    print(f"是否为Microsoft Pinyin: {is_pinyin}")
-    print(f"当前输入模式: {'中文' if is_chinese else '英文'}")
-    print(f"标点状态: {symbol_mode}")
+    print(f"窗口标题: {status.title}")
+    print(f"语言ID: 0x{status.lang_id:04x}")
+    print(f"是否为Microsoft Pinyin: {status.is_pinyin}")
+    print(f"当前输入模式: {'中文' if status.is_chinese else '英文'}")
+    print(f"标点状态: {status.symbol_mode}")
     
     # 测试自动切换
-    if is_pinyin and not is_chinese:
+    if status.is_pinyin and not status.is_chinese:
         print("\n检测到Microsoft Pinyin英文模式，尝试切换...")
-        if switch_to_chinese_mode(hwnd):
+        if switch_to_chinese_mode(status.hwnd):
             print("✅ 切换成功")
             # 再次检查状态
             time.sleep(0.1)
-            is_chinese_new, symbol_mode_new, _, _, _ = get_ime_status()
-            print(f"切换后状态: {'中文' if is_chinese_new else '英文'} | {symbol_mode_new}")
+            new_status = get_ime_status()
+            print(f"切换后状态: {'中文' if new_status.is_chinese else '英文'} | {new_status.symbol_mode}")
         else:
             print("❌ 切换失败")
 
+def _benchmark(rounds=20000):
+    """
+    强制中文监视器每次检查的开销：旧的做法（查询全部状态并生成标点模式字符串和标题）
+    对比 ALL | PINYIN_ONLY 且不访问显示用属性。一半窗口为英文布局。
+    """
+    from ime_switcher.backend import SimulatedBackend, set_backend
+
+    backend = set_backend(SimulatedBackend())
+    windows = [backend.add_window(f'window {i}', layout_id='00000804' if i % 2 else '00000409') for i in range(8)]
+
+    def full():
+        status = get_ime_status()
+        return status.is_pinyin, status.is_chinese, status.symbol_mode, status.title
+
+    def monitor():
+        status = get_ime_status(fields=ALL | PINYIN_ONLY)
+        return status.is_pinyin, status.is_chinese
+
+    for name, probe in (('full + strings', full), ('monitor fields', monitor)):
+        backend.calls.clear()
+        start = time.perf_counter()
+        for i in range(rounds):
+            backend.focus(windows[i % len(windows)])
+            probe()
+        elapsed = time.perf_counter() - start
+        calls = {api: round(count / rounds, 2) for api, count in sorted(backend.calls.items())}
+        print(f'{name:15}: {elapsed / rounds * 1e6:6.2f} us/check, calls/check: {calls}')
+
+
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == "--test":
         test_single_check()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        _benchmark()
     else:
         main()
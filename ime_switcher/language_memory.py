@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+按窗口（可选按进程）记住输入语言：离开窗口时记下它的键盘布局（HKL）和拼音的中/英文模式，
+切回该窗口时恢复，不需要再按一次切换热键。
+
+由前台窗口变化事件驱动，不另开轮询。窗口销毁事件会删除对应条目，
+漏掉的销毁事件由有界 LRU 兜底：条目大小固定，条目数有上限，因此内存有上限。
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('ime_switcher')
+
+WINDOW = 'window'
+PROCESS = 'process'
+OFF = 'off'
+
+# 条目：[hkl, is_chinese]，未知的一项为 None
+_LAYOUT = 0
+_CONVERSION = 1
+
+
+class LanguageMemory:
+    """
+    Args:
+        max_windows: 按窗口记忆的条目上限
+        max_processes: 按进程记忆的条目上限
+        get_process_name: hwnd -> 可执行文件名；给出时同时按进程记忆，
+            新打开的窗口沿用同一程序上次使用的语言
+    """
+
+    def __init__(self, max_windows=512, max_processes=128, get_process_name=None):
+        self.max_windows = max_windows
+        self.max_processes = max_processes
+        self.get_process_name = get_process_name
+        self.evictions = 0
+        self.forgotten = 0
+        # hwnd -> [hkl, is_chinese, 进程名]
+        self._windows = OrderedDict()
+        # 进程名 -> [hkl, is_chinese]
+        self._processes = OrderedDict()
+
+    def remember_layout(self, hwnd, hkl):
+        self._remember(hwnd, _LAYOUT, hkl)
+
+    def remember_conversion(self, hwnd, is_chinese):
+        self._remember(hwnd, _CONVERSION, is_chinese)
+
+    def recall_layout(self, hwnd):
+        return self._recall(hwnd, _LAYOUT)
+
+    def recall_conversion(self, hwnd):
+        return self._recall(hwnd, _CONVERSION)
+
+    def forget(self, hwnd):
+        """窗口已销毁；按进程的记忆保留"""
+        if self._windows.pop(hwnd, None) is not None:
+            self.forgotten += 1
+
+    def clear(self):
+        self._windows.clear()
+        self._processes.clear()
+
+    def __len__(self):
+        return len(self._windows) + len(self._processes)
+
+    def stats(self):
+        return {
+            'windows': len(self._windows),
+            'processes': len(self._processes),
+            'evictions': self.evictions,
+            'forgotten': self.forgotten,
+        }
+
+    def _remember(self, hwnd, index, value):
+        if not hwnd or value is None:
+            return
+        entry = self._windows.get(hwnd)
+        if entry is None:
+            process = self.get_process_name(hwnd) if self.get_process_name else None
+            entry = self._windows[hwnd] = [None, None, process]
+            self._evict(self._windows, self.max_windows)
+        else:
+            self._windows.move_to_end(hwnd)
+        entry[index] = value
+        process = entry[2]
+        if process:
+            process_entry = self._processes.get(process)
+            if process_entry is None:
+                process_entry = self._processes[process] = [None, None]
+                self._evict(self._processes, self.max_processes)
+            else:
+                self._processes.move_to_end(process)
+            process_entry[index] = value
+
+    def _recall(self, hwnd, index):
+        entry = self._windows.get(hwnd)
+        if entry is not None:
+            if entry[index] is not None:
+                return entry[index]
+            process = entry[2]
+        elif self.get_process_name:
+            process = self.get_process_name(hwnd)
+        else:
+            return None
+        process_entry = self._processes.get(process) if process else None
+        return process_entry[index] if process_entry is not None else None
+
+    def _evict(self, entries, max_size):
+        while len(entries) > max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+
+def create_language_memory(scope, get_process_name=None, **kwargs):
+    """scope: WINDOW / PROCESS / OFF，OFF 时返回 None"""
+    if scope == OFF:
+        return None
+    if scope not in (WINDOW, PROCESS):
+        raise ValueError(f'Unknown language memory scope: {scope}')
+    return LanguageMemory(get_process_name=get_process_name if scope == PROCESS else None, **kwargs)
+
+
+def _benchmark(events=1_000_000, live_windows=50, destroy_miss_rate=0.2):
+    """
+    窗口不断创建、获得焦点、被销毁；其中一部分销毁事件丢失（例如监视器尚未启动），
+    验证条目数和分配的内存在数百万次事件后仍有上限。
+    """
+    import random
+    import time
+    import tracemalloc
+
+    from ime_switcher.backend import SimulatedBackend
+
+    rng = random.Random(5)
+    backend = SimulatedBackend()
+    processes = [f'app{i}.exe' for i in range(300)]
+    memory = LanguageMemory(get_process_name=lambda hwnd: processes[hwnd % len(processes)])
+    hkls = [backend.hkl(layout_id) for layout_id in ('00000409', '00000804', '00000411')]
+
+    tracemalloc.start()
+    live = []
+    next_hwnd = 1
+    restored = 0
+    start = time.perf_counter()
+    for i in range(events):
+        if len(live) < live_windows or rng.random() < 0.3:
+            live.append(next_hwnd)
+            next_hwnd += 1
+        hwnd = rng.choice(live)
+        if memory.recall_layout(hwnd) is not None:
+            restored += 1
+        memory.remember_layout(hwnd, rng.choice(hkls))
+        memory.remember_conversion(hwnd, rng.random() < 0.5)
+        if len(live) > live_windows:
+            gone = live.pop(rng.randrange(len(live)))
+            if rng.random() >= destroy_miss_rate:
+                memory.forget(gone)
+        if i in (events // 10, events - 1):
+            current, peak = tracemalloc.get_traced_memory()
+            print(f'{i + 1:>9} events: {memory.stats()}, traced {current / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB)')
+    elapsed = time.perf_counter() - start
+    tracemalloc.stop()
+    print(f'{next_hwnd - 1} windows created, {restored} restores, '
+          f'{elapsed / events * 1e6:.2f} us per focus change (with tracemalloc)')
+
+
+if __name__ == '__main__':
+    _benchmark()
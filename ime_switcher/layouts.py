@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+键盘布局句柄 (HKL) 注册表：启动时预加载一次，切换时直接复用句柄。
+
+- PlatformLayoutBackend: 平台后端的 load_keyboard_layout / get_keyboard_layout_list
+- FakeLayoutBackend: 模拟加载开销的假后端，用于在 Linux 上测试和基准测试
+
+系统布局列表变化（用户增删输入法）时，注册表会重新加载全部句柄。
+"""
+
+import logging
+import time
+
+from ime_switcher.backend import get_backend
+
+logger = logging.getLogger('ime_switcher')
+
+
+class LayoutBackend:
+    """键盘布局后端的基类"""
+    name = 'base'
+
+    def load(self, layout_id):
+        """加载布局（不激活），返回 HKL"""
+        raise NotImplementedError
+
+    def layout_list(self):
+        """返回系统当前已加载的 HKL 元组"""
+        raise NotImplementedError
+
+
+class PlatformLayoutBackend(LayoutBackend):
+    """通过平台后端加载布局（默认即 Win32 的 LoadKeyboardLayoutW / GetKeyboardLayoutList）"""
+    name = 'platform'
+
+    def __init__(self, backend=None):
+        self.backend = backend or get_backend()
+
+    def load(self, layout_id):
+        return self.backend.load_keyboard_layout(layout_id)
+
+    def layout_list(self):
+        return self.backend.get_keyboard_layout_list()
+
+
+class FakeLayoutBackend(LayoutBackend):
+    """
+    HKL 由布局 ID 推导：'00000804' -> 0x08040804。
+    load_cost 模拟 LoadKeyboardLayout 的耗时（秒）。
+    """
+    name = 'fake'
+
+    def __init__(self, layouts=('00000409', '00000804'), load_cost=0.0):
+        self.layouts = list(layouts)
+        self.load_cost = load_cost
+        self.load_count = 0
+
+    def load(self, layout_id):
+        self.load_count += 1
+        if self.load_cost:
+            time.sleep(self.load_cost)
+        if layout_id not in self.layouts:
+            self.layouts.append(layout_id)
+        return self.hkl(layout_id)
+
+    def layout_list(self):
+        return tuple(self.hkl(layout_id) for layout_id in self.layouts)
+
+    @staticmethod
+    def hkl(layout_id):
+        lang_id = int(layout_id, 16) & 0xFFFF
+        return (lang_id << 16) | lang_id
+
+
+class KeyboardLayoutRegistry:
+    """
+    布局 ID -> HKL 的缓存。
+
+    get() 通常只是一次字典查找；invalidate() 之后或距上次检查超过 check_interval 秒时，
+    会先比较系统布局列表，列表变化才重新加载全部句柄。
+    """
+
+    def __init__(self, backend, layout_ids=(), check_interval=5.0, clock=time.monotonic):
+        self.backend = backend
+        self.layout_ids = list(dict.fromkeys(layout_ids))
+        self.check_interval = check_interval
+        self.clock = clock
+        self.reload_count = 0
+        self._handles = {}
+        self._layout_list = None
+        self._checked_at = None
+
+    def preload(self):
+        """加载全部已配置的布局，并记录当前系统布局列表"""
+        self._handles = {}
+        for layout_id in self.layout_ids:
+            try:
+                self._handles[layout_id] = self.backend.load(layout_id)
+            except OSError as e:
+                logger.warning(f'Failed to preload keyboard layout {layout_id}: {e}')
+        self._layout_list = self.backend.layout_list()
+        self._checked_at = self.clock()
+        self.reload_count += 1
+
+    def get(self, layout_id):
+        """返回布局的 HKL，未加载过的布局会被加载并加入注册表"""
+        if self._checked_at is None or self.clock() - self._checked_at >= self.check_interval:
+            self.refresh()
+        hkl = self._handles.get(layout_id)
+        if hkl is None:
+            hkl = self._handles[layout_id] = self.backend.load(layout_id)
+            if layout_id not in self.layout_ids:
+                self.layout_ids.append(layout_id)
+            self._layout_list = self.backend.layout_list()
+        return hkl
+
+    def refresh(self):
+        """系统布局列表变化时重新加载"""
+        layout_list = self.backend.layout_list()
+        if layout_list != self._layout_list:
+            logger.info('Keyboard layout list changed, reloading layouts')
+            self.preload()
+        else:
+            self._checked_at = self.clock()
+
+    def invalidate(self):
+        """下次 get() 时检查系统布局列表"""
+        self._checked_at = None
+
+    def stats(self):
+        return {
+            'layouts': {layout_id: f'0x{hkl:08x}' for layout_id, hkl in self._handles.items()},
+            'reloads': self.reload_count,
+        }
+
+
+def create_layout_registry(layout_ids, backend='platform', **kwargs):
+    backends = {
+        PlatformLayoutBackend.name: PlatformLayoutBackend,
+        FakeLayoutBackend.name: FakeLayoutBackend,
+    }
+    if backend not in backends:
+        raise ValueError(f'Unknown layout backend: {backend}')
+    registry = KeyboardLayoutRegistry(backends[backend](), layout_ids, **kwargs)
+    registry.preload()
+    return registry
+
+
+if __name__ == '__main__':
+    from ime_switcher.metrics import Histogram
+
+    # 假后端：每次 LoadKeyboardLayout 模拟 2ms 开销
+    layout_ids = ('00000409', '00000804')
+    toggles = 200
+
+    backend = FakeLayoutBackend(load_cost=0.002)
+    before = Histogram('toggle_ms')
+    for i in range(toggles):
+        start = time.perf_counter()
+        backend.load(layout_ids[i % 2])
+        before.add((time.perf_counter() - start) * 1000)
+
+    backend = FakeLayoutBackend(load_cost=0.002)
+    registry = KeyboardLayoutRegistry(backend, layout_ids)
+    registry.preload()
+    after = Histogram('toggle_ms')
+    for i in range(toggles):
+        start = time.perf_counter()
+        registry.get(layout_ids[i % 2])
+        after.add((time.perf_counter() - start) * 1000)
+
+    print(f'LoadKeyboardLayout per toggle (ms): {before.summary()}')
+    print(f'registry per toggle (ms):           {after.summary()}')
+    print(f'loads: {toggles} -> {backend.load_count}, registry: {registry.stats()}')
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+"""
+非阻塞日志：事件循环线程只把 LogRecord 放进有界队列，格式化和写控制台/文件都在后台线程进行。
+
+- BoundedQueueHandler: 队列满时丢弃并计数，不阻塞调用方；恢复后补记一条丢弃数量的警告
+- DailyRotatingFileHandler: logs/<日期>.log，超过 max_bytes 滚动为 .1 .2 ...，日期变化时换新文件，
+  只保留最近 keep_days 天
+- RateLimit: 热路径日志（例如每次按键）按调用点限速，被抑制的条数附在下一条日志后
+"""
+
+import datetime
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """不在调用线程格式化，队列满时丢弃"""
+
+    def __init__(self, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record):
+        # 格式化留给写入线程；消息参数先合并，避免参数对象之后被修改
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self._unreported:
+                self.queue.put_nowait(self._dropped_record())
+                self._unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+
+    def _dropped_record(self):
+        return logging.LogRecord('ime_switcher', logging.WARNING, __file__, 0,
+                                 f'{self._unreported} log records dropped (queue full)', None, None)
+
+
+class DailyRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Args:
+        directory: 日志目录，不存在时创建
+        max_bytes: 单个文件的大小上限，超过后滚动
+        backup_count: 每天最多保留的滚动文件数
+        keep_days: 删除多少天之前的日志文件
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024, backup_count=5, keep_days=14):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep_days = keep_days
+        self._date = datetime.date.today()
+        self._next_day = self._midnight_after(self._date)
+        super().__init__(self._path(self._date), maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self._cleanup()
+
+    def shouldRollover(self, record):
+        return time.time() >= self._next_day or super().shouldRollover(record)
+
+    def doRollover(self):
+        if time.time() < self._next_day:
+            super().doRollover()
+            return
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self._date = datetime.date.today()
+        self._next_day = self._midnight_after(self._date)
+        self.baseFilename = os.path.abspath(self._path(self._date))
+        self._cleanup()
+
+    def _path(self, date):
+        return os.path.join(self.directory, f'{date.isoformat()}.log')
+
+    @staticmethod
+    def _midnight_after(date):
+        return time.mktime((date + datetime.timedelta(days=1)).timetuple())
+
+    def _cleanup(self):
+        oldest = (self._date - datetime.timedelta(days=self.keep_days)).isoformat()
+        for name in os.listdir(self.directory):
+            # <YYYY-MM-DD>.log 及其滚动文件 .log.1 ...，日期按字符串比较即可
+            if '.log' in name and name[:10] < oldest:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class RateLimit:
+    """
+    按调用点限速：
+
+        _key_log = RateLimit(logger, logging.DEBUG, 1.0)
+        suppressed = _key_log.allow()
+        if suppressed is not None:
+            logger.debug(f'key pressed: {vk}{RateLimit.suffix(suppressed)}')
+
+    allow() 在日志级别未启用或 interval 秒内已放行过时返回 None（不做任何格式化），
+    否则返回上次放行以来被抑制的次数。
+    """
+
+    def __init__(self, logger, level, interval=1.0, clock=time.monotonic):
+        self.logger = logger
+        self.level = level
+        self.interval = interval
+        self.clock = clock
+        self.suppressed = 0
+        self._next = 0.0
+
+    def allow(self):
+        if not self.logger.isEnabledFor(self.level):
+            return None
+        now = self.clock()
+        if now < self._next:
+            self.suppressed += 1
+            return None
+        self._next = now + self.interval
+        suppressed, self.suppressed = self.suppressed, 0
+        return suppressed
+
+    @staticmethod
+    def suffix(suppressed):
+        return f' ({suppressed} similar suppressed)' if suppressed else ''
+
+
+class LogPipeline:
+    """队列处理器 + 后台写入线程，stop() 时写完队列中剩余的记录"""
+
+    def __init__(self, handlers, maxsize=10000):
+        self.handler = BoundedQueueHandler(maxsize)
+        self.handlers = handlers
+        self.listener = logging.handlers.QueueListener(self.handler.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+
+    def stats(self):
+        return {'queued': self.handler.queue.qsize(), 'dropped': self.handler.dropped}
+
+
+def setup_logging(logger, log_directory=None, console=True, level=logging.DEBUG, maxsize=10000):
+    """
+    把 logger 的输出接到非阻塞管道上并启动写入线程。
+    log_directory 为 None 或无法创建时只输出到控制台；没有控制台（无窗口的打包程序）时不输出到控制台。
+    """
+    formatter = logging.Formatter(FORMAT)
+    handlers = []
+    if console:
+        handlers.append(logging.StreamHandler())
+    file_error = None
+    if log_directory is not None:
+        try:
+            handlers.append(DailyRotatingFileHandler(log_directory))
+        except OSError as e:
+            file_error = e
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.setLevel(level)
+
+    pipeline = LogPipeline(handlers, maxsize)
+    logger.setLevel(level)
+    logger.addHandler(pipeline.handler)
+    logger.propagate = False
+    pipeline.start()
+    if file_error is not None:
+        logger.warning(f'File logging disabled: {file_error}')
+    return pipeline
+
+
+def _benchmark(keys=2000, console_write_ms=0.2):
+    """
+    打字突发时事件循环线程在日志上花的时间：同步 StreamHandler、队列管道、队列管道 + 限速。
+    控制台写入用 console_write_ms 的延迟模拟（Windows 控制台每次写入通常在 0.1~1ms）。
+    """
+    import io
+    import random
+
+    from ime_switcher.metrics import Histogram
+
+    class SlowConsole(io.StringIO):
+        def write(self, s):
+            time.sleep(console_write_ms / 1000)
+            return super().write(s)
+
+    rng = random.Random(11)
+    vks = [rng.randint(0x41, 0x5A) for _ in range(keys)]
+
+    def run(name, setup, limited):
+        logger = logging.getLogger(f'ime_switcher.bench.{name}')
+        logger.handlers.clear()
+        pipeline = setup(logger)
+        key_log = RateLimit(logger, logging.DEBUG, 1.0)
+        stall = Histogram(name)
+        for i, vk in enumerate(vks):
+            start = time.perf_counter()
+            if limited:
+                suppressed = key_log.allow()
+                if suppressed is not None:
+                    logger.debug(f'key pressed: {vk}{RateLimit.suffix(suppressed)}')
+            else:
+                logger.debug(f'key pressed: {vk}')
+            if i % 100 == 0:
+                logger.info(f'window {i}: toggled to ENGLISH')
+            stall.add((time.perf_counter() - start) * 1000)
+            # 两次按键之间的间隔，写入线程在这段时间里追上
+            time.sleep(0.0005)
+        if pipeline is not None:
+            pipeline.stop()
+        print(f'{name:18} loop stall per key (ms): {stall.summary()}, total {stall.total:.1f} ms')
+        return stall.total
+
+    def sync_setup(logger):
+        handler = logging.StreamHandler(SlowConsole())
+        handler.setFormatter(logging.Formatter(FORMAT))
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        return None
+
+    def queued_setup(logger):
+        handler = logging.StreamHandler(SlowConsole())
+        pipeline = setup_logging(logger, console=False)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        pipeline.listener.handlers = (handler,)
+        return pipeline
+
+    baseline = run('sync StreamHandler', sync_setup, limited=False)
+    queued = run('queue pipeline', queued_setup, limited=False)
+    limited = run('queue + rate limit', queued_setup, limited=True)
+    print(f'loop stall saved over {keys} keys: {baseline - queued:.1f} ms (queue), '
+          f'{baseline - limited:.1f} ms (queue + rate limit)')
+
+
+if __name__ == '__main__':
+    _benchmark()
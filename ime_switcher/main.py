@@ -1,414 +1,765 @@
-import asyncio
-import contextlib
-import ctypes
-import json
-import logging
-import os
 import time
-from ctypes import wintypes
-
-import win32api
-import win32con
-import win32gui
-import win32process
-from infi.systray import SysTrayIcon
-
-from ime_switcher.shortcut import parse_shortcut
-from ime_status_detector import (
-    get_ime_status, 
-    switch_to_chinese_mode, 
-    get_window_title,
-)
-
-logger_temp = logging.getLogger('ime_switcher')
-logger_temp.info("Successfully imported ime_status_detector module")
-
-IMC_GETOPENSTATUS = 0x0005
-IMC_SETOPENSTATUS = 0x0006
-user32 = ctypes.windll.user32
-imm32 = ctypes.WinDLL('imm32', use_last_error=True)
 
-user32.GetWindowTextW.argtypes = [wintypes.HWND, wintypes.LPWSTR, ctypes.c_int]
-user32.GetWindowTextW.restype = ctypes.c_int
+_process_start = time.perf_counter()
 
+import asyncio
+import heapq
+import logging
+import os
+import sys
 
-def setup_logger():
-    logger = logging.getLogger('ime_switcher')
-    logger.setLevel(logging.DEBUG)
-
-    # log_directory = os.path.join(get_executable_directory(), 'logs')
-    # if not os.path.exists(log_directory):
-    #     os.makedirs(log_directory)
-    #
-    # current_date = datetime.now().strftime('%Y-%m-%d')
-    # log_file = os.path.join(log_directory, f'{current_date}.log')
-    # file_handler = logging.FileHandler(log_file, encoding='utf-8')
-    # file_handler.setLevel(logging.DEBUG)
-    #
-    # formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # file_handler.setFormatter(formatter)
-
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG)
+from ime_switcher.startup import StartupProfile
 
-    # logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    return logger
+startup = StartupProfile(
+    _process_start,
+    trace_imports='--startup-profile' in sys.argv or bool(os.environ.get('IME_SWITCHER_STARTUP_PROFILE')),
+)
 
+# 只导入注册热键和执行切换所需的模块；托盘、强制中文、IME 查询在热键就绪后再加载
+with startup.phase('core imports'):
+    from ime_switcher import logs, metrics, settings
+    from ime_switcher import actions
+    from ime_switcher.activity import ActivityScheduler
+    from ime_switcher.backend import get_backend
+    from ime_switcher.confirm import SwitchVerifier
+    from ime_switcher.focus_events import DESTROY, IME_CHANGE, create_focus_event_source
+    from ime_switcher.ime_status_detector import window_info_cache
+    from ime_switcher.language_memory import create_language_memory
+    from ime_switcher.layouts import create_layout_registry
+    from ime_switcher.message_pump import create_hotkey_source
+    from ime_switcher.policy import PolicyEngine
+    from ime_switcher.session import SessionState, create_session_event_source
+    from ime_switcher.shortcut import MOD_NOREPEAT, Keymap, format_shortcut
+    from ime_switcher.switcher import ENGLISH_KEYBOARD_ID, Switcher
 
-logger = setup_logger()
 
 root_dir = os.path.abspath(os.path.dirname(__file__))
 config_path = os.path.join(root_dir, './config.json')
+metrics_path = os.path.join(root_dir, 'metrics.json')
+log_directory = os.path.join(root_dir, 'logs')
 
-if os.path.exists(config_path):
-    with open(config_path) as f:
-        config = json.load(f)
-    logger.info(f'Loaded config from {config_path}')
-    logger.info(f'Config: {config}')
-else:
-    config = {
-        "temp_switch_interval": 2.0,
-        "instant_switch_interval": 0.6,
-        "secondary_keyboard_id": "00000804",
-        "force_cn_mode": True,  # 添加自动切换开关
-        "force_cn_interval": 0.2,  # 自动切换检查间隔
-        "hotkeys": {
-            "toggle": "Ctrl+\\",
-            "temp_toggle": "Ctrl+Shift+\\",
-            "instant_toggle": "Ctrl+Alt+\\"
-        }
-    }
 
-english_lang_id = '0409'
-english_keyboard_id = f'0000{english_lang_id}'
-secondary_keyboard_id = config['secondary_keyboard_id']
-assert len(secondary_keyboard_id) == 8
-secondary_lang_id = secondary_keyboard_id[4:8]
+def setup_logger():
+    # 写控制台和文件都在后台线程进行，热键处理不会被慢速控制台阻塞；无窗口的打包程序没有 stderr
+    pipeline = logs.setup_logging(logging.getLogger('ime_switcher'), log_directory, console=sys.stderr is not None)
+    return logging.getLogger('ime_switcher'), pipeline
+
+
+logger, log_pipeline = setup_logger()
+
+
+def load_config():
+    config = settings.load_config(config_path)
+    if os.path.exists(config_path):
+        logger.info(f'Loaded config from {config_path}')
+        logger.info(f'Config: {config}')
+    return config
+
+
+config = None
+layout_registry = None
+policy = None
+language_memory = None
+switcher = None
+# 确认切换已生效（verify_switches），布局切换和强制中文共用，统计按应用汇总
+switch_verifier = None
+ime_query = None
+trigger = None
+loop = None
+systray = None
+config_watcher = None
+command_bus = None
+# 强制中文监视器维护的前台窗口状态，监视器重启时沿用
+window_status = None
+# 运行中的 ForceCnMonitor，供托盘“状态”显示检查次数和间隔
+force_cn_monitor_instance = None
+# 锁屏 / 断开连接 / 睡眠 / 显示器关闭时暂停后台循环
+session_state = SessionState()
+session_source = None
+# 本地控制接口（命名管道），供脚本和编辑器插件查询和切换
+control_server = None
+
+
+def get_layout_ids(config):
+    return [ENGLISH_KEYBOARD_ID, config['secondary_keyboard_id'], *config.get('preload_keyboard_ids', []),
+            *policy.layout_ids()]
+
+
+def resolve_rule_layout(layout):
+    """规则中的 english / secondary 换成布局 ID"""
+    if layout == 'english':
+        return ENGLISH_KEYBOARD_ID
+    if layout == 'secondary':
+        return config['secondary_keyboard_id']
+    return layout
+
+
+def create_policy():
+    engine = PolicyEngine(config.get('rules', []), resolve_rule_layout)
+    if engine.has_rules:
+        logger.info(f'Compiled {len(engine.compiled.rules)} rules in {engine.compile_ms:.1f} ms')
+    return engine
+
+
+def create_switcher():
+    return Switcher(config['secondary_keyboard_id'], layout_registry, window_info_cache,
+                    policy=policy, memory=language_memory, verifier=create_switch_verifier())
+
+
+def create_switch_verifier():
+    """verify_switches 关闭时返回 None；打开时沿用已有的确认器，保留统计"""
+    global switch_verifier
+    if not config.get('verify_switches', True):
+        switch_verifier = None
+    elif switch_verifier is None:
+        switch_verifier = SwitchVerifier(get_app=get_backend().get_process_name)
+    return switch_verifier
+
+
+def setup_switcher():
+    """热键就绪前必须完成的初始化：键盘布局预加载和切换引擎"""
+    global layout_registry, policy, language_memory, switcher
+    window_info_cache.ttl = config.get('window_info_cache_ttl', 1.0)
+    metrics.enabled = config.get('metrics_enabled', True)
+
+    policy = create_policy()
+    language_memory = create_language_memory(config.get('remember_language', 'window'),
+                                             get_backend().get_process_name)
+    # 启动时预加载一次键盘布局，切换时复用 HKL
+    layout_registry = create_layout_registry(get_layout_ids(config))
+    switcher = create_switcher()
+
+
+def force_cn_wanted():
+    """强制中文关闭时，只要有规则或语言记忆也需要运行监控（按窗口切换输入模式和布局）"""
+    return config.get('force_cn_mode', True) or policy.has_rules or language_memory is not None
+
+
+def get_ime_query():
+    """首次使用时创建 IME 查询线程池"""
+    global ime_query
+    if ime_query is None:
+        from ime_switcher import ime_status_detector
+        from ime_switcher.ime_query import ImeQueryExecutor
+
+        # IME 查询在线程池中执行，挂起的前台窗口不会阻塞事件循环
+        ime_query_timeout = config.get('ime_query_timeout', 0.5)
+        ime_status_detector.ime_query_timeout_ms = int(ime_query_timeout * 1000)
+        ime_query = ImeQueryExecutor(
+            get_backend().get_foreground_window,
+            ime_status_detector.get_ime_status,
+            ime_status_detector.switch_to_chinese_mode,
+            timeout=ime_query_timeout,
+        )
+    return ime_query
+
+
+def invalidate_window_info(event, hwnd, timestamp):
+    if event == DESTROY:
+        # 句柄可能被新窗口复用，删除按窗口缓存和记忆的一切
+        policy.invalidate(hwnd)
+        if language_memory is not None:
+            language_memory.forget(hwnd)
+    # IME 事件的 hwnd 通常是 IME 窗口本身，无法对应到前台窗口，因此清空全部缓存
+    window_info_cache.invalidate(None if event == IME_CHANGE else hwnd)
+    if event == IME_CHANGE:
+        # 输入法增删后系统布局列表可能变化
+        layout_registry.invalidate()
 
 
-def get_window_langid(hwnd):
+async def force_cn_monitor():
     """
-    Returns the LANGID of the currently active window.
+    自动切换监控任务：当检测到Microsoft Pinyin输入法且为英文模式时，自动切换到中文模式
     """
-    thread_id = win32process.GetWindowThreadProcessId(hwnd)[0]
-    hkl = user32.GetKeyboardLayout(thread_id)
-    # Extract the LANGID from the HKL (keyboard layout handle)
-    langid = format(hkl & 0x0000FFFF, '04x')
-    return langid
-
+    if not force_cn_wanted():
+        logger.info("Force CN mode is disabled in config")
+        return
 
-def get_front_window():
-    hwnd = win32gui.GetForegroundWindow()
-    return win32gui.GetAncestor(hwnd, win32con.GA_ROOTOWNER)
+    from ime_switcher import force_cn, ime_status_detector
+    from ime_switcher.policy import CHINESE, OFF
+
+    global window_status, force_cn_monitor_instance
+    if window_status is None:
+        window_status = force_cn.WindowStatus()
+    query = get_ime_query()
+    mode = config.get('force_cn_trigger', force_cn.EVENT)
+    event_source = None
+    if mode == force_cn.EVENT:
+        try:
+            event_source = create_focus_event_source()
+            event_source.start(asyncio.get_running_loop())
+            event_source.add_listener(invalidate_window_info)
+            if switch_verifier is not None:
+                # IME 变化事件到达时立即确认，不等下一个探测时间点
+                event_source.add_listener(switch_verifier.on_event)
+        except OSError as e:
+            logger.warning(f'Focus events unavailable ({e}), falling back to polling')
+            mode = force_cn.POLLING
+
+    monitor = force_cn.ForceCnMonitor(
+        # 监视器只处理拼音窗口，其他窗口不发送 IME 查询
+        lambda hwnd=None: query.get_status(hwnd, ime_status_detector.ALL | ime_status_detector.PINYIN_ONLY),
+        query.switch, switcher.get_window_title,
+        interval=config.get('force_cn_interval', 0.2),
+        mode=mode,
+        event_source=event_source,
+        fallback_interval=config.get('force_cn_fallback_interval', 1.0),
+        policy=policy,
+        switch_english=lambda hwnd: query.run(hwnd, ime_status_detector.switch_to_english_mode, hwnd),
+        default_conversion=CHINESE if config.get('force_cn_mode', True) else OFF,
+        on_window_change=lambda hwnd: switcher.on_window_change(hwnd),
+        memory=language_memory,
+        status=window_status,
+        max_interval=config.get('force_cn_max_interval', 3.0),
+        get_idle_time=get_backend().get_idle_time,
+        session=session_state,
+        verifier=switch_verifier,
+    )
+    force_cn_monitor_instance = monitor
+    try:
+        await monitor.run()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Force CN mode monitor error: {e}")
+    finally:
+        if event_source:
+            event_source.stop()
 
 
-def get_front_window_langid():
-    hwnd = get_front_window()
-    return get_window_langid(hwnd)
+class HotKeyTrigger:
+    # config['hotkeys'] 中可绑定的目标
+    hotkey_targets = actions.HOTKEY_TARGETS
+    # 临时切换 -> 切回前的不活动间隔所用的配置项
+    temp_intervals = {
+        actions.TEMP_TOGGLE: 'temp_switch_interval',
+        actions.INSTANT_TOGGLE: 'instant_switch_interval',
+    }
 
+    def __init__(self, hotkey_source='win32'):
+        self.force_cn_task = None
+        self.activity_scheduler = None
+        self.actions = None
+        # 热键来源的类型，模拟器中为 simulated
+        self.hotkey_source_kind = hotkey_source
+        self.hotkey_source = None
+        self.keymap = None
+        # 组合键 (modifiers, vk) <-> 热键 id，WM_HOTKEY 按 id 查表分派；
+        # 组合键仍在 keymap 中时 id 不变，重载后不再使用的 id 回收复用（RegisterHotKey 只接受 0~0xBFFF）
+        self.step_ids = {}
+        self.id_steps = {}
+        self._free_ids = []
+        # 一直注册的组合键（各序列的第一步）
+        self.registered_steps = set()
+        # 序列进行中临时注册的组合键
+        self._chord_steps = set()
+        self._chord_timer = None
+        # 尚未完成的序列组合键注册/注销任务
+        self._chord_tasks = set()
+
+    def create_keymap(self, hotkeys):
+        bindings = {target: hotkeys[target] for target in self.hotkey_targets if target in hotkeys}
+        return Keymap(bindings, config.get('chord_timeout', 1.0))
+
+    def process_hotkey(self, hotkey_id, timestamp):
+        step = self.id_steps.get(hotkey_id)
+        if step is None:
+            return
+        target = self.keymap.feed(step, timestamp)
+        self.update_chord()
+        if target is None:
+            return
+        # 从收到 WM_HOTKEY 到 PostMessage 切换输入语言；临时切换的任务继承此跨度
+        span_name = 'temp_toggle_to_switch_ms' if target in self.temp_intervals else 'hotkey_to_switch_ms'
+        with metrics.span(span_name, timestamp):
+            self.dispatch_hotkey(target, timestamp)
+
+    def dispatch_hotkey(self, target, timestamp=None):
+        """返回 False 表示作为自动重复被丢弃"""
+        # 连按/按住的热键在动作队列中去抖、合并；临时切换由队列串行化
+        interval = config[self.temp_intervals[target]] if target in self.temp_intervals else None
+        return self.actions.press(target, timestamp, interval)
 
-def set_input_language_for_window(hwnd, keyboard_layout_id: str):
-    """
-    Set the input language for the currently active window.
-    input_language should be a string representing the LANGID of the layout to load, e.g., '00000409' for English (US).
-    """
-    # thread_id = win32process.GetWindowThreadProcessId(hwnd)[0]
-    # Load and activate the specified keyboard layout for the window's thread.
-    locale_id = win32api.LoadKeyboardLayout(keyboard_layout_id, win32con.KLF_ACTIVATE)
-    # Post a message to the window to change its input language.
-    win32api.PostMessage(hwnd, win32con.WM_INPUTLANGCHANGEREQUEST, 0, locale_id)
+    async def listen_hotkey(self):
+        self.actions = actions.HotkeyActions(asyncio.get_running_loop(), switcher, self.activity_scheduler)
+        # 热键消息由专用线程阻塞接收，再线程安全地交给事件循环
+        self.hotkey_source = create_hotkey_source(self.hotkey_source_kind)
+        self.hotkey_source.start(asyncio.get_running_loop(), self.process_hotkey)
+
+        self.keymap = self.create_keymap(config['hotkeys'])
+        for step in self.keymap.first_steps():
+            await self.register_step(step)
+
+    def step_id(self, step):
+        hotkey_id = self.step_ids.get(step)
+        if hotkey_id is None:
+            # 没有回收的 id 时，已分配的 id 恰好是 1..len
+            hotkey_id = heapq.heappop(self._free_ids) if self._free_ids else len(self.step_ids) + 1
+            self.step_ids[step] = hotkey_id
+            self.id_steps[hotkey_id] = step
+        return hotkey_id
+
+    def release_unused_ids(self):
+        """回收不在当前 keymap 中的组合键的 id；调用时这些组合键必须都已注销"""
+        for step in set(self.step_ids) - self.keymap.all_steps():
+            hotkey_id = self.step_ids.pop(step)
+            del self.id_steps[hotkey_id]
+            heapq.heappush(self._free_ids, hotkey_id)
+
+    async def register_step(self, step, chord=False):
+        hotkey_id = self.step_id(step)
+        modifiers, vk = step
+        hotkey = format_shortcut(modifiers, vk)
+        if not await self.hotkey_source.register_hotkey(hotkey_id, modifiers | MOD_NOREPEAT, vk):
+            logger.info(f"Failed to register global hotkey: ID {hotkey_id}, hotkey {hotkey}")
+            return False
+        if chord:
+            logger.debug(f"Chord step registered: ID {hotkey_id}, hotkey {hotkey}")
+        else:
+            target = self.keymap.root.get(step)
+            logger.info(f"Global hotkey registered: ID {hotkey_id}, hotkey {hotkey}, "
+                        f"target {target if isinstance(target, str) else 'key sequence'}")
+            self.registered_steps.add(step)
+        return True
+
+    async def unregister_step(self, step):
+        await self.hotkey_source.unregister_hotkey(self.step_ids[step])
+        self.registered_steps.discard(step)
+
+    async def update_hotkeys(self, hotkeys):
+        """
+        重新编译 keymap，只注册/注销发生变化的组合键。
+        新组合键被其他程序占用时撤销本次修改，继续使用旧的热键。
+        """
+        keymap = self.create_keymap(hotkeys)
+        self.end_chord()
+        # 等序列的组合键全部注销后才能回收它们的 id
+        await asyncio.gather(*self._chord_tasks)
+        wanted = keymap.first_steps()
+        old_keymap, self.keymap = self.keymap, keymap
+        added = []
+        for step in wanted - self.registered_steps:
+            if not await self.register_step(step):
+                for registered in added:
+                    await self.unregister_step(registered)
+                self.keymap = old_keymap
+                self.release_unused_ids()
+                logger.warning("Hotkeys not changed: a new shortcut is in use by another program")
+                return
+            added.append(step)
+        for step in self.registered_steps - wanted:
+            await self.unregister_step(step)
+        self.release_unused_ids()
+
+    def update_chord(self):
+        """序列进行中时临时注册下一步可按的组合键，超时或结束后注销"""
+        if self._chord_timer is not None:
+            self._chord_timer.cancel()
+            self._chord_timer = None
+        loop = asyncio.get_running_loop()
+        if self.keymap.pending:
+            self._chord_timer = loop.call_later(self.keymap.chord_timeout, self.expire_chord)
+        wanted = self.keymap.pending_steps() - self.registered_steps
+        if wanted != self._chord_steps:
+            removed, added = self._chord_steps - wanted, wanted - self._chord_steps
+            self._chord_steps = wanted
+            # 注册/注销在消息线程上按提交顺序执行
+            task = loop.create_task(self._swap_chord_steps(removed, added))
+            self._chord_tasks.add(task)
+            task.add_done_callback(self._chord_tasks.discard)
+
+    def expire_chord(self):
+        self._chord_timer = None
+        self.keymap.expire()
+        self.update_chord()
+
+    def end_chord(self):
+        self.keymap.reset()
+        self.update_chord()
+
+    async def _swap_chord_steps(self, removed, added):
+        for step in removed:
+            await self.hotkey_source.unregister_hotkey(self.step_ids[step])
+        for step in added:
+            await self.register_step(step, chord=True)
+
+    def create_activity_scheduler(self, loop):
+        self.activity_scheduler = ActivityScheduler(loop, config.get('activity_source', 'hook'), session_state)
+        if self.actions is not None:
+            self.actions.activity_scheduler = self.activity_scheduler
 
+    async def cleanup(self):
+        """清理资源"""
+        if self.actions is not None:
+            self.actions.cancel_temp()
+        if self._chord_timer is not None:
+            self._chord_timer.cancel()
+        if self.activity_scheduler and self.activity_scheduler.is_armed:
+            self.activity_scheduler.source.stop()
+        if self.hotkey_source:
+            self.hotkey_source.stop()
+        await self.stop_force_cn()
+
+    async def stop_force_cn(self):
+        if self.force_cn_task and not self.force_cn_task.done():
+            self.force_cn_task.cancel()
+            try:
+                await self.force_cn_task
+            except asyncio.CancelledError:
+                pass
+            logger.info("Force CN mode task cancelled")
 
-def on_toggle():
-    hwnd = get_front_window()
-    title = get_window_title(hwnd) or '[Unknown]'
-    lang_id = get_window_langid(hwnd)
-    if lang_id == secondary_lang_id:
-        set_input_language_for_window(hwnd, english_keyboard_id)
-        logger.info(f'{title}: toggled to ENGLISH')
-    else:
-        set_input_language_for_window(hwnd, secondary_keyboard_id)
-        logger.info(f'{title}: toggled to secondary keyboard')
 
+# 监视器创建时取得 policy 和 switcher，改变它们的配置项也需要重启监视器
+_force_cn_keys = {
+    'force_cn_mode', 'force_cn_interval', 'force_cn_trigger', 'force_cn_fallback_interval', 'force_cn_max_interval',
+    'rules', 'secondary_keyboard_id', 'remember_language', 'verify_switches',
+}
+_config_lock = None
 
-def on_switch_english():
-    hwnd = get_front_window()
-    title = get_window_title(hwnd) or '[Unknown]'
-    set_input_language_for_window(hwnd, english_keyboard_id)
-    logger.info(f'{title}: switched to ENGLISH')
 
+async def apply_config(new_config):
+    """
+    应用已校验的新配置，只改动变化的部分。
 
-def on_switch_secondary():
-    hwnd = get_front_window()
-    title = get_window_title(hwnd) or '[Unknown]'
-    set_input_language_for_window(hwnd, secondary_keyboard_id)
-    logger.info(f'{title}: switched to secondary keyboard')
+    正在等待切回的临时切换持有旧的 Switcher 和 ActivityScheduler，会按旧配置完成；
+    之后的热键使用新的对象。
+    """
+    global config, policy, language_memory, switcher, _config_lock
+    if _config_lock is None:
+        _config_lock = asyncio.Lock()
+    async with _config_lock:
+        old_config = config
+        changed = settings.diff_config(old_config, new_config)
+        if not changed:
+            return
+        logger.info(f"Config changed: {sorted(changed)}")
+        # 间隔类配置在每次热键时读取，替换字典即生效
+        config = new_config
+
+        if 'window_info_cache_ttl' in changed:
+            window_info_cache.ttl = config.get('window_info_cache_ttl', 1.0)
+        if 'metrics_enabled' in changed:
+            metrics.enabled = config.get('metrics_enabled', True)
+        if 'ime_query_timeout' in changed and ime_query is not None:
+            from ime_switcher import ime_status_detector
+
+            ime_query.timeout = config.get('ime_query_timeout', 0.5)
+            ime_status_detector.ime_query_timeout_ms = int(ime_query.timeout * 1000)
+
+        if changed & {'secondary_keyboard_id', 'rules'}:
+            # 规则中的 secondary 依赖 secondary_keyboard_id，一起重新编译
+            policy = create_policy()
+        if 'remember_language' in changed:
+            language_memory = create_language_memory(config.get('remember_language', 'window'),
+                                                     get_backend().get_process_name)
+        if changed & {'secondary_keyboard_id', 'preload_keyboard_ids', 'rules'}:
+            layout_registry.layout_ids = list(dict.fromkeys(get_layout_ids(config)))
+            layout_registry.preload()
+        if changed & {'secondary_keyboard_id', 'preload_keyboard_ids', 'rules', 'remember_language', 'verify_switches'}:
+            switcher = create_switcher()
+            trigger.actions.switcher = switcher
+
+        if 'activity_source' in changed:
+            trigger.create_activity_scheduler(loop)
+        if 'session_events' in changed:
+            start_session_events()
+        if 'control_api' in changed:
+            await start_control_server()
+
+        if changed & {'hotkeys', 'chord_timeout'}:
+            await trigger.update_hotkeys(config['hotkeys'])
+
+        if changed & _force_cn_keys:
+            await trigger.stop_force_cn()
+            if force_cn_wanted():
+                trigger.force_cn_task = loop.create_task(force_cn_monitor())
+                logger.info("Force CN monitor task restarted")
+
+
+def start_config_watcher(kind=None, fs=None):
+    """kind 默认取自配置；fs 为 settings.FileSystem，模拟器中传入 MemoryFileSystem"""
+    global config_watcher
+    kind = kind or config.get('config_watcher', 'win32')
+    if kind == 'off':
+        return
 
+    def on_change(new_config):
+        loop.create_task(apply_config(new_config))
 
-last_key_press_time: float = None
-is_during_temp_toggling = False
+    polling = {'interval': config.get('config_poll_interval', 1.0), 'session': session_state}
+    try:
+        config_watcher = settings.create_config_watcher(kind, config_path, on_change, fs=fs,
+                                                        **(polling if kind == 'polling' else {}))
+        config_watcher.start(loop)
+    except OSError as e:
+        logger.warning(f'Config change notifications unavailable ({e}), falling back to polling')
+        config_watcher = settings.PollingConfigWatcher(config_path, on_change, fs=fs, **polling)
+        config_watcher.start(loop)
+
+
+def on_session_change(active, reason):
+    """会话恢复：暂停期间窗口可能已关闭或变化（远程重连后尤其如此），清空按窗口的缓存"""
+    if not active:
+        return
+    window_info_cache.invalidate()
+    policy.invalidate()
+    layout_registry.invalidate()
+
+
+def start_session_events():
+    """订阅锁屏、远程断开、睡眠和显示器状态；配置修改时重新订阅"""
+    global session_source
+    if session_source is not None:
+        session_source.stop()
+        session_source = None
+    kind = config.get('session_events', 'win32')
+    if kind == 'off':
+        # 不再收到恢复事件，不能停在暂停状态
+        session_state.reset()
+        return
+    source = create_session_event_source(kind)
+    source.add_listener(session_state.on_event)
+    try:
+        source.start(loop)
+    except OSError as e:
+        logger.warning(f'Session notifications unavailable ({e}), background tasks keep running while locked')
+        return
+    session_source = source
 
 
-@contextlib.contextmanager
-def during_temp_toggling():
-    global is_during_temp_toggling
+async def start_control_server():
+    """启动本地控制接口；配置修改时重新启动"""
+    global control_server
+    if control_server is not None:
+        control_server.stop()
+        control_server = None
+    kind = config.get('control_api', 'pipe')
+    if kind == 'off':
+        return
+    from ime_switcher.control import create_control_server
+
+    server = create_control_server(kind)
+    server.register('status', control_status)
+    server.register('toggle', lambda: control_press(actions.TOGGLE))
+    server.register('switch', control_switch)
+    server.register('temp_toggle', lambda: control_press(actions.TEMP_TOGGLE))
+    server.register('metrics', control_metrics)
     try:
-        is_during_temp_toggling = True
-        yield
-    finally:
-        is_during_temp_toggling = False
+        await server.start(loop)
+    except OSError as e:
+        logger.warning(f'Control API unavailable ({e})')
+        return
+    control_server = server
+    logger.info(f'Control API listening on {server.address}')
+
+
+def monitored_status():
+    """强制中文监视器运行时返回它维护的 WindowStatus，否则返回 None"""
+    monitor_running = trigger.force_cn_task is not None and not trigger.force_cn_task.done()
+    if monitor_running and window_status is not None and window_status.snapshot is not None:
+        return window_status
+    return None
+
+
+async def query_window_status():
+    """查询一次前台窗口"""
+    from ime_switcher.force_cn import WindowStatus
+
+    status = WindowStatus()
+    status.update(await get_ime_query().get_status())
+    return status
+
+
+def describe_status(status):
+    snapshot = status.snapshot
+    return {
+        'hwnd': snapshot.hwnd,
+        'title': snapshot.title,
+        'lang_id': f'{snapshot.lang_id:04x}',
+        'pinyin': snapshot.is_pinyin,
+        'chinese': snapshot.is_chinese,
+        'symbol_mode': snapshot.symbol_mode,
+        'age': round(status.age(), 3),
+        'force_cn_mode': config.get('force_cn_mode', True),
+        'temp_toggling': trigger.actions.is_temp_toggling,
+        'session_active': session_state.active,
+    }
 
 
-async def on_temp_toggle(key_press_interval: float):
-    if is_during_temp_toggling:
-        return
+def control_status():
+    """控制接口的 status：监视器运行时直接读取快照，否则查询一次"""
+    status = monitored_status()
+    if status is not None:
+        return describe_status(status)
 
-    with during_temp_toggling():
-        # for Chinese, there's a time to select the Chinese character
-        is_switching_to_chinese = get_front_window_langid() == english_lang_id and secondary_lang_id == '0804'
-        if is_switching_to_chinese:
-            key_press_interval = max(key_press_interval, 2)
+    async def query():
+        return describe_status(await query_window_status())
+    return query()
 
-        await asyncio.sleep(0.2)
-        on_toggle()
 
-        logger.info(f'Switching back in when key is inactive for {key_press_interval}...')
+def control_press(target):
+    """与热键走同一路径（去抖、合并、临时切换的串行化）"""
+    return {'accepted': trigger.dispatch_hotkey(target)}
 
-        global last_key_press_time
-        last_key_press_time = None
-        while True:
-            await asyncio.sleep(0.1)
-            logger.debug('checking key activity...')
-            if last_key_press_time and time.time() - last_key_press_time > key_press_interval:
-                break
-        on_toggle()
 
+def control_switch(layout):
+    if layout not in (actions.ENGLISH, actions.SECONDARY):
+        raise ValueError(f'layout must be {actions.ENGLISH} or {actions.SECONDARY}, got {layout!r}')
+    return control_press(layout)
 
-async def force_cn_monitor():
-    """
-    自动切换监控任务：当检测到Microsoft Pinyin输入法且为英文模式时，自动切换到中文模式
-    """
-    if not config.get('force_cn_mode', True):
-        logger.info("Force CN mode is disabled in config")
-        return
-    
-    logger.info("Force CN mode monitor started")
-    interval = config.get('force_cn_interval', 0.2)
-    last_status = None
-    
-    try:
-        while True:
-            try:
-                # 获取当前IME状态
-                is_chinese, symbol_mode, lang_id, is_pinyin, hwnd = get_ime_status()
-                
-                # 检查是否需要自动切换
-                if is_pinyin and not is_chinese:
-                    current_status = (is_pinyin, is_chinese, hwnd)
-                    
-                    # 避免频繁切换，只在状态变化时执行
-                    if current_status != last_status:
-                        window_title = get_window_title(hwnd)
-                        logger.info("Force CN triggered: Microsoft Pinyin detected in English mode")
-                        logger.info(f"Window: {window_title}")
-                        
-                        # 执行自动切换
-                        success = switch_to_chinese_mode(hwnd)
-                        if success:
-                            logger.info("✅ Auto switched to Chinese mode successfully")
-                        else:
-                            logger.warning("❌ Force CN failed")
-                        
-                        last_status = current_status
-                
-                # 如果状态变化但不需要切换，也更新last_status
-                current_status = (is_pinyin, is_chinese, hwnd)
-                if current_status != last_status:
-                    last_status = current_status
-                
-            except Exception as e:
-                logger.error(f"Error in force CN monitor: {e}")
-                await asyncio.sleep(interval * 2)  # 出错时等待更长时间
-                continue
-            
-            await asyncio.sleep(interval)
-            
-    except asyncio.CancelledError:
-        logger.info("Force CN mode monitor cancelled")
-        raise
-    except Exception as e:
-        logger.error(f"Force CN mode monitor error: {e}")
 
+def control_metrics():
+    if not metrics.enabled:
+        raise ValueError('metrics are disabled in config')
+    return metrics.snapshot()
 
-class HotKeyTrigger:
-    def __init__(self):
-        self.force_cn_task = None
-    
-    def register_hotkey(self, hwnd, id, modifiers, vk):
-        prototype = ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.wintypes.HWND, ctypes.c_int, ctypes.c_uint, ctypes.c_uint)
-        paramflags = (1, "hWnd", 0), (1, "id", 0), (1, "fsModifiers", 0), (1, "vk", 0)
-        RegisterHotKey = prototype(("RegisterHotKey", user32), paramflags)
-
-        return RegisterHotKey(hWnd=hwnd, id=id, fsModifiers=modifiers, vk=vk)
-
-    def unregister_hotkey(self, hwnd, id):
-        prototype = ctypes.WINFUNCTYPE(ctypes.c_bool, ctypes.wintypes.HWND, ctypes.c_int)
-        paramflags = (1, "hWnd", 0), (1, "id", 0)
-        UnregisterHotKey = prototype(("UnregisterHotKey", user32), paramflags)
-
-        return UnregisterHotKey(hWnd=hwnd, id=id)
-
-    def create_window(self):
-        wc = win32gui.WNDCLASS()
-        wc.lpfnWndProc = self.process_message
-        wc.lpszClassName = "GlobalHotkeyWindow"
-        hinst = win32gui.GetModuleHandle(None)
-        wc.hInstance = hinst
-        class_atom = win32gui.RegisterClass(wc)
-        return win32gui.CreateWindow(class_atom, "Global Hotkey Window", 0, 0, 0, 0, 0, 0, 0, hinst, None)
-
-    def process_message(self, hwnd, msg, wparam, lparam):
-        if msg == win32con.WM_HOTKEY:
-            hotkey_id = wparam
-            if hotkey_id == 1:
-                on_toggle()
-            elif hotkey_id == 2:
-                asyncio.create_task(on_temp_toggle(key_press_interval=config['temp_switch_interval']))
-            elif hotkey_id == 3:
-                asyncio.create_task(on_temp_toggle(key_press_interval=config['instant_switch_interval']))
-            elif hotkey_id == 4:
-                on_switch_english()
-            elif hotkey_id == 5:
-                on_switch_secondary()
-        return win32gui.DefWindowProc(hwnd, msg, wparam, lparam)
 
-    async def listen_hotkey(self):
-        self.hwnd = self.create_window()
-
-        # Register multiple global hotkeys
-        hotkeys = [
-            (1, 'toggle'),
-            (2, 'temp_toggle'),
-            (3, 'instant_toggle'),
-            (4, 'english'),
-            (5, 'secondary'),
-        ]
-
-        registered_hotkeys = []
-        for id, target in hotkeys:
-            hotkey = config['hotkeys'].get(target)
-            if hotkey is None:
-                continue
-
-            modifiers, vk = parse_shortcut(hotkey)
-            if vk is None:
-                continue
-
-            if self.register_hotkey(self.hwnd, id, modifiers, vk):
-                logger.info(f"Global hotkey registered: ID {id}, hotkey {hotkey}, target {target}")
-                registered_hotkeys.append(id)
-            else:
-                logger.info(f"Failed to register global hotkey: ID {id}, hotkey {hotkey}, target {target}")
-
-        # Message loop
-        while True:
-            await asyncio.sleep(0.05)
-            win32gui.PumpWaitingMessages()
-
-    async def do_key_check(self):
-        while True:
-            for vk in range(256):
-                if win32api.GetAsyncKeyState(vk) & 0x0001:  # Key was pressed since last call
-                    logger.info(f'key pressed: {vk}')
-                    global last_key_press_time
-                    last_key_press_time = time.time()
-                    break
-            await asyncio.sleep(0.05)
+def create_command_bus():
+    """托盘线程上的菜单操作经命令总线在事件循环上执行"""
+    from ime_switcher.commands import CommandBus
 
-    async def cleanup(self):
-        """清理资源"""
-        if self.force_cn_task and not self.force_cn_task.done():
-            self.force_cn_task.cancel()
-            try:
-                await self.force_cn_task
-            except asyncio.CancelledError:
-                pass
-            logger.info("Force CN mode task cancelled")
+    bus = CommandBus(loop)
+    bus.register('toggle_force_cn_mode', toggle_force_cn_mode)
+    bus.register('show_status', show_status)
+    bus.register('show_metrics', show_metrics)
+    return bus
 
 
 def create_systray_menu():
     """创建系统托盘菜单"""
     menu_options = (
-        ("Toggle Force CN Mode", None, toggle_force_cn_mode),
-        ("Status", None, show_status),
+        ("Toggle Force CN Mode", None, command_bus.menu_action('toggle_force_cn_mode')),
+        ("Status", None, command_bus.menu_action('show_status')),
+        ("Metrics", None, command_bus.menu_action('show_metrics')),
     )
     return menu_options
 
 
-def toggle_force_cn_mode(_):
-    """切换自动切换功能"""
-    global trigger
-    current_state = config.get('force_cn_mode', True)
-    config['force_cn_mode'] = not current_state
-    
-    if config['force_cn_mode']:
-        logger.info("Force CN mode enabled")
-        # 重启自动切换任务
-        if trigger.force_cn_task is None or trigger.force_cn_task.done():
+async def toggle_force_cn_mode():
+    """切换自动切换功能（只修改运行中的配置）"""
+    new_config = dict(config)
+    new_config['force_cn_mode'] = not config.get('force_cn_mode', True)
+    logger.info(f"Force CN mode {'enabled' if new_config['force_cn_mode'] else 'disabled'}")
+    # 与配置文件重新加载走同一路径：按规则/语言记忆是否仍需要来决定监视器的启停
+    await apply_config(new_config)
+
+
+async def show_status():
+    """显示当前状态：监视器运行时读取它维护的窗口状态，否则查询一次"""
+    status = monitored_status() or await query_window_status()
+    monitor_running = trigger.force_cn_task is not None and not trigger.force_cn_task.done()
+    snapshot = status.snapshot
+    logger.info("Current Status:")
+    logger.info(f"  Window: {snapshot.title} (checked {status.age():.1f}s ago)")
+    logger.info(f"  Language ID: 0x{snapshot.lang_id:04x}")
+    logger.info(f"  Microsoft Pinyin: {snapshot.is_pinyin}")
+    logger.info(f"  Chinese Mode: {snapshot.is_chinese}")
+    logger.info(f"  Symbol Mode: {snapshot.symbol_mode}")
+    logger.info(f"  Force CN Mode: {config.get('force_cn_mode', True)}")
+    if monitor_running and force_cn_monitor_instance is not None:
+        logger.info(f"  Force CN Monitor: {force_cn_monitor_instance.stats()}")
+    logger.info(f"  Key Activity Sampling: {trigger.activity_scheduler.stats()}")
+    logger.info(f"  Hotkeys: {trigger.actions.stats()}, {trigger.keymap.stats()}")
+    logger.info(f"  Window Info Cache: {window_info_cache.stats()}")
+    logger.info(f"  IME Query: {get_ime_query().stats()}")
+    logger.info(f"  Keyboard Layouts: {layout_registry.stats()}")
+    logger.info(f"  Rules: {policy.stats()}")
+    if language_memory is not None:
+        logger.info(f"  Language Memory: {language_memory.stats()}")
+    logger.info(f"  Startup: {startup.summary()}")
+    if config_watcher is not None:
+        logger.info(f"  Config Watcher: {config_watcher.stats()}")
+    logger.info(f"  Logging: {log_pipeline.stats()}")
+    logger.info(f"  Commands: {command_bus.stats()}")
+    logger.info(f"  Session: {session_state.stats()}")
+    if switch_verifier is not None:
+        logger.info(f"  Switch Confirmation: {switch_verifier.stats()}")
+        logger.info(f"  Switch Success by App: {switch_verifier.app_stats()}")
+    if control_server is not None:
+        logger.info(f"  Control API: {control_server.stats()}")
+
+
+def show_metrics():
+    """输出延迟直方图和 Win32 调用计数，并写入 metrics.json"""
+    if not metrics.enabled:
+        logger.info("Metrics are disabled in config")
+        return
+    snapshot = metrics.snapshot()
+    logger.info("Metrics:")
+    for name, summary in snapshot['histograms'].items():
+        logger.info(f"  {name}: {summary}")
+    for name, count in sorted(snapshot['counters'].items()):
+        logger.info(f"  {name}: {count}")
+    metrics.dump(metrics_path)
+    logger.info(f"Metrics written to {metrics_path}")
+
+
+def start_deferred():
+    """热键就绪后再加载托盘和强制中文监控"""
+    global systray, command_bus
+    with startup.phase('tray'):
+        from infi.systray import SysTrayIcon
+
+        command_bus = create_command_bus()
+        systray = SysTrayIcon("icon.ico", "IME Switcher",
+                              menu_options=create_systray_menu(),
+                              on_quit=lambda _: os._exit(1))
+        systray.start()
+
+    with startup.phase('session events'):
+        session_state.add_listener(on_session_change)
+        start_session_events()
+
+    # 启动自动切换监控任务
+    with startup.phase('force cn'):
+        if force_cn_wanted():
             trigger.force_cn_task = loop.create_task(force_cn_monitor())
-    else:
-        logger.info("Force CN mode disabled")
-        # 停止自动切换任务
-        if trigger.force_cn_task:
-            trigger.force_cn_task.cancel()
-
+            logger.info("Force CN monitor task started")
 
-def show_status(_):
-    """显示当前状态"""
-    try:
-        is_chinese, symbol_mode, lang_id, is_pinyin, hwnd = get_ime_status()
-        window_title = get_window_title(hwnd)
-        logger.info("Current Status:")
-        logger.info(f"  Window: {window_title}")
-        logger.info(f"  Language ID: 0x{lang_id:04x}")
-        logger.info(f"  Microsoft Pinyin: {is_pinyin}")
-        logger.info(f"  Chinese Mode: {is_chinese}")
-        logger.info(f"  Symbol Mode: {symbol_mode}")
-        logger.info(f"  Force CN Mode: {config.get('force_cn_mode', True)}")
-    except Exception as e:
-        logger.error(f"Error getting status: {e}")
+    start_config_watcher()
+    loop.create_task(start_control_server())
+    startup.mark('ready')
+    startup.finish()
+    logger.info("IME Switcher started")
+    for line in startup.report():
+        logger.info(line)
 
 
 if __name__ == '__main__':
-    trigger = HotKeyTrigger()
-    
-    # 创建系统托盘
-    menu_options = create_systray_menu()
-    systray = SysTrayIcon("icon.ico", "IME Switcher", 
-                          menu_options=menu_options,
-                          on_quit=lambda _: os._exit(1))
-    systray.start()
-    
-    # 启动异步任务
+    with startup.phase('config'):
+        config = load_config()
+    with startup.phase('layouts'):
+        setup_switcher()
+
     loop = asyncio.new_event_loop()
-    
-    try:
-        loop.create_task(trigger.do_key_check())
-        loop.create_task(trigger.listen_hotkey())
+    trigger = HotKeyTrigger()
 
-        # 启动自动切换监控任务
-        if config.get('force_cn_mode', False):
-            trigger.force_cn_task = loop.create_task(force_cn_monitor())
-            logger.info("Force CN monitor task started")
-        
-        logger.info("IME Switcher started")
+    try:
+        # 先注册热键，其余初始化在之后的事件循环迭代中进行
+        with startup.phase('hotkeys'):
+            trigger.create_activity_scheduler(loop)
+            loop.run_until_complete(trigger.listen_hotkey())
+        startup.mark('hotkeys_ready')
+        logger.info(f"Hotkeys ready in {startup.marks['hotkeys_ready']:.1f} ms")
+
+        loop.call_soon(start_deferred)
         loop.run_forever()
-        
+
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     finally:
         # 清理资源
+        if config_watcher is not None:
+            config_watcher.stop()
+        if session_source is not None:
+            session_source.stop()
+        if control_server is not None:
+            control_server.stop()
         loop.run_until_complete(trigger.cleanup())
-        systray.shutdown()
+        if ime_query is not None:
+            ime_query.shutdown()
+        if systray is not None:
+            systray.shutdown()
         loop.close()
+        log_pipeline.stop()
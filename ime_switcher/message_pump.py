@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Win32 消息线程与全局热键来源。
+
+MessageThread 在独立线程上阻塞于 GetMessageW，钩子、热键等需要消息循环的
+功能都运行在这样的线程上，事件通过 call_soon_threadsafe 交给 asyncio 事件循环，
+因此热键延迟只受操作系统调度限制，不再受 sleep 间隔限制。
+"""
+
+import asyncio
+import concurrent.futures
+import ctypes
+import ctypes.wintypes
+import logging
+import queue
+import threading
+import time
+
+from ime_switcher import win32
+from ime_switcher.backend import get_backend
+from ime_switcher.metrics import histogram
+
+logger = logging.getLogger('ime_switcher')
+
+WM_QUIT = 0x0012
+WM_HOTKEY = 0x0312
+WM_APP = 0x8000
+WM_APP_CALL = WM_APP + 1
+PM_NOREMOVE = 0x0000
+
+
+class MessageThread:
+    """
+    运行 Win32 消息循环的后台线程。
+
+    - call(func, *args): 在该线程上执行 func，返回 concurrent.futures.Future
+    - add_message_handler(message, handler): 在分发前拦截指定消息，handler(hwnd, wparam, lparam)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.thread_id = None
+        self._thread = None
+        self._calls = queue.SimpleQueue()
+        self._handlers = {}
+        self._ready = threading.Event()
+
+    def start(self, timeout=1.0):
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise OSError(f'Timed out starting message thread {self.name}')
+
+    def stop(self):
+        if self.thread_id is not None:
+            win32.api().PostThreadMessageW(self.thread_id, WM_QUIT, 0, 0)
+            self.thread_id = None
+
+    def add_message_handler(self, message, handler):
+        self._handlers[message] = handler
+
+    def call(self, func, *args):
+        future = concurrent.futures.Future()
+        self._calls.put((future, func, args))
+        if self.thread_id is None or not win32.api().PostThreadMessageW(self.thread_id, WM_APP_CALL, 0, 0):
+            future.set_exception(OSError(f'Message thread {self.name} is not running'))
+        return future
+
+    def _run_calls(self):
+        while True:
+            try:
+                future, func, args = self._calls.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _run(self):
+        api = win32.api()
+        msg = ctypes.wintypes.MSG()
+        # PeekMessage 强制创建线程消息队列，之后 PostThreadMessage 才能成功
+        api.PeekMessageW(ctypes.byref(msg), None, 0, 0, PM_NOREMOVE)
+        self.thread_id = api.GetCurrentThreadId()
+        self._ready.set()
+
+        while api.GetMessageW(ctypes.byref(msg), None, 0, 0) > 0:
+            if msg.message == WM_APP_CALL and not msg.hWnd:
+                self._run_calls()
+                continue
+            handler = self._handlers.get(msg.message)
+            if handler is not None:
+                handler(msg.hWnd, msg.wParam, msg.lParam)
+                continue
+            api.TranslateMessage(ctypes.byref(msg))
+            api.DispatchMessageW(ctypes.byref(msg))
+        logger.info(f'Message thread {self.name} stopped')
+
+
+class HotkeySource:
+    """
+    全局热键来源的基类。
+
+    start(loop, on_hotkey) 之后，每个热键都会在事件循环线程上调用
+    on_hotkey(hotkey_id, timestamp)，timestamp 为收到消息时的单调时钟时间。
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.loop = None
+        self.on_hotkey = None
+        self.dispatch_latency = histogram('hotkey_dispatch_ms')
+
+    def start(self, loop, on_hotkey):
+        self.loop = loop
+        self.on_hotkey = on_hotkey
+
+    def stop(self):
+        pass
+
+    async def register_hotkey(self, id, modifiers, vk):
+        raise NotImplementedError
+
+    async def unregister_hotkey(self, id):
+        raise NotImplementedError
+
+    def _dispatch(self, hotkey_id, timestamp):
+        self.dispatch_latency.add((time.monotonic() - timestamp) * 1000)
+        self.on_hotkey(hotkey_id, timestamp)
+
+    def _post(self, hotkey_id, timestamp):
+        """从消息线程把热键交给事件循环"""
+        self.loop.call_soon_threadsafe(self._dispatch, hotkey_id, timestamp)
+
+
+class Win32HotkeySource(HotkeySource):
+    """
+    在专用消息线程上注册热键。RegisterHotKey 不指定窗口，WM_HOTKEY 直接进入该线程的
+    消息队列（RegisterHotKey 必须在该线程调用），因此不需要创建隐藏窗口
+    """
+    name = 'win32'
+
+    def __init__(self):
+        super().__init__()
+        self.hwnd = None
+        self._thread = MessageThread('HotkeyPump')
+
+    def start(self, loop, on_hotkey, timeout=1.0):
+        super().start(loop, on_hotkey)
+        self._thread.add_message_handler(WM_HOTKEY, self._on_wm_hotkey)
+        self._thread.start(timeout)
+
+    def stop(self):
+        self._thread.stop()
+
+    async def register_hotkey(self, id, modifiers, vk):
+        return await asyncio.wrap_future(self._thread.call(get_backend().register_hotkey, self.hwnd, id, modifiers, vk))
+
+    async def unregister_hotkey(self, id):
+        return await asyncio.wrap_future(self._thread.call(get_backend().unregister_hotkey, self.hwnd, id))
+
+    def _on_wm_hotkey(self, hwnd, wparam, lparam):
+        self._post(wparam, time.monotonic())
+
+
+class SimulatedHotkeySource(HotkeySource):
+    """
+    模拟的热键来源：后台线程阻塞在队列上（相当于 GetMessageW），
+    post_hotkey() 可从任意线程调用，用于在 Linux 上驱动和测试热键路径。
+    history 按顺序记录注册 / 注销调用 [('register' | 'unregister', id), ...]
+    """
+    name = 'simulated'
+
+    def __init__(self):
+        super().__init__()
+        self.registered = {}
+        self.history = []
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def start(self, loop, on_hotkey):
+        super().start(loop, on_hotkey)
+        self._thread = threading.Thread(target=self._run, name='SimulatedHotkeyPump', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._queue.put(None)
+
+    async def register_hotkey(self, id, modifiers, vk):
+        self.history.append(('register', id))
+        if (modifiers, vk) in self.registered.values():
+            return False
+        self.registered[id] = (modifiers, vk)
+        return True
+
+    async def unregister_hotkey(self, id):
+        self.history.append(('unregister', id))
+        return self.registered.pop(id, None) is not None
+
+    def post_hotkey(self, hotkey_id):
+        self._queue.put((hotkey_id, time.monotonic()))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            hotkey_id, timestamp = item
+            # 与操作系统一致：未注册的热键不会产生 WM_HOTKEY
+            if hotkey_id in self.registered:
+                self._post(hotkey_id, timestamp)
+
+
+_hotkey_sources = {
+    Win32HotkeySource.name: Win32HotkeySource,
+    SimulatedHotkeySource.name: SimulatedHotkeySource,
+}
+
+
+def create_hotkey_source(kind='win32'):
+    if kind not in _hotkey_sources:
+        raise ValueError(f'Unknown hotkey source: {kind}')
+    return _hotkey_sources[kind]()
+
+
+async def _benchmark(count=500):
+    import random
+
+    loop = asyncio.get_running_loop()
+
+    def produce(post):
+        for _ in range(count):
+            time.sleep(random.uniform(0.001, 0.005))
+            post()
+
+    # 1. 阻塞式消息线程
+    source = SimulatedHotkeySource()
+    received = asyncio.Event()
+    seen = []
+
+    def on_hotkey(hotkey_id, timestamp):
+        seen.append(hotkey_id)
+        if len(seen) == count:
+            received.set()
+
+    source.start(loop, on_hotkey)
+    await source.register_hotkey(1, 0x0002, 0xDC)
+    await loop.run_in_executor(None, produce, lambda: source.post_hotkey(1))
+    await received.wait()
+    source.stop()
+    print(f'blocking pump latency (ms): {source.dispatch_latency.summary()}')
+
+    # 2. 旧方式：每 50ms 唤醒一次处理积压的消息
+    from ime_switcher.metrics import Histogram
+    pending = queue.SimpleQueue()
+    poll_latency = Histogram('poll_pump_ms')
+    producer = loop.run_in_executor(None, produce, lambda: pending.put(time.monotonic()))
+    wakeups = 0
+    while poll_latency.count < count:
+        await asyncio.sleep(0.05)
+        wakeups += 1
+        while not pending.empty():
+            poll_latency.add((time.monotonic() - pending.get()) * 1000)
+    await producer
+    print(f'50ms poll pump latency (ms): {poll_latency.summary()}, {wakeups} wakeups')
+
+
+if __name__ == '__main__':
+    asyncio.run(_benchmark())
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""轻量级指标：固定分桶直方图、操作跨度和 Win32 调用计数"""
+
+import bisect
+import contextlib
+import contextvars
+import json
+import time
+
+# 毫秒分桶上界，最后一个桶收集所有更大的值
+DEFAULT_BUCKETS_MS = (0.5, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram:
+    """固定分桶直方图，add() 为 O(log 桶数)，不保存原始样本"""
+
+    def __init__(self, name, buckets=DEFAULT_BUCKETS_MS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """返回第 p 百分位所在桶的上界（溢出桶返回最大值）"""
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def reset(self):
+        self.__init__(self.name, self.buckets)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3),
+            'min': round(self.min, 3),
+            'max': round(self.max, 3),
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+_histograms = {}
+
+
+def histogram(name, buckets=DEFAULT_BUCKETS_MS):
+    """获取（或创建）指定名称的全局直方图"""
+    if name not in _histograms:
+        _histograms[name] = Histogram(name, buckets)
+    return _histograms[name]
+
+
+def histograms():
+    return dict(_histograms)
+
+
+# --- 操作跨度与 Win32 调用计数 ---
+# 关闭后 span()/mark()/count_call() 只做一次布尔判断
+
+enabled = True
+
+_counters = {}
+_current_span = contextvars.ContextVar('ime_switcher_span', default=None)
+_null_span = contextlib.nullcontext()
+
+
+class Span:
+    """
+    一次操作（例如一次热键切换）。start 为操作起点的单调时钟时间，
+    mark() 记录起点到第一次调用之间的毫秒数，count_call() 按操作统计 Win32 调用。
+    """
+
+    def __init__(self, name, start=None):
+        self.name = name
+        self.start = time.monotonic() if start is None else start
+        self.marked = False
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _current_span.reset(self._token)
+        return False
+
+
+def span(name, start=None):
+    """在 with 块（以及其中创建的任务/线程池调用）内追踪一次操作"""
+    if not enabled:
+        return _null_span
+    return Span(name, start)
+
+
+def mark():
+    """记录当前操作从起点到现在的耗时，每个操作只记录一次"""
+    if not enabled:
+        return
+    current = _current_span.get()
+    if current is not None and not current.marked:
+        current.marked = True
+        histogram(current.name).add((time.monotonic() - current.start) * 1000)
+
+
+def count_call(api):
+    """统计一次 Win32 调用，计入当前操作（无操作时计入 'idle'）"""
+    if not enabled:
+        return
+    current = _current_span.get()
+    key = f'{current.name if current is not None else "idle"}.{api}'
+    _counters[key] = _counters.get(key, 0) + 1
+
+
+def counters():
+    return dict(list(_counters.items()))
+
+
+def snapshot():
+    return {
+        'histograms': {name: h.summary() for name, h in list(_histograms.items())},
+        'counters': counters(),
+    }
+
+
+def dump(path):
+    """把当前指标写入 JSON 文件"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f, indent=2, ensure_ascii=False)
+
+
+def reset():
+    for h in _histograms.values():
+        h.reset()
+    _counters.clear()
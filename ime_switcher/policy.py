@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+按应用的切换策略：根据进程名、窗口类名和标题决定窗口的目标布局和输入模式。
+
+config.json 中的规则按顺序匹配，第一条匹配的规则生效：
+
+    "rules": [
+        {"exe": "WindowsTerminal.exe", "layout": "english", "conversion": "english"},
+        {"class": "Chrome_WidgetWin_1", "title": "微信|WeChat", "conversion": "chinese"},
+        {"exe": "code.exe", "secondary": "00000411"}
+    ]
+
+匹配条件（给出的条件必须全部满足）：
+- exe: 可执行文件名，不区分大小写
+- class: 窗口类名，精确匹配
+- title: 标题正则表达式（re.search）
+
+动作：
+- layout: 窗口获得焦点时切换到的布局，english / secondary / 8 位布局 ID
+- conversion: 强制中文的行为，chinese（强制中文）/ english（强制英文）/ off（不处理）
+- secondary: 在该窗口中切换热键使用的第二语言布局
+
+规则只编译一次：exe 和 class 建立哈希索引，只有它们的规则只需一次字典查找；
+只有标题条件的规则按顺序用预编译的正则匹配（CPython 的 re 对合并成一个大的
+选择分支并不会更快，实测反而慢数十倍）。决策再按窗口句柄和标题缓存，
+焦点变化时通常只需一次字典查找。
+"""
+
+import logging
+import re
+import time
+from collections import OrderedDict
+
+from ime_switcher.backend import get_backend
+
+logger = logging.getLogger('ime_switcher')
+
+CHINESE = 'chinese'
+ENGLISH = 'english'
+OFF = 'off'
+
+CONVERSIONS = (CHINESE, ENGLISH, OFF)
+
+
+class Decision:
+    __slots__ = ('rule', 'layout', 'conversion', 'secondary')
+
+    def __init__(self, rule=None, layout=None, conversion=None, secondary=None):
+        self.rule = rule
+        self.layout = layout
+        self.conversion = conversion
+        self.secondary = secondary
+
+    def __repr__(self):
+        return f'Decision(rule={self.rule}, layout={self.layout}, conversion={self.conversion}, secondary={self.secondary})'
+
+
+NO_DECISION = Decision()
+
+
+def validate_rules(rules):
+    """返回错误信息列表"""
+    if not isinstance(rules, list):
+        return ['rules must be a list']
+    errors = []
+    for i, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            errors.append(f'rule {i} must be an object')
+            continue
+        if 'title' in rule:
+            try:
+                re.compile(rule['title'])
+            except (re.error, TypeError) as e:
+                errors.append(f'rule {i} has an invalid title pattern: {e}')
+        if rule.get('conversion') not in (None, *CONVERSIONS):
+            errors.append(f'rule {i} conversion must be one of {CONVERSIONS}')
+        for key in ('exe', 'class', 'layout', 'secondary'):
+            if key in rule and not isinstance(rule[key], str):
+                errors.append(f'rule {i} {key} must be a string')
+    return errors
+
+
+class CompiledRules:
+    """
+    规则索引：
+    - by_exe / by_class: 键 -> 规则序号列表（每条规则只放进最有选择性的一个索引）
+    - title_only: 只有标题条件的规则序号，按顺序匹配
+    - wildcard: 没有任何条件的规则
+    """
+
+    def __init__(self, rules, resolve_layout=lambda layout: layout):
+        self.rules = list(rules)
+        self.decisions = []
+        self.title_patterns = {}
+        self.by_exe = {}
+        self.by_class = {}
+        self.title_only = []
+        self.wildcard = []
+        for i, rule in enumerate(self.rules):
+            self.decisions.append(Decision(
+                i,
+                resolve_layout(rule['layout']) if rule.get('layout') else None,
+                rule.get('conversion'),
+                resolve_layout(rule['secondary']) if rule.get('secondary') else None,
+            ))
+            if 'title' in rule:
+                self.title_patterns[i] = re.compile(rule['title'])
+            if 'exe' in rule:
+                self.by_exe.setdefault(rule['exe'].lower(), []).append(i)
+            elif 'class' in rule:
+                self.by_class.setdefault(rule['class'], []).append(i)
+            elif 'title' in rule:
+                self.title_only.append(i)
+            else:
+                self.wildcard.append(i)
+        self.uses_title = bool(self.title_patterns)
+        self.uses_class = any('class' in rule for rule in self.rules)
+
+    def match(self, exe, class_name, title):
+        """返回第一条匹配规则的序号，没有匹配时返回 None"""
+        best = None
+        for i in self.by_exe.get(exe, ()):
+            if self._matches(i, class_name, title):
+                best = i
+                break
+        for i in self.by_class.get(class_name, ()):
+            if best is not None and i > best:
+                break
+            if self._matches(i, class_name, title):
+                best = i
+                break
+        # 只需尝试序号比已命中规则更小的标题规则
+        for i in self.title_only:
+            if best is not None and i > best:
+                break
+            if self.title_patterns[i].search(title or '') is not None:
+                best = i
+                break
+        if self.wildcard and (best is None or self.wildcard[0] < best):
+            best = self.wildcard[0]
+        return best
+
+    def match_linear(self, exe, class_name, title):
+        """逐条匹配，与 match() 结果相同，用于对照和基准测试"""
+        for i, rule in enumerate(self.rules):
+            if 'exe' in rule and rule['exe'].lower() != exe:
+                continue
+            if self._matches(i, class_name, title):
+                return i
+        return None
+
+    def _matches(self, i, class_name, title):
+        rule = self.rules[i]
+        if 'class' in rule and rule['class'] != class_name:
+            return False
+        pattern = self.title_patterns.get(i)
+        return pattern is None or pattern.search(title or '') is not None
+
+
+class PolicyEngine:
+    """
+    按窗口决定策略。窗口的进程名和类名按句柄缓存（不会变化），
+    决策按 (句柄, 标题) 缓存；没有标题规则时不读取标题。
+    """
+
+    def __init__(self, rules, resolve_layout=lambda layout: layout, backend=None, max_size=256):
+        self.backend = backend or get_backend()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        started = time.perf_counter()
+        self.compiled = CompiledRules(rules, resolve_layout)
+        self.compile_ms = (time.perf_counter() - started) * 1000
+        # hwnd -> (exe, class_name)
+        self._windows = OrderedDict()
+        # hwnd -> (title, decision)
+        self._decisions = OrderedDict()
+
+    @property
+    def has_rules(self):
+        return bool(self.compiled.rules)
+
+    def layout_ids(self):
+        """规则用到的全部布局 ID，用于预加载"""
+        ids = []
+        for decision in self.compiled.decisions:
+            ids += [layout for layout in (decision.layout, decision.secondary) if layout]
+        return list(dict.fromkeys(ids))
+
+    def decide(self, hwnd):
+        if not hwnd or not self.compiled.rules:
+            return NO_DECISION
+        title = self.backend.get_window_title(hwnd) if self.compiled.uses_title else None
+        cached = self._decisions.get(hwnd)
+        if cached is not None and cached[0] == title:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        exe, class_name = self._window(hwnd)
+        i = self.compiled.match(exe, class_name, title)
+        decision = NO_DECISION if i is None else self.compiled.decisions[i]
+        self._put(self._decisions, hwnd, (title, decision))
+        return decision
+
+    def invalidate(self, hwnd=None):
+        if hwnd is None:
+            self._windows.clear()
+            self._decisions.clear()
+        else:
+            self._windows.pop(hwnd, None)
+            self._decisions.pop(hwnd, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'rules': len(self.compiled.rules),
+            'compile_ms': round(self.compile_ms, 3),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else None,
+        }
+
+    def _window(self, hwnd):
+        info = self._windows.get(hwnd)
+        if info is None:
+            exe = self.backend.get_process_name(hwnd) if self.compiled.by_exe else ''
+            class_name = self.backend.get_window_class(hwnd) if self.compiled.uses_class else ''
+            info = (exe, class_name)
+            self._put(self._windows, hwnd, info)
+        return info
+
+    def _put(self, cache, hwnd, value):
+        cache[hwnd] = value
+        cache.move_to_end(hwnd)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+
+def _benchmark(rule_count=5000, windows=200, lookups=20000):
+    import random
+
+    from ime_switcher.backend import SimulatedBackend
+    from ime_switcher.metrics import Histogram
+
+    rng = random.Random(3)
+    rules = []
+    for i in range(rule_count):
+        kind = rng.random()
+        if kind < 0.5:
+            rules.append({'exe': f'app{i}.exe', 'conversion': CHINESE})
+        elif kind < 0.8:
+            rules.append({'class': f'Class{i}', 'title': f'doc{i % 50}', 'layout': 'english'})
+        else:
+            rules.append({'title': f'^project {i} ', 'conversion': ENGLISH})
+
+    backend = SimulatedBackend()
+    hwnds = [backend.add_window(f'project {rng.randrange(rule_count)} - doc{rng.randrange(100)}',
+                                class_name=f'Class{rng.randrange(rule_count)}',
+                                process_name=f'app{rng.randrange(rule_count * 2)}.exe')
+             for _ in range(windows)]
+    engine = PolicyEngine(rules, backend=backend)
+    compiled = engine.compiled
+
+    samples = [(backend.windows[h].process_name, backend.windows[h].class_name, backend.windows[h].title) for h in hwnds]
+    for sample in samples:
+        assert compiled.match(*sample) == compiled.match_linear(*sample), sample
+
+    for name, match in (('linear scan', compiled.match_linear), ('indexed', compiled.match)):
+        latency = Histogram(name)
+        for i in range(2000):
+            sample = samples[i % len(samples)]
+            start = time.perf_counter()
+            match(*sample)
+            latency.add((time.perf_counter() - start) * 1000)
+        print(f'{name:12} per window (ms): {latency.summary()}')
+
+    latency = Histogram('decide')
+    for _ in range(lookups):
+        hwnd = rng.choice(hwnds)
+        start = time.perf_counter()
+        engine.decide(hwnd)
+        latency.add((time.perf_counter() - start) * 1000)
+    print(f'decide (cached) (ms):     {latency.summary()}')
+    print(f'{rule_count} rules, {windows} windows: {engine.stats()}')
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+会话与电源状态：锁屏、断开远程连接、系统睡眠或显示器关闭时暂停后台循环。
+
+- Win32SessionEventSource: 隐藏窗口接收 WM_WTSSESSION_CHANGE（WTSRegisterSessionNotification）
+  和 WM_POWERBROADCAST（睡眠/唤醒、GUID_CONSOLE_DISPLAY_STATE），运行在独立消息线程上
+- SimulatedSessionEventSource: post() 模拟会话事件，用于在 Linux 上测试和基准测试
+
+SessionState 汇总暂停原因（同时锁屏和关闭显示器时，两者都恢复才算恢复）。
+后台循环在每轮开始前 await state.wait_active()，恢复后重新同步状态；
+监听器 callback(active, reason) 用于让缓存在恢复时失效。
+"""
+
+import asyncio
+import ctypes
+import logging
+import time
+
+from ime_switcher import win32
+from ime_switcher.message_pump import MessageThread
+from ime_switcher.win32 import GUID, POWERBROADCAST_SETTING
+
+logger = logging.getLogger('ime_switcher')
+
+WM_POWERBROADCAST = 0x0218
+WM_WTSSESSION_CHANGE = 0x02B1
+WTS_CONSOLE_CONNECT = 0x1
+WTS_CONSOLE_DISCONNECT = 0x2
+WTS_REMOTE_CONNECT = 0x3
+WTS_REMOTE_DISCONNECT = 0x4
+WTS_SESSION_LOCK = 0x7
+WTS_SESSION_UNLOCK = 0x8
+NOTIFY_FOR_THIS_SESSION = 0
+PBT_APMSUSPEND = 0x0004
+PBT_APMRESUMESUSPEND = 0x0007
+PBT_APMRESUMEAUTOMATIC = 0x0012
+PBT_POWERSETTINGCHANGE = 0x8013
+DEVICE_NOTIFY_WINDOW_HANDLE = 0
+# {6fe69556-704a-47a0-8f24-c28d936fda47}
+GUID_CONSOLE_DISPLAY_STATE = (0x6fe69556, 0x704a, 0x47a0, (0x8f, 0x24, 0xc2, 0x8d, 0x93, 0x6f, 0xda, 0x47))
+
+# 事件名称
+LOCK = 'lock'
+UNLOCK = 'unlock'
+DISCONNECT = 'disconnect'
+CONNECT = 'connect'
+SUSPEND = 'suspend'
+RESUME = 'resume'
+DISPLAY_OFF = 'display_off'
+DISPLAY_ON = 'display_on'
+
+# 事件 -> (暂停原因, 是否进入暂停)
+_transitions = {
+    LOCK: ('locked', True),
+    UNLOCK: ('locked', False),
+    DISCONNECT: ('disconnected', True),
+    CONNECT: ('disconnected', False),
+    SUSPEND: ('suspended', True),
+    RESUME: ('suspended', False),
+    DISPLAY_OFF: ('display_off', True),
+    DISPLAY_ON: ('display_off', False),
+}
+
+_wts_events = {
+    WTS_CONSOLE_CONNECT: CONNECT,
+    WTS_CONSOLE_DISCONNECT: DISCONNECT,
+    WTS_REMOTE_CONNECT: CONNECT,
+    WTS_REMOTE_DISCONNECT: DISCONNECT,
+    WTS_SESSION_LOCK: LOCK,
+    WTS_SESSION_UNLOCK: UNLOCK,
+}
+
+_power_events = {
+    PBT_APMSUSPEND: SUSPEND,
+    PBT_APMRESUMESUSPEND: RESUME,
+    PBT_APMRESUMEAUTOMATIC: RESUME,
+}
+
+
+class SessionState:
+    """
+    当前会话是否需要后台任务。on_event(event, timestamp) 在事件循环线程上调用，
+    即 SessionEventSource 的监听器。
+    """
+
+    def __init__(self):
+        self.reasons = set()
+        self.suspend_count = 0
+        self._suspended_since = None
+        self._suspended_seconds = 0.0
+        self._listeners = []
+        self._resumed = None
+
+    @property
+    def active(self):
+        return not self.reasons
+
+    @property
+    def suspended_seconds(self):
+        """累计暂停时长（秒）"""
+        if self._suspended_since is None:
+            return self._suspended_seconds
+        return self._suspended_seconds + time.monotonic() - self._suspended_since
+
+    def add_listener(self, callback):
+        """callback(active, reason) 在进入暂停和恢复时调用"""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def on_event(self, event, timestamp=None):
+        if event not in _transitions:
+            return
+        reason, suspend = _transitions[event]
+        was_active = self.active
+        if suspend:
+            self.reasons.add(reason)
+        else:
+            self.reasons.discard(reason)
+        if was_active == self.active:
+            return
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        if not self.active:
+            self.suspend_count += 1
+            self._suspended_since = timestamp
+            logger.info(f'Session inactive ({reason}), background tasks paused')
+        else:
+            self._suspended_seconds += timestamp - self._suspended_since
+            self._suspended_since = None
+            if self._resumed is not None:
+                self._resumed.set()
+                self._resumed = None
+            logger.info(f'Session active again ({reason} ended), resuming background tasks')
+        for callback in list(self._listeners):
+            callback(self.active, reason)
+
+    def reset(self):
+        """清除全部暂停原因（停止接收会话事件时调用）"""
+        for event in (UNLOCK, CONNECT, RESUME, DISPLAY_ON):
+            self.on_event(event)
+
+    async def wait_active(self):
+        """会话活动时立即返回 False；否则等到恢复，返回 True（调用方应重新同步状态）"""
+        if self.active:
+            return False
+        if self._resumed is None:
+            self._resumed = asyncio.Event()
+        await self._resumed.wait()
+        return True
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'reasons': sorted(self.reasons),
+            'suspend_count': self.suspend_count,
+            'suspended_seconds': round(self.suspended_seconds, 1),
+        }
+
+
+class SessionEventSource:
+    """
+    会话事件来源的基类。start(loop) 之后，每个事件都会在事件循环线程上调用所有监听器
+    callback(event, timestamp)。
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.loop = None
+        self.event_count = 0
+        self._listeners = []
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def start(self, loop):
+        self.loop = loop
+
+    def stop(self):
+        pass
+
+    def notify(self, event, timestamp=None):
+        self.event_count += 1
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        for callback in list(self._listeners):
+            callback(event, timestamp)
+
+
+class Win32SessionEventSource(SessionEventSource):
+    """
+    隐藏的顶层窗口：WM_POWERBROADCAST 只广播给顶层窗口，不会发给仅消息窗口 (HWND_MESSAGE)。
+    两种通知都是发送（SendMessage）到窗口过程的，由消息线程的 GetMessageW 分发。
+    """
+    name = 'win32'
+
+    def __init__(self):
+        super().__init__()
+        self.hwnd = None
+        self._thread = None
+        self._wndproc = None
+        self._class_name = f'ImeSwitcherSession{id(self):x}'
+        self._power_notify = None
+
+    def start(self, loop, timeout=1.0):
+        super().start(loop)
+        self._thread = MessageThread('SessionEvents')
+        self._thread.start(timeout)
+        try:
+            self._thread.call(self._install).result(timeout)
+        except Exception as e:
+            self._thread.stop()
+            raise e if isinstance(e, OSError) else OSError(str(e))
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.call(self._uninstall)
+            self._thread.stop()
+            self._thread = None
+
+    def _install(self):
+        api = win32.api()
+        instance = api.GetModuleHandleW(None)
+        self._wndproc = api.WNDPROC(self._on_message)
+        window_class = api.WNDCLASSW(lpfnWndProc=self._wndproc, hInstance=instance, lpszClassName=self._class_name)
+        if not api.RegisterClassW(ctypes.byref(window_class)):
+            raise api.error()
+        self.hwnd = api.CreateWindowExW(0, self._class_name, 'IME Switcher session events', 0,
+                                        0, 0, 0, 0, None, None, instance, None)
+        if not self.hwnd:
+            error = api.error()
+            api.UnregisterClassW(self._class_name, instance)
+            raise error
+        if not api.WTSRegisterSessionNotification(self.hwnd, NOTIFY_FOR_THIS_SESSION):
+            error = api.error()
+            self._uninstall()
+            raise error
+        # 注册后系统立即发送一次当前的显示器状态；失败时只是少了显示器关闭的暂停
+        guid = GUID.from_tuple(GUID_CONSOLE_DISPLAY_STATE)
+        self._power_notify = api.RegisterPowerSettingNotification(self.hwnd, ctypes.byref(guid),
+                                                                  DEVICE_NOTIFY_WINDOW_HANDLE)
+
+    def _uninstall(self):
+        if self.hwnd is None:
+            return
+        api = win32.api()
+        if self._power_notify:
+            api.UnregisterPowerSettingNotification(self._power_notify)
+            self._power_notify = None
+        api.WTSUnRegisterSessionNotification(self.hwnd)
+        api.DestroyWindow(self.hwnd)
+        api.UnregisterClassW(self._class_name, api.GetModuleHandleW(None))
+        self.hwnd = None
+
+    def _on_message(self, hwnd, message, wparam, lparam):
+        event = None
+        if message == WM_WTSSESSION_CHANGE:
+            event = _wts_events.get(wparam)
+        elif message == WM_POWERBROADCAST:
+            if wparam == PBT_POWERSETTINGCHANGE and lparam:
+                setting = ctypes.cast(lparam, ctypes.POINTER(POWERBROADCAST_SETTING)).contents
+                if setting.PowerSetting.as_tuple() == GUID_CONSOLE_DISPLAY_STATE:
+                    # 0 关闭，1 打开，2 变暗（仍可见，按打开处理）
+                    event = DISPLAY_OFF if setting.Data == 0 else DISPLAY_ON
+            else:
+                event = _power_events.get(wparam)
+        if event is not None:
+            self.loop.call_soon_threadsafe(self.notify, event, time.monotonic())
+        if message == WM_POWERBROADCAST:
+            return 1
+        return win32.api().DefWindowProcW(hwnd, message, wparam, lparam)
+
+
+class SimulatedSessionEventSource(SessionEventSource):
+    """post(event) 可从任意线程调用"""
+    name = 'simulated'
+
+    def post(self, event):
+        self.loop.call_soon_threadsafe(self.notify, event, time.monotonic())
+
+
+_session_event_sources = {
+    Win32SessionEventSource.name: Win32SessionEventSource,
+    SimulatedSessionEventSource.name: SimulatedSessionEventSource,
+}
+
+
+def create_session_event_source(kind='win32'):
+    if kind not in _session_event_sources:
+        raise ValueError(f'Unknown session event source: {kind}')
+    return _session_event_sources[kind]()
+
+
+async def _benchmark(interval=0.01, active=0.5, locked=1.5):
+    """
+    按比例缩短的时间线：活动 active 秒，锁屏 locked 秒，再活动 active 秒（相当于一天中大部分时间锁屏的 VDI 会话）。
+    三个定期循环（强制中文监视器、轮询配置监视器、轮询按键来源）都以 interval 秒为间隔，
+    比较不暂停和暂停时锁屏期间的唤醒次数，以及解锁后重新检查的延迟；
+    锁屏期间前台窗口的拼音被切到英文，检查恢复后是否立即纠正。
+    """
+    import json
+
+    from ime_switcher.activity import PollingActivitySource
+    from ime_switcher.force_cn import POLLING, ForceCnMonitor
+    from ime_switcher.ime_status_detector import IME_CMODE_NATIVE, ImeSnapshot
+    from ime_switcher.settings import DEFAULT_CONFIG, MemoryFileSystem, PollingConfigWatcher
+
+    loop = asyncio.get_running_loop()
+    for gated in (False, True):
+        state = SessionState()
+        source = SimulatedSessionEventSource()
+        source.add_listener(state.on_event)
+        source.start(loop)
+        session = state if gated else None
+        world = {'chinese': True, 'unlocked_at': None, 'resync_ms': None}
+        # 各循环的唤醒时间
+        wakeups = {'force_cn': [], 'config': [], 'key_scan': []}
+
+        async def get_status():
+            now = time.monotonic()
+            wakeups['force_cn'].append(now)
+            if world['unlocked_at'] is not None and world['resync_ms'] is None:
+                world['resync_ms'] = (now - world['unlocked_at']) * 1000
+            return ImeSnapshot.from_values(1, 0x08040804, True, IME_CMODE_NATIVE if world['chinese'] else 0,
+                                           is_pinyin=True)
+
+        async def switch(hwnd):
+            world['chinese'] = True
+            return True
+
+        class CountingFileSystem(MemoryFileSystem):
+            def signature(self, path):
+                wakeups['config'].append(time.monotonic())
+                return super().signature(path)
+
+        def get_async_key_state(vk):
+            if vk == 0:
+                wakeups['key_scan'].append(time.monotonic())
+            return 0
+
+        monitor = ForceCnMonitor(get_status, switch, lambda hwnd: 'editor', interval=interval, mode=POLLING,
+                                 session=session)
+        watcher = PollingConfigWatcher('config.json', lambda config: None,
+                                       CountingFileSystem({'config.json': json.dumps(DEFAULT_CONFIG)}),
+                                       interval=interval, session=session)
+        keys = PollingActivitySource(interval, get_async_key_state)
+        keys.session = session
+        task = loop.create_task(monitor.run())
+        watcher.start(loop)
+        keys.start(loop)
+
+        await asyncio.sleep(active)
+        source.post(LOCK)
+        await asyncio.sleep(locked / 2)
+        # 锁屏期间：切换用户的远程连接断开又重连，窗口的输入法被切到英文
+        source.post(DISCONNECT)
+        world['chinese'] = False
+        await asyncio.sleep(locked / 2)
+        source.post(CONNECT)
+        world['unlocked_at'] = time.monotonic()
+        source.post(UNLOCK)
+        await asyncio.sleep(active)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        watcher.stop()
+        keys.stop()
+        source.stop()
+
+        lock_start = world['unlocked_at'] - locked
+        counts = {name: sum(1 for t in times if lock_start + interval < t < world['unlocked_at'])
+                  for name, times in wakeups.items()}
+        print(f'{"paused" if gated else "always on":9}: wakeups while locked {counts}, '
+              f'first check {world["resync_ms"]:.1f} ms after unlock, '
+              f'English fixed: {world["chinese"]}, {state.stats()}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(_benchmark())
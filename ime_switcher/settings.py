@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+配置：默认值、校验、差异比较，以及 config.json 的变更监视。
+
+- Win32ConfigWatcher: FindFirstChangeNotificationW 监视所在目录，运行在独立线程上
+- PollingConfigWatcher: 定期比较文件的修改时间和大小，作为后备
+- MemoryConfigWatcher: 配合 MemoryFileSystem 使用，用于在 Linux 上测试
+
+监视器只在文件内容解析并校验通过后才回调 on_change(new_config)，
+无效的配置会被记录并忽略，继续使用旧配置。
+"""
+
+import asyncio
+import copy
+import ctypes
+import ctypes.wintypes
+import json
+import logging
+import os
+import threading
+
+from ime_switcher import win32
+from ime_switcher.actions import HOTKEY_TARGETS
+from ime_switcher.policy import validate_rules
+from ime_switcher.shortcut import Keymap, ShortcutError
+
+logger = logging.getLogger('ime_switcher')
+
+FILE_NOTIFY_CHANGE_LAST_WRITE = 0x00000010
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+INFINITE = 0xFFFFFFFF
+WAIT_OBJECT_0 = 0
+
+DEFAULT_CONFIG = {
+    "temp_switch_interval": 2.0,
+    "instant_switch_interval": 0.6,
+    "secondary_keyboard_id": "00000804",
+    "force_cn_mode": True,  # 添加自动切换开关
+    "force_cn_interval": 0.2,  # 自动切换检查间隔
+    "force_cn_trigger": "event",  # 自动切换触发方式: event / polling
+    "force_cn_fallback_interval": 1.0,  # event 方式下的兜底检查间隔
+    "force_cn_max_interval": 3.0,  # 用户空闲时检查间隔逐渐放长到的上限
+    "window_info_cache_ttl": 1.0,  # 窗口键盘布局/IME窗口缓存的有效期
+    "ime_query_timeout": 0.5,  # 单次IME查询的超时时间（秒），超时的窗口会被暂时跳过
+    "activity_source": "hook",  # 按键活动来源: hook / polling
+    "preload_keyboard_ids": [],  # 启动时额外预加载的键盘布局
+    "metrics_enabled": True,  # 记录热键/自动切换延迟和 Win32 调用次数
+    "config_watcher": "win32",  # 配置文件变更监视: win32 / polling / off
+    "config_poll_interval": 1.0,  # polling 方式下的检查间隔
+    "rules": [],  # 按应用的切换规则，见 policy.py
+    "remember_language": "window",  # 切回窗口时恢复它上次的输入语言: window / process / off
+    "chord_timeout": 1.0,  # 按键序列（如 "Ctrl+K, Ctrl+E"）两步之间的最长间隔（秒）
+    "session_events": "win32",  # 锁屏/断开连接/睡眠/显示器关闭时暂停后台检查: win32 / off
+    "verify_switches": True,  # 切换后确认布局/中英文模式已生效，未生效时有限次重试
+    "control_api": "pipe",  # 本地控制接口（见 control_client.py）: pipe / unix / off
+    "hotkeys": {
+        "toggle": "Ctrl+\\",
+        "temp_toggle": "Ctrl+Shift+\\",
+        "instant_toggle": "Ctrl+Alt+\\"
+    }
+}
+
+_positive_numbers = (
+    'temp_switch_interval', 'instant_switch_interval', 'force_cn_interval', 'force_cn_fallback_interval',
+    'force_cn_max_interval', 'window_info_cache_ttl', 'ime_query_timeout', 'config_poll_interval', 'chord_timeout',
+)
+_choices = {
+    'force_cn_trigger': ('event', 'polling'),
+    'activity_source': ('hook', 'polling'),
+    'config_watcher': ('win32', 'polling', 'off'),
+    'remember_language': ('window', 'process', 'off'),
+    'session_events': ('win32', 'off'),
+    'control_api': ('pipe', 'unix', 'off'),
+}
+
+
+def _is_keyboard_id(value):
+    if not isinstance(value, str) or len(value) != 8:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def validate_config(config):
+    """校验配置，有错误时抛出 ValueError（包含全部错误）"""
+    if not isinstance(config, dict):
+        raise ValueError('config must be a JSON object')
+    errors = []
+    for key in _positive_numbers:
+        value = config.get(key, DEFAULT_CONFIG[key])
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            errors.append(f'{key} must be a positive number, got {value!r}')
+    for key, choices in _choices.items():
+        value = config.get(key, DEFAULT_CONFIG[key])
+        if value not in choices:
+            errors.append(f'{key} must be one of {choices}, got {value!r}')
+    if not _is_keyboard_id(config.get('secondary_keyboard_id')):
+        errors.append(f'secondary_keyboard_id must be 8 hex digits, got {config.get("secondary_keyboard_id")!r}')
+    preload = config.get('preload_keyboard_ids', [])
+    if not isinstance(preload, list) or not all(_is_keyboard_id(value) for value in preload):
+        errors.append(f'preload_keyboard_ids must be a list of 8-hex-digit ids, got {preload!r}')
+    rules = config.get('rules', [])
+    errors += validate_rules(rules)
+    if isinstance(rules, list):
+        for i, rule in enumerate(rules):
+            for key in ('layout', 'secondary'):
+                value = rule.get(key) if isinstance(rule, dict) else None
+                if isinstance(value, str) and value not in ('english', 'secondary') and not _is_keyboard_id(value):
+                    errors.append(f'rule {i} {key} must be english, secondary or 8 hex digits, got {value!r}')
+    hotkeys = config.get('hotkeys')
+    if not isinstance(hotkeys, dict):
+        errors.append('hotkeys must be an object')
+    else:
+        unknown = sorted(set(hotkeys) - set(HOTKEY_TARGETS))
+        if unknown:
+            errors.append(f'unknown hotkey targets {unknown}, expected one of {list(HOTKEY_TARGETS)}')
+        # 编译一次以检查键名、重复和互为前缀的序列
+        try:
+            Keymap(hotkeys)
+        except ShortcutError as e:
+            errors.append(str(e))
+    if errors:
+        raise ValueError('; '.join(errors))
+    return config
+
+
+def diff_config(old, new):
+    """返回值发生变化的顶层键集合"""
+    return {key for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+
+def parse_config(text):
+    """解析并校验配置；缺少的顶层项取默认值，启动加载和热重载得到的都是完整的配置"""
+    config = json.loads(text)
+    if isinstance(config, dict):
+        config = {**copy.deepcopy(DEFAULT_CONFIG), **config}
+    return validate_config(config)
+
+
+# --- 文件系统 ---
+
+class FileSystem:
+    """真实文件系统"""
+
+    def signature(self, path):
+        """返回用于判断文件是否变化的值；文件不存在时返回 None"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def read(self, path):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+
+
+class MemoryFileSystem(FileSystem):
+    """内存文件系统，write() 会通知监听器，相当于文件变更通知"""
+
+    def __init__(self, files=None):
+        self._files = {}
+        self._versions = {}
+        self._listeners = []
+        for path, text in (files or {}).items():
+            self.write(path, text)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def write(self, path, text):
+        self._files[path] = text
+        self._versions[path] = self._versions.get(path, 0) + 1
+        for callback in list(self._listeners):
+            callback(path)
+
+    def signature(self, path):
+        if path not in self._files:
+            return None
+        return self._versions[path], len(self._files[path])
+
+    def read(self, path):
+        return self._files[path]
+
+
+def load_config(path, fs=None):
+    """读取并校验配置文件；文件不存在时返回默认配置的副本"""
+    fs = fs or FileSystem()
+    if fs.signature(path) is None:
+        return copy.deepcopy(DEFAULT_CONFIG)
+    return parse_config(fs.read(path))
+
+
+# --- 监视器 ---
+
+class ConfigWatcher:
+    """
+    配置文件监视器的基类。start(loop) 之后，文件变化且新配置有效时，
+    在事件循环线程上调用 on_change(new_config)。
+    """
+    name = 'base'
+
+    def __init__(self, path, on_change, fs=None, debounce=0.1):
+        self.path = path
+        self.on_change = on_change
+        self.fs = fs or FileSystem()
+        self.debounce = debounce
+        self.loop = None
+        self.reload_count = 0
+        self.error_count = 0
+        self._signature = None
+        self._pending = None
+
+    def start(self, loop):
+        self.loop = loop
+        self._signature = self.fs.signature(self.path)
+
+    def stop(self):
+        if self._pending is not None:
+            self._pending.cancel()
+            self._pending = None
+
+    def notify(self):
+        """文件可能已变化：编辑器往往连续写入多次，合并后再检查"""
+        if self._pending is None:
+            self._pending = self.loop.call_later(self.debounce, self.check)
+
+    def check(self):
+        self._pending = None
+        signature = self.fs.signature(self.path)
+        if signature is None or signature == self._signature:
+            return
+        self._signature = signature
+        try:
+            config = parse_config(self.fs.read(self.path))
+        except (OSError, ValueError) as e:
+            self.error_count += 1
+            logger.error(f'Ignoring invalid config {self.path}: {e}')
+            return
+        self.reload_count += 1
+        self.on_change(config)
+
+    def stats(self):
+        return {'watcher': self.name, 'reloads': self.reload_count, 'errors': self.error_count}
+
+
+class PollingConfigWatcher(ConfigWatcher):
+    name = 'polling'
+
+    def __init__(self, path, on_change, fs=None, interval=1.0, session=None, **kwargs):
+        super().__init__(path, on_change, fs, **kwargs)
+        self.interval = interval
+        # SessionState（可选）：会话暂停期间不轮询，恢复后立即检查一次
+        self.session = session
+        self._task = None
+
+    def start(self, loop):
+        super().start(loop)
+        self._task = loop.create_task(self._poll())
+
+    def stop(self):
+        super().stop()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.session is not None:
+                await self.session.wait_active()
+            self.check()
+
+
+class MemoryConfigWatcher(ConfigWatcher):
+    name = 'memory'
+
+    def start(self, loop):
+        super().start(loop)
+        self.fs.add_listener(self._on_write)
+
+    def stop(self):
+        super().stop()
+        self.fs.remove_listener(self._on_write)
+
+    def _on_write(self, path):
+        if path == self.path:
+            self.notify()
+
+
+class Win32ConfigWatcher(ConfigWatcher):
+    """FindFirstChangeNotificationW 监视配置文件所在目录的写入"""
+    name = 'win32'
+
+    def __init__(self, path, on_change, fs=None, **kwargs):
+        super().__init__(path, on_change, fs, **kwargs)
+        self._handle = None
+        self._stop_event = None
+        self._thread = None
+
+    def start(self, loop):
+        super().start(loop)
+        api = win32.api()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        handle = api.FindFirstChangeNotificationW(directory, False, FILE_NOTIFY_CHANGE_LAST_WRITE)
+        if handle == INVALID_HANDLE_VALUE:
+            raise api.error()
+        self._handle = handle
+        self._stop_event = api.CreateEventW(None, True, False, None)
+        self._thread = threading.Thread(target=self._run, name='ConfigWatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        super().stop()
+        if self._stop_event:
+            api = win32.api()
+            api.SetEvent(self._stop_event)
+            self._thread.join(1.0)
+            api.CloseHandle(self._stop_event)
+            self._stop_event = None
+
+    def _run(self):
+        api = win32.api()
+        handles = (ctypes.wintypes.HANDLE * 2)(self._handle, self._stop_event)
+        try:
+            while api.WaitForMultipleObjects(2, handles, False, INFINITE) == WAIT_OBJECT_0:
+                self.loop.call_soon_threadsafe(self.notify)
+                if not api.FindNextChangeNotification(self._handle):
+                    break
+        finally:
+            api.FindCloseChangeNotification(self._handle)
+            self._handle = None
+
+
+_config_watchers = {
+    Win32ConfigWatcher.name: Win32ConfigWatcher,
+    PollingConfigWatcher.name: PollingConfigWatcher,
+    MemoryConfigWatcher.name: MemoryConfigWatcher,
+}
+
+
+def create_config_watcher(kind, path, on_change, **kwargs):
+    if kind not in _config_watchers:
+        raise ValueError(f'Unknown config watcher: {kind}')
+    return _config_watchers[kind](path, on_change, **kwargs)
+
+
+def _hot_reload_demo():
+    """
+    在模拟后端上运行 main 的热重载路径：通过 MemoryFileSystem 依次写入配置，
+    由 MemoryConfigWatcher 交给 apply_config，并检查：
+    1. 只修改一个热键时，只注销并重新注册这一个组合键；不再使用的热键 id 被回收
+    2. 修改 force_cn_interval 会重启强制中文监视器
+    3. 无效配置被记录并忽略，继续使用旧配置
+    4. 修改 secondary_keyboard_id 时，进行中的临时切换按旧配置完成切回，
+       强制中文监视器重启并使用按新 secondary 编译的规则
+    """
+    from ime_switcher import actions, main, message_pump
+    from ime_switcher.backend import SimulatedBackend, set_backend
+    from ime_switcher.shortcut import parse_shortcut
+
+    # main 导入时安装了写文件的日志管道，演示只输出到控制台
+    main.log_pipeline.stop()
+    logger.handlers.clear()
+    logger.propagate = True
+    errors = []
+    error_handler = logging.Handler(logging.ERROR)
+    error_handler.emit = errors.append
+    logger.addHandler(error_handler)
+
+    backend = set_backend(SimulatedBackend(layouts=('00000409', '00000411', '00000412')))
+    hwnd = backend.add_window('notes.txt - Notepad')
+    word = backend.add_window('report.docx - Word')
+    backend.focus(hwnd)
+
+    def layout():
+        return f'{backend.get_keyboard_layout(backend.windows[hwnd].thread_id) & 0xFFFF:04x}'
+
+    path = 'config.json'
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    # 日文布局没有中文的 2 秒最短切回时间；轮询方式在 Linux 上可用
+    config.update(secondary_keyboard_id='00000411', temp_switch_interval=0.3, force_cn_trigger='polling',
+                  activity_source='polling', remember_language='off',
+                  rules=[{'title': 'Word', 'layout': 'secondary'}])
+    fs = MemoryFileSystem({path: json.dumps(config)})
+
+    def write(**changes):
+        config.update(changes)
+        fs.write(path, json.dumps(config))
+
+    async def run():
+        main.loop = loop = asyncio.get_running_loop()
+        main.config_path = path
+        main.config = load_config(path, fs)
+        main.setup_switcher()
+        main.trigger = trigger = main.HotKeyTrigger(hotkey_source=message_pump.SimulatedHotkeySource.name)
+        trigger.create_activity_scheduler(loop)
+        await trigger.listen_hotkey()
+        trigger.force_cn_task = loop.create_task(main.force_cn_monitor())
+        main.start_config_watcher(MemoryConfigWatcher.name, fs)
+        reload_wait = main.config_watcher.debounce + 0.1
+        source = trigger.hotkey_source
+        await asyncio.sleep(0.05)
+
+        # 1. 只改 toggle 热键
+        old_id = trigger.step_ids[parse_shortcut(config['hotkeys']['toggle'])]
+        source.history.clear()
+        write(hotkeys={**config['hotkeys'], 'toggle': 'Ctrl+Q'})
+        await asyncio.sleep(reload_wait)
+        new_id = trigger.step_ids[parse_shortcut('Ctrl+Q')]
+        assert sorted(source.history) == [('register', new_id), ('unregister', old_id)], source.history
+        print(f'hotkey reload: {source.history}, registered ids {sorted(source.registered)}')
+        # 反复修改热键：不再使用的 id 被回收，id 不会随重载次数增长
+        for toggle in ('Ctrl+K, Ctrl+E', 'Ctrl+\\'):
+            write(hotkeys={**config['hotkeys'], 'toggle': toggle})
+            await asyncio.sleep(reload_wait)
+        assert set(trigger.step_ids) <= trigger.keymap.all_steps() and max(trigger.id_steps) == new_id, trigger.step_ids
+        print(f'hotkey ids after {len(source.history)} (un)registrations: {sorted(trigger.id_steps)}')
+
+        # 2. 修改 force_cn_interval 重启监视器
+        task, monitor = trigger.force_cn_task, main.force_cn_monitor_instance
+        write(force_cn_interval=0.05)
+        await asyncio.sleep(reload_wait)
+        assert task.done() and trigger.force_cn_task is not task
+        assert main.force_cn_monitor_instance is not monitor and main.force_cn_monitor_instance.interval == 0.05
+        print(f'force_cn_interval reload: monitor restarted, interval {main.force_cn_monitor_instance.interval}')
+
+        # 3. 无效配置：记录错误，保留旧配置
+        current = main.config
+        fs.write(path, json.dumps({**config, 'force_cn_interval': -1}))
+        await asyncio.sleep(reload_wait)
+        assert main.config is current and len(errors) == 1, errors
+        print(f'invalid config: kept old config, logged "{errors[0].getMessage()}"')
+
+        # 4. 临时切换进行中修改 secondary_keyboard_id
+        trigger.dispatch_hotkey(actions.TEMP_TOGGLE)
+        await asyncio.sleep(main.switcher.temp_toggle_delay + 0.1)
+        during = layout()
+        old_switcher, task = main.switcher, trigger.force_cn_task
+        assert main.force_cn_monitor_instance.policy.decide(word).layout == '00000411'
+        write(secondary_keyboard_id='00000412')
+        await asyncio.sleep(reload_wait)
+        assert main.switcher is not old_switcher and trigger.actions.is_temp_toggling
+        # 规则中的 secondary 随之改变，强制中文监视器使用新的规则
+        assert task.done() and main.force_cn_monitor_instance.policy is main.policy
+        assert main.force_cn_monitor_instance.policy.decide(word).layout == '00000412'
+        # 重载之后继续输入，停止输入后按旧配置切回
+        backend.press(0x41)
+        await asyncio.sleep(config['temp_switch_interval'] + 0.2)
+        after = layout()
+        assert (during, after) == ('0411', '0409') and not trigger.actions.is_temp_toggling, (during, after)
+        trigger.dispatch_hotkey(actions.TOGGLE)
+        await asyncio.sleep(0.05)
+        assert layout() == '0412'
+        print(f'secondary reload during temp toggle: {during} -> {after}, next toggle uses {layout()}')
+
+        print(f'{main.config_watcher.stats()}')
+        main.config_watcher.stop()
+        await trigger.cleanup()
+        main.ime_query.shutdown()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    _hot_reload_demo()
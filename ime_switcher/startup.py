@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+启动耗时分析：按阶段记录耗时，可选地像 -X importtime 一样记录每个模块的导入耗时。
+
+    python main.py --startup-profile
+    或设置环境变量 IME_SWITCHER_STARTUP_PROFILE=1
+"""
+
+import builtins
+import contextlib
+import sys
+import time
+
+
+class ImportTimer:
+    """包装 builtins.__import__，记录首次导入的模块的自身耗时和累计耗时（微秒）"""
+
+    def __init__(self):
+        # [(模块名, 自身耗时, 累计耗时, 嵌套深度)]
+        self.records = []
+        self._original = None
+        self._stack = []
+
+    def install(self):
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def uninstall(self):
+        if self._original is not None:
+            builtins.__import__ = self._original
+            self._original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return self._original(name, globals, locals, fromlist, level)
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1e6
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.records.append((name, elapsed - children, elapsed, len(self._stack)))
+
+    def report(self, top=15):
+        lines = ['import time: self [us] | cumulative | imported package']
+        for name, self_us, cumulative_us, depth in sorted(self.records, key=lambda r: -r[2])[:top]:
+            lines.append(f'import time: {self_us:9.0f} | {cumulative_us:10.0f} | {"  " * depth}{name}')
+        return lines
+
+
+class StartupProfile:
+    """
+    Args:
+        origin: 进程启动时的 perf_counter()，阶段时间都相对于它
+        trace_imports: 是否记录每个模块的导入耗时
+    """
+
+    def __init__(self, origin=None, trace_imports=False):
+        self.origin = time.perf_counter() if origin is None else origin
+        # [(阶段名, 开始时间, 耗时)]，时间单位为毫秒
+        self.phases = []
+        self.marks = {}
+        self.import_timer = None
+        if trace_imports:
+            self.import_timer = ImportTimer()
+            self.import_timer.install()
+
+    def elapsed(self):
+        return (time.perf_counter() - self.origin) * 1000
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.elapsed()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start, self.elapsed() - start))
+
+    def mark(self, name):
+        """记录一个里程碑，例如 'hotkeys_ready'"""
+        self.marks[name] = self.elapsed()
+
+    def finish(self):
+        if self.import_timer is not None:
+            self.import_timer.uninstall()
+
+    def report(self):
+        lines = [f'  {name:<20} +{start:8.1f} ms  {duration:8.1f} ms' for name, start, duration in self.phases]
+        lines += [f'  {name:<20} @{at:8.1f} ms' for name, at in self.marks.items()]
+        if self.import_timer is not None:
+            lines += [f'  {line}' for line in self.import_timer.report()]
+        return lines
+
+    def summary(self):
+        return {
+            'phases_ms': {name: round(duration, 1) for name, _, duration in self.phases},
+            'marks_ms': {name: round(at, 1) for name, at in self.marks.items()},
+        }
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+切换引擎：热键对应的切换动作（切换、切到英文/第二语言、临时切换）。
+
+所有窗口和布局调用都经过平台后端，因此可以在模拟后端上回放和测量。
+热键的去抖、合并和临时切换的串行化见 actions.HotkeyActions。
+"""
+
+import asyncio
+import logging
+import time
+
+from ime_switcher import metrics
+from ime_switcher.activity import wait_for_key_inactivity
+from ime_switcher.backend import WM_INPUTLANGCHANGEREQUEST, get_backend
+
+logger = logging.getLogger('ime_switcher')
+
+ENGLISH_LANG_ID = '0409'
+ENGLISH_KEYBOARD_ID = f'0000{ENGLISH_LANG_ID}'
+
+
+class Switcher:
+    """
+    Args:
+        secondary_keyboard_id: 第二语言的键盘布局 ID，例如 '00000804'
+        layout_registry: KeyboardLayoutRegistry，提供预加载的 HKL
+        window_info_cache: 切换后需要失效的 WindowInfoCache（可选）
+        backend: 平台后端，默认 get_backend()
+        temp_toggle_delay: 临时切换前等待热键松开的时间（秒）
+        policy: PolicyEngine（可选），规则的 secondary 覆盖该窗口的第二语言，layout 在获得焦点时生效
+        memory: LanguageMemory（可选），离开窗口时记下布局，切回时恢复
+        settle_time: PostMessage 之后目标线程处理 WM_INPUTLANGCHANGEREQUEST 之前，GetKeyboardLayout
+            仍返回旧布局；此时间（秒）内以刚发出的布局为准，连续切换不会基于过时的状态
+        verifier: confirm.SwitchVerifier（可选），在后台确认布局已生效，未生效时重新发出；
+            确认或放弃后不再等 settle_time，立即以实际布局为准
+    """
+
+    def __init__(self, secondary_keyboard_id, layout_registry, window_info_cache=None, backend=None,
+                 temp_toggle_delay=0.2, policy=None, memory=None, settle_time=0.3, clock=time.monotonic,
+                 verifier=None):
+        assert len(secondary_keyboard_id) == 8
+        self.secondary_keyboard_id = secondary_keyboard_id
+        self.secondary_lang_id = secondary_keyboard_id[4:8]
+        self.layout_registry = layout_registry
+        self.window_info_cache = window_info_cache
+        self.backend = backend or get_backend()
+        self.temp_toggle_delay = temp_toggle_delay
+        self.policy = policy
+        self.memory = memory
+        self.settle_time = settle_time
+        self.clock = clock
+        self.verifier = verifier
+        self._focused = None
+        # hwnd -> (刚发出的 HKL, 发出时间)
+        self._posted = {}
+        self.switch_count = 0
+
+    def get_window_hkl(self, hwnd):
+        posted = self._posted.get(hwnd)
+        if posted is not None and self.clock() - posted[1] < self.settle_time:
+            return posted[0]
+        return self.read_window_hkl(hwnd)
+
+    def read_window_hkl(self, hwnd):
+        """窗口线程实际的布局，不考虑刚发出、尚未生效的切换"""
+        metrics.count_call('GetWindowThreadProcessId')
+        metrics.count_call('GetKeyboardLayout')
+        thread_id = self.backend.get_window_thread_id(hwnd)
+        return self.backend.get_keyboard_layout(thread_id)
+
+    def get_window_langid(self, hwnd):
+        """Returns the LANGID of the window as a 4-digit hex string."""
+        hkl = self.get_window_hkl(hwnd)
+        # Extract the LANGID from the HKL (keyboard layout handle)
+        return format(hkl & 0x0000FFFF, '04x')
+
+    def get_front_window(self):
+        metrics.count_call('GetForegroundWindow')
+        metrics.count_call('GetAncestor')
+        return self.backend.get_root_owner(self.backend.get_foreground_window())
+
+    def get_front_window_langid(self):
+        return self.get_window_langid(self.get_front_window())
+
+    def get_window_title(self, hwnd):
+        metrics.count_call('GetWindowTextW')
+        return self.backend.get_window_title(hwnd) if hwnd else ''
+
+    def set_input_language_for_window(self, hwnd, keyboard_layout_id: str):
+        """
+        Set the input language for the window.
+        keyboard_layout_id is the layout to activate, e.g., '00000409' for English (US).
+        """
+        # Reuse the preloaded layout handle instead of loading it on every toggle.
+        self.post_layout(hwnd, self.layout_registry.get(keyboard_layout_id))
+
+    def post_layout(self, hwnd, hkl):
+        self._post(hwnd, hkl)
+        if self.verifier is not None and hwnd:
+            self.verifier.submit(hwnd, self._confirm_layout(hwnd, hkl))
+
+    def _post(self, hwnd, hkl):
+        # Post a message to the window to change its input language.
+        metrics.count_call('PostMessage')
+        self.backend.post_message(hwnd, WM_INPUTLANGCHANGEREQUEST, 0, hkl)
+        now = self.clock()
+        if len(self._posted) >= 16:
+            self._posted = {h: p for h, p in self._posted.items() if now - p[1] < self.settle_time}
+        self._posted[hwnd] = (hkl, now)
+        metrics.mark()
+        self.switch_count += 1
+        if self.window_info_cache is not None:
+            self.window_info_cache.invalidate()
+
+    async def _confirm_layout(self, hwnd, hkl):
+        await self.verifier.run(hwnd, lambda: self._post(hwnd, hkl), lambda: self.read_window_hkl(hwnd) == hkl,
+                                f'Layout 0x{hkl:08x}', applied=True)
+        posted = self._posted.get(hwnd)
+        if posted is not None and posted[0] == hkl:
+            del self._posted[hwnd]
+
+    def get_secondary_keyboard_id(self, hwnd):
+        """窗口的第二语言布局：规则指定的，否则为全局配置"""
+        if self.policy is not None:
+            return self.policy.decide(hwnd).secondary or self.secondary_keyboard_id
+        return self.secondary_keyboard_id
+
+    def toggle_target(self, hwnd, langid):
+        """窗口当前为 langid 时，切换热键的目标布局"""
+        secondary_keyboard_id = self.get_secondary_keyboard_id(hwnd)
+        return ENGLISH_KEYBOARD_ID if langid == secondary_keyboard_id[4:8] else secondary_keyboard_id
+
+    def toggle(self):
+        hwnd = self.get_front_window()
+        title = self.get_window_title(hwnd) or '[Unknown]'
+        target = self.toggle_target(hwnd, self.get_window_langid(hwnd))
+        self.set_input_language_for_window(hwnd, target)
+        if target == ENGLISH_KEYBOARD_ID:
+            logger.info(f'{title}: toggled to ENGLISH')
+        else:
+            logger.info(f'{title}: toggled to secondary keyboard')
+
+    def switch_english(self):
+        hwnd = self.get_front_window()
+        title = self.get_window_title(hwnd) or '[Unknown]'
+        self.set_input_language_for_window(hwnd, ENGLISH_KEYBOARD_ID)
+        logger.info(f'{title}: switched to ENGLISH')
+
+    def switch_secondary(self):
+        hwnd = self.get_front_window()
+        title = self.get_window_title(hwnd) or '[Unknown]'
+        self.set_input_language_for_window(hwnd, self.get_secondary_keyboard_id(hwnd))
+        logger.info(f'{title}: switched to secondary keyboard')
+
+    def on_window_change(self, hwnd):
+        """前台窗口变化：记下上一个窗口的布局，新窗口按规则或记忆切换布局"""
+        if not hwnd:
+            return False
+        metrics.count_call('GetAncestor')
+        hwnd = self.backend.get_root_owner(hwnd)
+        previous, self._focused = self._focused, hwnd
+        if self.memory is not None and previous and previous != hwnd:
+            # 布局可能是用户用 Win+Space 等方式切换的，离开时读取实际布局
+            self.memory.remember_layout(previous, self.get_window_hkl(previous) or None)
+        return self.apply_policy_layout(hwnd) or self.restore_layout(hwnd)
+
+    def restore_layout(self, hwnd):
+        """恢复窗口上次使用的布局"""
+        if self.memory is None:
+            return False
+        hkl = self.memory.recall_layout(hwnd)
+        if hkl is None or self.get_window_hkl(hwnd) == hkl:
+            return False
+        self.post_layout(hwnd, hkl)
+        logger.info(f'{self.get_window_title(hwnd) or "[Unknown]"}: restored layout 0x{hkl:08x}')
+        return True
+
+    def apply_policy_layout(self, hwnd):
+        """窗口获得焦点时切换到规则指定的布局；已是该布局或没有规则时不做任何事"""
+        if self.policy is None or not hwnd:
+            return False
+        layout = self.policy.decide(hwnd).layout
+        if layout is None or self.get_window_langid(hwnd) == layout[4:8]:
+            return False
+        self.set_input_language_for_window(hwnd, layout)
+        logger.info(f'{self.get_window_title(hwnd) or "[Unknown]"}: switched to {layout} by rule')
+        return True
+
+    async def temp_toggle(self, activity_scheduler, key_press_interval: float, on_timer=None):
+        """
+        切换一次，等用户停止输入 key_press_interval 秒后把该窗口切回原来的布局。
+        等待期间用户自己改了布局（例如按了切换热键）时不再切回。
+        同一时间只应有一个临时切换，由 HotkeyActions 保证。
+
+        on_timer: 可选，收到切回用的 DeadlineTimer，用于延长等待
+        """
+        # 只在等待切回期间采样键盘活动
+        with activity_scheduler.armed() as activity_source:
+            await asyncio.sleep(self.temp_toggle_delay)
+            hwnd = self.get_front_window()
+            original = self.get_window_hkl(hwnd)
+
+            # for Chinese, there's a time to select the Chinese character
+            is_switching_to_chinese = (format(original & 0xFFFF, '04x') == ENGLISH_LANG_ID
+                                       and self.get_secondary_keyboard_id(hwnd)[4:8] == '0804')
+            if is_switching_to_chinese:
+                key_press_interval = max(key_press_interval, 2)
+
+            self.toggle()
+            switched = self.get_window_hkl(hwnd)
+
+            logger.info(f'Switching back in when key is inactive for {key_press_interval}...')
+
+            await wait_for_key_inactivity(activity_source, key_press_interval, on_timer)
+            if self.get_window_hkl(hwnd) == switched:
+                self.post_layout(hwnd, original)
+                logger.info(f'{self.get_window_title(hwnd) or "[Unknown]"}: switched back')
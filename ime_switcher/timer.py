@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""基于截止时间的可重置定时器，用于"停止输入 N 秒后切回" """
+
+import heapq
+import itertools
+
+
+class DeadlineTimer:
+    """
+    可重置的截止时间定时器。
+
+    每次 touch() 把截止时间推迟到 timestamp + interval，到达截止时间时调用 callback。
+    时间取自 loop.time()（单调时钟）。按键期间不会重复操作定时器堆：
+    到期时若截止时间已被推迟，只重新安排一次。
+
+    Args:
+        loop: 事件循环，或任何提供 time() / call_at() 的对象（例如 FakeClock）
+        interval: 不活动时长（秒）
+        callback: 到期回调
+        histogram: 可选，记录实际触发时间与截止时间的误差（毫秒）
+    """
+
+    def __init__(self, loop, interval, callback, histogram=None):
+        self.loop = loop
+        self.interval = interval
+        self.callback = callback
+        self.histogram = histogram
+        self.deadline = None
+        self._handle = None
+
+    @property
+    def is_pending(self):
+        return self.deadline is not None
+
+    def touch(self, timestamp=None):
+        """记录一次活动，截止时间推迟到 timestamp + interval"""
+        now = self.loop.time() if timestamp is None else timestamp
+        self.deadline = now + self.interval
+        if self._handle is None:
+            self._handle = self.loop.call_at(self.deadline, self._on_timer)
+
+    def cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self.deadline = None
+
+    def _on_timer(self):
+        self._handle = None
+        if self.deadline is None:
+            return
+        now = self.loop.time()
+        if now < self.deadline:
+            # 期间有新的活动，按新的截止时间重新安排
+            self._handle = self.loop.call_at(self.deadline, self._on_timer)
+            return
+        if self.histogram is not None:
+            self.histogram.add((now - self.deadline) * 1000)
+        self.deadline = None
+        self.callback()
+
+
+class _FakeHandle:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeClock:
+    """可手动推进的时钟，提供 DeadlineTimer 所需的 time() / call_at()"""
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self._queue = []
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback):
+        handle = _FakeHandle()
+        heapq.heappush(self._queue, (when, next(self._seq), handle, callback))
+        return handle
+
+    def advance(self, seconds):
+        """推进时钟，并按时间顺序执行期间到期的回调"""
+        target = self.now + seconds
+        while self._queue and self._queue[0][0] <= target:
+            when, _, handle, callback = heapq.heappop(self._queue)
+            self.now = max(self.now, when)
+            if not handle.cancelled:
+                callback()
+        self.now = target
+
+
+if __name__ == '__main__':
+    import asyncio
+    import random
+    import time
+
+    from ime_switcher.metrics import Histogram
+
+    # 1. 假时钟：验证到期时间精确等于最后一次活动 + interval
+    clock = FakeClock()
+    fired = []
+    timer = DeadlineTimer(clock, 0.6, lambda: fired.append(clock.time()))
+    for _ in range(20):
+        timer.touch()
+        clock.advance(0.05)
+    clock.advance(1.0)
+    print(f'fake clock: last touch at {0.95:.2f}s, fired at {fired[0]:.2f}s')
+
+    # 2. 真实事件循环：模拟多次输入后停止，统计切回误差
+    async def run(rounds=50):
+        loop = asyncio.get_running_loop()
+        latency = Histogram('switch_back_error_ms')
+        for _ in range(rounds):
+            done = loop.create_future()
+            timer = DeadlineTimer(loop, 0.3, lambda: done.set_result(None), latency)
+            for _ in range(random.randint(1, 10)):
+                timer.touch(time.monotonic())
+                await asyncio.sleep(random.uniform(0.01, 0.1))
+            await done
+        return latency
+
+    print(f'event loop: {asyncio.run(run()).summary()}')
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Win32 绑定：程序用到的全部 user32 / imm32 / kernel32 / wtsapi32 函数在这里声明一次
+（argtypes / restype），首次使用时加载，函数指针作为属性缓存在 Win32Api 上。
+
+- api(): 返回共享的 Win32Api；非 Windows 平台上抛出 OSError，调用方按“不可用”处理
+- Win32Api.error(): 统一的错误：用调用线程最后一次的 GetLastError 构造 OSError (WinError)
+- text_buffer() / out_dword() / out_size_t(): 线程局部、可复用的输出缓冲区，
+  热路径（窗口标题、IME 查询）不再每次分配。返回的缓冲区在同一线程的下一次调用前有效
+- FakeWin32Api: 用 Python 实现 Win32Backend 用到的函数（同样的参数形式，写入同样的缓冲区），
+  用于在 Linux 上运行 Win32Backend 本身的代码并测量绑定层的开销
+"""
+
+import ctypes
+import ctypes.wintypes
+import threading
+
+# 窗口标题、类名、进程路径的初始缓冲区大小（字符），不够时按需放大
+TEXT_BUFFER_SIZE = 512
+
+
+class LASTINPUTINFO(ctypes.Structure):
+    _fields_ = [('cbSize', ctypes.wintypes.UINT), ('dwTime', ctypes.wintypes.DWORD)]
+
+
+class KBDLLHOOKSTRUCT(ctypes.Structure):
+    _fields_ = [
+        ('vkCode', ctypes.wintypes.DWORD),
+        ('scanCode', ctypes.wintypes.DWORD),
+        ('flags', ctypes.wintypes.DWORD),
+        ('time', ctypes.wintypes.DWORD),
+        ('dwExtraInfo', ctypes.c_size_t),
+    ]
+
+
+class GUID(ctypes.Structure):
+    _fields_ = [
+        ('Data1', ctypes.wintypes.DWORD),
+        ('Data2', ctypes.wintypes.WORD),
+        ('Data3', ctypes.wintypes.WORD),
+        ('Data4', ctypes.c_ubyte * 8),
+    ]
+
+    @classmethod
+    def from_tuple(cls, value):
+        data1, data2, data3, data4 = value
+        return cls(data1, data2, data3, (ctypes.c_ubyte * 8)(*data4))
+
+    def as_tuple(self):
+        return self.Data1, self.Data2, self.Data3, tuple(self.Data4)
+
+
+class POWERBROADCAST_SETTING(ctypes.Structure):
+    _fields_ = [
+        ('PowerSetting', GUID),
+        ('DataLength', ctypes.wintypes.DWORD),
+        ('Data', ctypes.wintypes.DWORD),
+    ]
+
+
+def _prototypes(api):
+    """DLL -> ((函数名, restype, *argtypes), ...)"""
+    wt = ctypes.wintypes
+    MSG = ctypes.POINTER(wt.MSG)
+    return {
+        'user32': (
+            ('GetForegroundWindow', wt.HWND),
+            ('GetAncestor', wt.HWND, wt.HWND, wt.UINT),
+            ('GetWindowThreadProcessId', wt.DWORD, wt.HWND, ctypes.POINTER(wt.DWORD)),
+            ('GetWindowTextW', ctypes.c_int, wt.HWND, wt.LPWSTR, ctypes.c_int),
+            ('GetWindowTextLengthW', ctypes.c_int, wt.HWND),
+            ('GetClassNameW', ctypes.c_int, wt.HWND, wt.LPWSTR, ctypes.c_int),
+            ('GetKeyboardLayout', wt.HKL, wt.DWORD),
+            ('LoadKeyboardLayoutW', wt.HKL, wt.LPCWSTR, wt.UINT),
+            ('GetKeyboardLayoutList', ctypes.c_int, ctypes.c_int, ctypes.POINTER(wt.HKL)),
+            ('SendMessageTimeoutW', wt.LPARAM, wt.HWND, wt.UINT, wt.WPARAM, wt.LPARAM, wt.UINT, wt.UINT,
+             ctypes.POINTER(ctypes.c_size_t)),
+            ('PostMessageW', wt.BOOL, wt.HWND, wt.UINT, wt.WPARAM, wt.LPARAM),
+            ('PostThreadMessageW', wt.BOOL, wt.DWORD, wt.UINT, wt.WPARAM, wt.LPARAM),
+            ('GetMessageW', wt.BOOL, MSG, wt.HWND, wt.UINT, wt.UINT),
+            ('PeekMessageW', wt.BOOL, MSG, wt.HWND, wt.UINT, wt.UINT, wt.UINT),
+            ('TranslateMessage', wt.BOOL, MSG),
+            ('DispatchMessageW', wt.LPARAM, MSG),
+            ('GetAsyncKeyState', ctypes.c_short, ctypes.c_int),
+            ('GetLastInputInfo', wt.BOOL, ctypes.POINTER(LASTINPUTINFO)),
+            ('RegisterHotKey', wt.BOOL, wt.HWND, ctypes.c_int, wt.UINT, wt.UINT),
+            ('UnregisterHotKey', wt.BOOL, wt.HWND, ctypes.c_int),
+            ('SetWinEventHook', wt.HANDLE, wt.DWORD, wt.DWORD, wt.HMODULE, api.WINEVENTPROC, wt.DWORD, wt.DWORD,
+             wt.DWORD),
+            ('UnhookWinEvent', wt.BOOL, wt.HANDLE),
+            ('SetWindowsHookExW', wt.HHOOK, ctypes.c_int, api.HOOKPROC, wt.HINSTANCE, wt.DWORD),
+            ('CallNextHookEx', wt.LPARAM, wt.HHOOK, ctypes.c_int, wt.WPARAM, wt.LPARAM),
+            ('UnhookWindowsHookEx', wt.BOOL, wt.HHOOK),
+            ('RegisterClassW', wt.ATOM, ctypes.POINTER(api.WNDCLASSW)),
+            ('UnregisterClassW', wt.BOOL, wt.LPCWSTR, wt.HINSTANCE),
+            ('CreateWindowExW', wt.HWND, wt.DWORD, wt.LPCWSTR, wt.LPCWSTR, wt.DWORD, ctypes.c_int, ctypes.c_int,
+             ctypes.c_int, ctypes.c_int, wt.HWND, wt.HMENU, wt.HINSTANCE, wt.LPVOID),
+            ('DestroyWindow', wt.BOOL, wt.HWND),
+            ('DefWindowProcW', wt.LPARAM, wt.HWND, wt.UINT, wt.WPARAM, wt.LPARAM),
+            ('RegisterPowerSettingNotification', wt.HANDLE, wt.HANDLE, ctypes.POINTER(GUID), wt.DWORD),
+            ('UnregisterPowerSettingNotification', wt.BOOL, wt.HANDLE),
+        ),
+        'imm32': (
+            ('ImmGetDefaultIMEWnd', wt.HWND, wt.HWND),
+        ),
+        'kernel32': (
+            ('GetTickCount', wt.DWORD),
+            ('GetCurrentThreadId', wt.DWORD),
+            ('GetModuleHandleW', wt.HMODULE, wt.LPCWSTR),
+            ('OpenProcess', wt.HANDLE, wt.DWORD, wt.BOOL, wt.DWORD),
+            ('QueryFullProcessImageNameW', wt.BOOL, wt.HANDLE, wt.DWORD, wt.LPWSTR, ctypes.POINTER(wt.DWORD)),
+            ('CloseHandle', wt.BOOL, wt.HANDLE),
+            ('FindFirstChangeNotificationW', wt.HANDLE, wt.LPCWSTR, wt.BOOL, wt.DWORD),
+            ('FindNextChangeNotification', wt.BOOL, wt.HANDLE),
+            ('FindCloseChangeNotification', wt.BOOL, wt.HANDLE),
+            ('CreateEventW', wt.HANDLE, wt.LPVOID, wt.BOOL, wt.BOOL, wt.LPCWSTR),
+            ('SetEvent', wt.BOOL, wt.HANDLE),
+            ('WaitForMultipleObjects', wt.DWORD, wt.DWORD, ctypes.POINTER(wt.HANDLE), wt.BOOL, wt.DWORD),
+        ),
+        'wtsapi32': (
+            ('WTSRegisterSessionNotification', wt.BOOL, wt.HWND, wt.DWORD),
+            ('WTSUnRegisterSessionNotification', wt.BOOL, wt.HWND),
+        ),
+    }
+
+
+class Win32Api:
+    """
+    已声明原型的 Win32 函数（扁平命名空间，例如 api().GetForegroundWindow），
+    以及只能在 Windows 上创建的回调原型 WINEVENTPROC / HOOKPROC / WNDPROC 和结构体 WNDCLASSW。
+    """
+    name = 'win32'
+
+    def __init__(self):
+        if not hasattr(ctypes, 'WINFUNCTYPE'):
+            raise OSError('Win32 API is not available on this platform')
+        wt = ctypes.wintypes
+        self.WINEVENTPROC = ctypes.WINFUNCTYPE(None, wt.HANDLE, wt.DWORD, wt.HWND, wt.LONG, wt.LONG, wt.DWORD,
+                                               wt.DWORD)
+        self.HOOKPROC = ctypes.WINFUNCTYPE(wt.LPARAM, ctypes.c_int, wt.WPARAM, wt.LPARAM)
+        self.WNDPROC = ctypes.WINFUNCTYPE(wt.LPARAM, wt.HWND, wt.UINT, wt.WPARAM, wt.LPARAM)
+
+        class WNDCLASSW(ctypes.Structure):
+            _fields_ = [
+                ('style', wt.UINT),
+                ('lpfnWndProc', self.WNDPROC),
+                ('cbClsExtra', ctypes.c_int),
+                ('cbWndExtra', ctypes.c_int),
+                ('hInstance', wt.HINSTANCE),
+                ('hIcon', wt.HICON),
+                ('hCursor', wt.HANDLE),
+                ('hbrBackground', wt.HBRUSH),
+                ('lpszMenuName', wt.LPCWSTR),
+                ('lpszClassName', wt.LPCWSTR),
+            ]
+        self.WNDCLASSW = WNDCLASSW
+
+        for dll_name, functions in _prototypes(self).items():
+            dll = ctypes.WinDLL(dll_name, use_last_error=True)
+            for name, restype, *argtypes in functions:
+                function = getattr(dll, name)
+                function.restype = restype
+                function.argtypes = argtypes
+                setattr(self, name, function)
+
+    @staticmethod
+    def last_error():
+        """调用线程最后一次 Win32 调用的错误码（use_last_error 保存的副本）"""
+        return ctypes.get_last_error()
+
+    def error(self, code=None):
+        return ctypes.WinError(self.last_error() if code is None else code)
+
+
+_api = None
+_api_lock = threading.Lock()
+
+
+def api():
+    global _api
+    if _api is None:
+        with _api_lock:
+            if _api is None:
+                _api = Win32Api()
+    return _api
+
+
+class _Buffers(threading.local):
+    def __init__(self):
+        self.text = ctypes.create_unicode_buffer(TEXT_BUFFER_SIZE)
+        self.dword = ctypes.wintypes.DWORD()
+        self.size_t = ctypes.c_size_t()
+
+
+_buffers = _Buffers()
+
+
+def text_buffer(size=TEXT_BUFFER_SIZE):
+    """至少 size 个字符的 WCHAR 缓冲区（线程局部，按需放大）"""
+    if len(_buffers.text) < size:
+        _buffers.text = ctypes.create_unicode_buffer(size)
+    return _buffers.text
+
+
+def out_dword():
+    return _buffers.dword
+
+
+def out_size_t():
+    return _buffers.size_t
+
+
+class FakeWin32Api:
+    """
+    Win32Backend 用到的函数的 Python 实现，参数形式与真实函数相同（缓冲区、byref 输出参数）。
+    windows: {hwnd: FakeWindow}，未知窗口的行为与真实 API 一致（返回 0 并设置错误码）。
+    """
+    name = 'fake'
+
+    ERROR_INVALID_WINDOW_HANDLE = 1400
+
+    def __init__(self):
+        self.windows = {}
+        self.foreground = 0
+        self.tick_count = 0
+        self._error = 0
+
+    def add_window(self, hwnd, title='', class_name='', thread_id=1, pid=1, hkl=0x04090409, hime=0,
+                   image='C:\\Windows\\notepad.exe'):
+        self.windows[hwnd] = (title, class_name, thread_id, pid, hkl, hime, image)
+        if not self.foreground:
+            self.foreground = hwnd
+
+    def last_error(self):
+        return self._error
+
+    def error(self, code=None):
+        code = self._error if code is None else code
+        return OSError(code, f'[WinError {code}]')
+
+    def _window(self, hwnd):
+        window = self.windows.get(hwnd)
+        self._error = 0 if window is not None else self.ERROR_INVALID_WINDOW_HANDLE
+        return window
+
+    @staticmethod
+    def _set(out, value):
+        # byref() 的结果通过 _obj 访问原对象
+        getattr(out, '_obj', out).value = value
+
+    def GetForegroundWindow(self):
+        return self.foreground or None
+
+    def GetAncestor(self, hwnd, flags):
+        return hwnd if self._window(hwnd) else None
+
+    def GetWindowThreadProcessId(self, hwnd, pid):
+        window = self._window(hwnd)
+        if window is None:
+            return 0
+        if pid is not None:
+            self._set(pid, window[3])
+        return window[2]
+
+    def GetWindowTextLengthW(self, hwnd):
+        window = self._window(hwnd)
+        return len(window[0]) if window else 0
+
+    def GetWindowTextW(self, hwnd, buffer, size):
+        window = self._window(hwnd)
+        text = window[0][:size - 1] if window else ''
+        buffer.value = text
+        return len(text)
+
+    def GetClassNameW(self, hwnd, buffer, size):
+        window = self._window(hwnd)
+        text = window[1][:size - 1] if window else ''
+        buffer.value = text
+        return len(text)
+
+    def GetKeyboardLayout(self, thread_id):
+        return next((window[4] for window in self.windows.values() if window[2] == thread_id), None)
+
+    def ImmGetDefaultIMEWnd(self, hwnd):
+        window = self._window(hwnd)
+        return window[5] if window else None
+
+    def SendMessageTimeoutW(self, hwnd, message, wparam, lparam, flags, timeout, result):
+        self._set(result, 1)
+        return 1
+
+    def PostMessageW(self, hwnd, message, wparam, lparam):
+        return 1 if self._window(hwnd) else 0
+
+    def GetLastInputInfo(self, info):
+        getattr(info, '_obj', info).dwTime = self.tick_count
+        return 1
+
+    def GetTickCount(self):
+        return self.tick_count
+
+    def OpenProcess(self, access, inherit, pid):
+        return pid if any(window[3] == pid for window in self.windows.values()) else None
+
+    def QueryFullProcessImageNameW(self, process, flags, buffer, size):
+        image = next(window[6] for window in self.windows.values() if window[3] == process)
+        buffer.value = image
+        self._set(size, len(image))
+        return 1
+
+    def CloseHandle(self, handle):
+        return 1
+
+
+def _benchmark(rounds=100000, repeats=7):
+    """
+    在 FakeWin32Api 上运行 Win32Backend 的真实代码，测量绑定层本身的开销（不含 Win32 调用）：
+    旧的写法（每次新建缓冲区 / 输出参数，标题先取长度再取文本）对比复用线程局部缓冲区。
+    两种写法交替运行 repeats 轮，各取最好的一轮，减少 CPU 频率和调度带来的偏差。
+    """
+    import functools
+    import time
+
+    from ime_switcher.backend import IMC_GETCONVERSIONMODE, SMTO_ABORTIFHUNG, WM_IME_CONTROL, Win32Backend
+
+    fake = FakeWin32Api()
+    fake.add_window(0x1234, title='README.md - Visual Studio Code', class_name='Chrome_WidgetWin_1',
+                    hkl=0x08040804, hime=0x5678)
+    backend = Win32Backend(fake)
+
+    def legacy_title(hwnd):
+        length = fake.GetWindowTextLengthW(hwnd) + 1
+        if length <= 1:
+            return ""
+        buf = ctypes.create_unicode_buffer(length)
+        fake.GetWindowTextW(hwnd, buf, length)
+        return buf.value
+
+    def legacy_ime_control(hime, command, value=0, timeout_ms=200):
+        result = ctypes.c_size_t()
+        if not fake.SendMessageTimeoutW(hime, WM_IME_CONTROL, command, value, SMTO_ABORTIFHUNG, timeout_ms,
+                                        ctypes.byref(result)):
+            raise TimeoutError
+        return result.value
+
+    def legacy_class(hwnd):
+        buf = ctypes.create_unicode_buffer(256)
+        fake.GetClassNameW(hwnd, buf, len(buf))
+        return buf.value
+
+    def measure(func, *args):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            func(*args)
+        return (time.perf_counter() - start) / rounds * 1e6
+
+    def compare(legacy, current, *args):
+        timings = [(measure(legacy, *args), measure(current, *args)) for _ in range(repeats)]
+        return min(t[0] for t in timings), min(t[1] for t in timings)
+
+    def count_calls(func, *args):
+        """func 一次调用里的 Win32 调用次数"""
+        calls = []
+        names = ('GetWindowTextLengthW', 'GetWindowTextW', 'GetClassNameW', 'SendMessageTimeoutW')
+        for name in names:
+            setattr(fake, name, functools.partial(lambda f, *a: calls.append(f) or f(*a), getattr(fake, name)))
+        try:
+            func(*args)
+        finally:
+            for name in names:
+                delattr(fake, name)
+        return len(calls)
+
+    for name, legacy, current, args in (
+            ('title fetch', legacy_title, backend.get_window_title, (0x1234,)),
+            ('class name', legacy_class, backend.get_window_class, (0x1234,)),
+            ('status probe', legacy_ime_control, backend.send_ime_control, (0x5678, IMC_GETCONVERSIONMODE))):
+        before, after = compare(legacy, current, *args)
+        print(f'{name:12}: {before:5.2f} -> {after:5.2f} us/call binding overhead ({before / after:.1f}x), '
+              f'{count_calls(legacy, *args)} -> {count_calls(current, *args)} Win32 calls')
+
+
+if __name__ == '__main__':
+    _benchmark()